@@ -1,4 +1,4 @@
-from openai import OpenAI
+from vllm_client import get_client, resolve_model, create_chat_completion
 import time
 
 
@@ -11,13 +11,13 @@ ip_algo='192.168.5.212'
 
 #client = OpenAI(api_key='YOUR_API_KEY', base_url='http://192.168.5.212:8000/v1')
 
-client = OpenAI(api_key='sk-2x1zj2w6q7jQ8q6Y5q6Y5q6Y', base_url=f'http://{ip_algo}:8000/v1')
+client = get_client('sk-2x1zj2w6q7jQ8q6Y5q6Y5q6Y', f'http://{ip_algo}:8000/v1')
 prompt="what's your name"
 T0=time.time()
-model_name = client.models.list().data[0].id
+model_name = resolve_model(client)
 print(model_name)
-response = client.chat.completions.create(
-    model=model_name,
+response = create_chat_completion(
+    client,
     messages=[
         {
         'role':'system',
@@ -1,21 +1,35 @@
 import gradio as gr
-import base64
-import io
 from PIL import Image
-from typing import Generator, List, Dict
+from typing import Callable, Generator, List, Dict, Optional, Union
 import requests
 import json
 from openai import OpenAI
+from vllm_client import get_client
+from endpoint_router import parse_endpoints
+from dispatch import (dispatch_chat_completion, stream_chat_completion, batch_request_timeout, max_in_flight,
+                      format_endpoint_status)
+from retry_policy import DeadLetterQueue
+from hedging import HedgePolicy
+from concurrency import PRIORITY_BATCH, PRIORITY_INTERACTIVE, batch_priority
+from async_engine import caption_filename
+from fanout import FanoutStats, fanout_captions, fanout_filename
+from prompt_groups import PromptCacheStats, grouped_order
+from image_preprocess import get_preprocessor
+from pipeline import batch_pipeline, start_process_pool
+from result_cache import batch_result_cache, sampling_params
+from result_sink import batch_zip_sink
+from dedup import batch_dedup
+from media_transport import TRANSPORTS, TRANSPORT_BASE64, create_transport, default_transport
 import logging
 import asyncio
 import aiofiles
-from concurrent.futures import ThreadPoolExecutor
-import zipfile
+from concurrent.futures import wait
 import os
 import tempfile
 from pathlib import Path
 import random
 import time
+from functools import partial
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -240,21 +254,9 @@ EXTRA_OPTIONS_MAP = {
     "避免无用的描述开头": "Your response will be used by a text-to-image model, so avoid useless meta phrases like \"This image shows…\", \"You are looking at...\", etc.",
 }
 
-# 🔥 新增：分批文件处理器
-class BatchFileProcessor:
-    def __init__(self, batch_size=50):
-        self.batch_size = batch_size
-        
-    def create_batches(self, files):
-        """创建批次，避免内存溢出"""
-        batches = []
-        for i in range(0, len(files), self.batch_size):
-            batches.append(files[i:i + self.batch_size])
-        return batches
-    
 def create_openai_client(api_key: str, base_url: str) -> OpenAI:
-    """创建OpenAI客户端"""
-    return OpenAI(api_key=api_key, base_url=base_url)
+    """获取共享的OpenAI客户端（进程内按地址和密钥复用连接池）"""
+    return get_client(api_key, base_url)
 
 
 def build_prompt(caption_type: str, caption_length: str | int, extra_options: list[str]) -> str:
@@ -280,24 +282,32 @@ def build_prompt(caption_type: str, caption_length: str | int, extra_options: li
 
 
 def test_api_connection(base_url: str, api_key: str) -> tuple[bool, str]:
-    """测试API连接"""
-    try:
-        client = create_openai_client(api_key, base_url)
-        models = client.models.list()
-        if models.data:
-            return True, f"✅ 连接成功！可用模型: {models.data[0].id}"
-        else:
-            return False, "❌ 连接失败：没有可用的模型"
-    except Exception as e:
-        return False, f"❌ 连接失败：{str(e)}"
+    """测试API连接（多个地址时逐个测试）"""
+    endpoints = parse_endpoints(base_url)
+    if not endpoints:
+        return False, "❌ 连接失败：请填写API地址"
+    messages = []
+    all_ok = True
+    for endpoint in endpoints:
+        prefix = f"{endpoint}: " if len(endpoints) > 1 else ""
+        try:
+            client = create_openai_client(api_key, endpoint)
+            models = client.models.list()
+            if models.data:
+                messages.append(f"✅ {prefix}连接成功！可用模型: {models.data[0].id}")
+            else:
+                all_ok = False
+                messages.append(f"❌ {prefix}连接失败：没有可用的模型")
+        except Exception as e:
+            all_ok = False
+            messages.append(f"❌ {prefix}连接失败：{str(e)}")
+    return all_ok, "<br>".join(messages)
 
 
-def image_to_base64(image: Image.Image) -> str:
-    """将PIL图像转换为base64"""
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    image_bytes = buffer.getvalue()
-    return base64.b64encode(image_bytes).decode("utf-8")
+def image_to_data_url(image: Union[Image.Image, str]) -> str:
+    """将图片转换为 data URL：文件路径符合直传条件时直接发送原始字节，否则按模型视觉输入尺寸预缩放、
+    编码（格式和质量见 image_preprocess）；批量处理时预处理流水线已编码好的 data URL 原样返回"""
+    return get_preprocessor().source_to_data_url(image)
 
 
 def get_safe_filename(filename: str) -> str:
@@ -311,6 +321,97 @@ def get_safe_filename(filename: str) -> str:
     return filename
 
 
+def build_caption_messages(image_data: str, prompt: str) -> List[Dict]:
+    """构建打标请求的消息列表（提示词在图片之前，同一提示词模板的请求共享 system + 提示词前缀缓存）"""
+    return [
+        {
+            'role': 'system',
+            'content': 'You are a helpful image captioner.',
+        },
+        {
+            'role': 'user',
+            'content': [
+                {'type': 'text', 'text': prompt},
+                {'type': 'image_url', 'image_url': {'url': image_data}}
+            ],
+        }
+    ]
+
+
+def generate_caption_variants(
+    image: Union[Image.Image, str],
+    prompt: str,
+    base_url: str,
+    api_key: str,
+    temperature: float,
+    top_p: float,
+    max_tokens: int,
+    n: int = 1,
+    adaptive: bool = False,
+    hedge: Optional[HedgePolicy] = None,
+    priority: int = PRIORITY_BATCH,
+    on_usage: Optional[Callable] = None,
+    timeout: Optional[float] = None
+) -> List[str]:
+    """一次请求生成 n 个描述变体（图片和提示词只预填充一次，n 条序列并行解码），出错时抛出异常
+
+    base_url 可包含多个端点，adaptive=True 时受自适应并发控制并按 priority 排队，
+    传入 hedge 时对慢请求发出对冲副本，on_usage 接收响应的 usage（用于统计前缀缓存命中），
+    timeout 为每次尝试的时限（秒）。
+    """
+    image_data = image_to_data_url(image)
+    
+    response = dispatch_chat_completion(
+        base_url,
+        api_key,
+        adaptive=adaptive,
+        hedge=hedge,
+        priority=priority,
+        timeout=timeout,
+        messages=build_caption_messages(image_data, prompt),
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        n=n
+    )
+    
+    if on_usage is not None:
+        on_usage(response.usage)
+    return [choice.message.content.strip() for choice in sorted(response.choices, key=lambda c: c.index)]
+
+
+def generate_caption_fanout(
+    image: Union[Image.Image, str],
+    prompts: Dict[str, str],
+    base_url: str,
+    api_key: str,
+    temperature: float,
+    top_p: float,
+    max_tokens: int,
+    n: int = 1,
+    priority: int = PRIORITY_BATCH,
+    stats: Optional[FanoutStats] = None,
+    timeout: Optional[float] = None
+) -> Dict[str, List[str]]:
+    """同一张图片按多个提示词生成描述（图片在前，请求连续发往同一端点以命中前缀缓存），出错时抛出异常；
+    timeout 为每个请求每次尝试的时限（秒）"""
+    image_data = image_to_data_url(image)
+    
+    return fanout_captions(
+        base_url,
+        api_key,
+        image_data,
+        prompts,
+        priority=priority,
+        stats=stats,
+        timeout=timeout,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        n=n
+    )
+
+
 def generate_single_caption(
     image: Image.Image,
     prompt: str,
@@ -318,37 +419,17 @@ def generate_single_caption(
     api_key: str,
     temperature: float,
     top_p: float,
-    max_tokens: int
+    max_tokens: int,
+    adaptive: bool = False,
+    hedge: Optional[HedgePolicy] = None,
+    priority: int = PRIORITY_BATCH
 ) -> str:
-    """生成单个图像描述（用于批量处理）"""
+    """生成单个图像描述，出错时返回以 "Error:" 开头的文本"""
     try:
-        base64_image = image_to_base64(image)
-        image_data = f"data:image/png;base64,{base64_image}"
-        
-        client = create_openai_client(api_key, base_url)
-        model_name = client.models.list().data[0].id
-        
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {
-                    'role': 'system',
-                    'content': 'You are a helpful image captioner.',
-                },
-                {
-                    'role': 'user',
-                    'content': [
-                        {'type': 'text', 'text': prompt},
-                        {'type': 'image_url', 'image_url': {'url': image_data}}
-                    ],
-                }
-            ],
-            temperature=temperature,
-            top_p=top_p,
-            max_tokens=max_tokens
-        )
-        
-        return response.choices[0].message.content.strip()
+        return generate_caption_variants(
+            image, prompt, base_url, api_key, temperature, top_p, max_tokens,
+            1, adaptive, hedge, priority
+        )[0]
         
     except Exception as e:
         logging.error(f"生成描述时出错: {str(e)}")
@@ -364,7 +445,7 @@ def generate_caption(
     top_p: float,
     max_tokens: int
 ) -> Generator[str, None, None]:
-    """生成图像描述（单图处理用）"""
+    """生成图像描述（单图处理用），逐 token 流式输出并显示首 token 时间和生成速度"""
     if image is None:
         yield "❌ 请先上传图片"
         return
@@ -376,14 +457,24 @@ def generate_caption(
     try:
         yield "🔄 正在处理图片..."
         
-        caption = generate_single_caption(
-            image, prompt, base_url, api_key, temperature, top_p, max_tokens
-        )
+        image_data = image_to_data_url(image)
+        progress = None
+        # 单图请求以交互优先级排队，批量任务运行时也能优先获得并发名额
+        for progress in stream_chat_completion(
+            base_url,
+            api_key,
+            priority=PRIORITY_INTERACTIVE,
+            messages=build_caption_messages(image_data, prompt),
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens
+        ):
+            yield f"{progress.format()}\n\n{progress.text}"
         
-        if caption.startswith("Error:"):
-            yield f"❌ 生成失败: {caption}"
+        if progress is None:
+            yield "❌ 生成失败: 服务端没有返回内容"
         else:
-            yield f"✅ 生成完成！\n\n{caption}"
+            yield f"✅ 生成完成！{progress.format()}\n\n{progress.text.strip()}"
         
     except Exception as e:
         logging.error(f"生成描述时出错: {str(e)}")
@@ -424,9 +515,14 @@ def process_batch_images(
     temperature: float,
     top_p: float, 
     max_tokens: int,
+    hedge_percentile: float = 0,
+    variants: int = 1,
+    fanout_prompts: Optional[Dict[str, str]] = None,
+    transport: str = TRANSPORT_BASE64,
     progress=gr.Progress()
 ) -> tuple[str, str]:
-    """批量处理图片（单一提示词）"""
+    """批量处理图片（单一提示词）；传入 fanout_prompts 时每张图片按其中每个提示词各生成一份描述，
+    transport 为 file/http 时图片以本地路径或文件服务器 URL 发送"""
     if not files_info:
         return "❌ 请先上传图片", None
     
@@ -434,76 +530,103 @@ def process_batch_images(
         return "❌ 请配置API地址和密钥", None
     
     try:
-        # 创建临时目录
+        # 创建临时目录（只存放结果压缩包）
         temp_dir = tempfile.mkdtemp()
-        results_dir = os.path.join(temp_dir, "results")
-        os.makedirs(results_dir, exist_ok=True)
+        zip_path = os.path.join(temp_dir, "caption_results.zip")
         
         total_images = len(files_info)
         success_count = 0
         error_count = 0
         processed_files = []
+        dead_letters = DeadLetterQueue()
+        # 扇出模式不使用对冲：副本会落到其他端点，无法命中前缀缓存
+        fanout_stats = FanoutStats() if fanout_prompts else None
+        hedge = HedgePolicy(percentile=hedge_percentile) if hedge_percentile > 0 and not fanout_stats else None
+        priority = batch_priority(total_images)
+        # 结果缓存（环境变量 JOYCAPTION_RESULT_CACHE）：图片、提示词、模型和采样参数都相同的请求直接复用上次结果
+        result_cache, model = batch_result_cache(base_url, api_key)
+        sampling = sampling_params(temperature, top_p, max_tokens, variants)
+        # 每次请求的时限由 HTTP 层执行：超时即断开连接（vLLM 随之中止生成）并按可重试错误处理
+        timeout = batch_request_timeout()
         
         progress(0, desc="开始批量处理...")
         
-        # 使用线程池并行处理
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = []
-            for i, (image, original_filename) in enumerate(files_info):
-                future = executor.submit(
-                    generate_single_caption,
-                    image, prompt, base_url, api_key, 
-                    temperature, top_p, max_tokens
-                )
-                futures.append((i, future, original_filename))
+        # 两级流水线：预处理进程解码、预缩放、编码图片，网络线程只收发请求；
+        # 请求按端点路由，实际并发由各端点的自适应限制器控制
+        # 描述完成一条就追加一条到压缩包（环境变量 JOYCAPTION_ZIP_COMPRESSION/JOYCAPTION_ZIP_LEVEL），
+        # 最后一张图片写完即可下载，不再有单独的打包阶段
+        with batch_zip_sink(zip_path) as sink, \
+                batch_pipeline(max_in_flight(base_url, api_key), create_transport(transport, base_url),
+                               result_cache, batch_dedup()) as pipeline:
+            # 去重（环境变量 JOYCAPTION_DEDUP）：每组重复图片只提交代表，其余复用代表的 Future
+            duplicates = pipeline.find_duplicates([image for image, _ in files_info])
+            representatives = set(duplicates.values())
+            submitted = {}
             
-            # 收集结果
-            for i, future, original_filename in futures:
-                try:
-                    caption = future.result(timeout=60)  # 60秒超时
-                    
-                    if caption.startswith("Error:"):
-                        error_count += 1
-                        caption = f"处理失败: {caption}"
+            def submissions():
+                """迭代到哪张才提交哪张，窗口满时阻塞；只保留有重复图片的代表的 Future"""
+                for image, original_filename in files_info:
+                    if isinstance(image, str) and image in duplicates:
+                        pipeline.dedup.record_saved(len(fanout_prompts) if fanout_stats is not None else 1)
+                        yield original_filename, submitted[duplicates[image]]
+                        continue
+                    result_key = result_cache.key_for(image, fanout_prompts or prompt, model, sampling) \
+                        if result_cache is not None and isinstance(image, str) else None
+                    if fanout_stats is not None:
+                        future = pipeline.submit(
+                            image, generate_caption_fanout,
+                            fanout_prompts, base_url, api_key,
+                            temperature, top_p, max_tokens, variants, priority, fanout_stats, timeout,
+                            result_key=result_key
+                        )
                     else:
-                        success_count += 1
+                        future = pipeline.submit(
+                            image, generate_caption_variants,
+                            prompt, base_url, api_key, 
+                            temperature, top_p, max_tokens, variants, True, hedge, priority, None, timeout,
+                            result_key=result_key
+                        )
+                    if isinstance(image, str) and image in representatives:
+                        submitted[image] = future
+                    yield original_filename, future
+            
+            # 边提交边按完成顺序收集结果：已完成的图片立即以原始文件名写出描述，慢请求不挡住其他图片
+            for original_filename, future in pipeline.stream(submissions()):
+                try:
+                    result = future.result()
+                    success_count += 1
                     
                     # 使用原始文件名
                     safe_filename = get_safe_filename(original_filename)
                     # 移除原始扩展名，添加.txt扩展名
                     base_name = os.path.splitext(safe_filename)[0]
-                    txt_filename = f"{base_name}.txt"
-                    
-                    filepath = os.path.join(results_dir, txt_filename)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(caption)
-                    
-                    processed_files.append(txt_filename)
-                    
-                    # 更新进度
-                    progress_val = (i + 1) / total_images
-                    progress(progress_val, desc=f"已处理 {i+1}/{total_images} 张图片")
+                    # 扇出时每个描述类型写为 name_类型.txt；多个变体依次写为 name.txt, name_1.txt, ...
+                    outputs = {fanout_filename(base_name, name): captions for name, captions in result.items()} \
+                        if fanout_stats is not None else {base_name: result}
+                    for output_name, captions in outputs.items():
+                        for j, caption in enumerate(captions):
+                            txt_filename = caption_filename(output_name, j)
+                            processed_files.append(sink.write(txt_filename, caption))
                     
                 except Exception as e:
                     error_count += 1
+                    dead_letters.add(original_filename, str(e))
                     safe_filename = get_safe_filename(original_filename)
                     base_name = os.path.splitext(safe_filename)[0]
                     txt_filename = f"{base_name}.txt"
                     
-                    filepath = os.path.join(results_dir, txt_filename)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(f"处理出错: {str(e)}")
-                    
-                    processed_files.append(txt_filename)
+                    processed_files.append(sink.write(txt_filename, f"处理出错: {str(e)}"))
+                
+                # 进度按实际完成的图片数（含失败）更新
+                completed = success_count + error_count
+                progress(completed / total_images, desc=f"已处理 {completed}/{total_images} 张图片")
+            
+            # 失败列表随结果一起打包，便于只重新上传失败的图片
+            if dead_letters:
+                sink.write("failed_images.txt", dead_letters.dumps())
         
-        # 创建ZIP文件
-        zip_path = os.path.join(temp_dir, "caption_results.zip")
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(results_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, results_dir)
-                    zipf.write(file_path, arcname)
+        if hedge is not None:
+            hedge.cancel_shadows()
         
         # 生成摘要
         summary = f"""
@@ -511,9 +634,20 @@ def process_batch_images(
 
 ### 📈 处理统计
 - **总图片数**: {total_images}
+{f"- **每张图片描述数**: {variants}（n 采样，一次请求生成）" if variants > 1 else ""}
 - **成功处理**: {success_count} 张 
 - **处理失败**: {error_count} 张
 - **成功率**: {success_count/total_images*100:.1f}%
+{f"- **失败列表**: ZIP 包中的 `failed_images.txt`（{len(dead_letters)} 张，可只重新上传这些图片）" if dead_letters else ""}
+- **结果压缩包**: {sink.format_stats()}
+
+### 🌐 端点状态
+{format_endpoint_status(base_url, api_key)}
+
+### 🏭 预处理流水线
+{pipeline.format_report()}
+{f"{chr(10)}### ⏱️ 尾延迟对冲{chr(10)}{hedge.format_report()}{chr(10)}" if hedge else ""}
+{f"{chr(10)}### 🔀 多类型扇出（{len(fanout_prompts)} 种描述类型）{chr(10)}{fanout_stats.format_report()}{chr(10)}" if fanout_stats else ""}
 
 ### 📁 处理的文件
 {chr(10).join([f"- {filename}" for filename in processed_files[:10]])}
@@ -542,9 +676,12 @@ def process_mix_batch_images(
     temperature: float,
     top_p: float, 
     max_tokens: int,
+    hedge_percentile: float = 0,
+    variants: int = 1,
+    transport: str = TRANSPORT_BASE64,
     progress=gr.Progress()
 ) -> tuple[str, str]:
-    """混合模式批量处理图片"""
+    """混合模式批量处理图片，transport 为 file/http 时图片以本地路径或文件服务器 URL 发送"""
     if not files_info:
         return "❌ 请先上传图片", None
     
@@ -555,95 +692,127 @@ def process_mix_batch_images(
         return "❌ 请配置API地址和密钥", None
     
     try:
-        # 创建临时目录
+        # 创建临时目录（只存放结果压缩包）
         temp_dir = tempfile.mkdtemp()
-        results_dir = os.path.join(temp_dir, "results")
-        os.makedirs(results_dir, exist_ok=True)
+        zip_path = os.path.join(temp_dir, "mix_caption_results.zip")
         
         total_images = len(files_info)
         success_count = 0
         error_count = 0
         processed_files = []
+        dead_letters = DeadLetterQueue()
+        hedge = HedgePolicy(percentile=hedge_percentile) if hedge_percentile > 0 else None
+        priority = batch_priority(total_images)
         prompt_usage_stats = {i: 0 for i in range(len(prompt_configs))}
         
         progress(0, desc="开始混合模式处理...")
         
-        # 为每张图片预先分配提示词
-        image_prompt_assignments = []
-        for i, (image, original_filename) in enumerate(files_info):
-            selected_prompt = select_prompt_by_weight(prompt_configs)
-            # 找到选中提示词的索引
-            prompt_idx = None
-            for idx, config in enumerate(prompt_configs):
-                if config['prompt'] == selected_prompt:
-                    prompt_idx = idx
-                    break
-            if prompt_idx is not None:
-                prompt_usage_stats[prompt_idx] += 1
-            image_prompt_assignments.append((image, original_filename, selected_prompt, prompt_idx))
+        result_cache, model = batch_result_cache(base_url, api_key)
+        sampling = sampling_params(temperature, top_p, max_tokens, variants)
+        # 每次请求的时限由 HTTP 层执行：超时即断开连接（vLLM 随之中止生成）并按可重试错误处理
+        timeout = batch_request_timeout()
         
-        # 使用线程池并行处理
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = []
-            for i, (image, original_filename, prompt, prompt_idx) in enumerate(image_prompt_assignments):
-                future = executor.submit(
-                    generate_single_caption,
-                    image, prompt, base_url, api_key, 
-                    temperature, top_p, max_tokens
-                )
-                futures.append((i, future, original_filename, prompt_idx))
+        # 两级流水线：预处理进程解码、预缩放、编码图片，网络线程只收发请求；
+        # 请求按端点路由，实际并发由各端点的自适应限制器控制（按提交顺序放行）
+        # 描述完成一条就追加一条到压缩包（环境变量 JOYCAPTION_ZIP_COMPRESSION/JOYCAPTION_ZIP_LEVEL），
+        # 最后一张图片写完即可下载，不再有单独的打包阶段
+        with batch_zip_sink(zip_path) as sink, \
+                batch_pipeline(max_in_flight(base_url, api_key), create_transport(transport, base_url),
+                               result_cache, batch_dedup()) as pipeline:
+            # 每组重复图片只抽一次提示词，组内图片都沿用代表的提示词并复用代表的 Future，每组只发一次请求
+            duplicates = pipeline.find_duplicates([image for image, _ in files_info])
+            clustered = set(duplicates) | set(duplicates.values())
+            submitted = {}
+            
+            # 为每张图片预先分配提示词
+            image_prompt_assignments = []
+            cluster_prompts = {}
+            for i, (image, original_filename) in enumerate(files_info):
+                cluster = duplicates.get(image, image) if isinstance(image, str) and image in clustered else None
+                if cluster in cluster_prompts:
+                    selected_prompt, prompt_idx = cluster_prompts[cluster]
+                else:
+                    selected_prompt = select_prompt_by_weight(prompt_configs)
+                    # 找到选中提示词的索引
+                    prompt_idx = None
+                    for idx, config in enumerate(prompt_configs):
+                        if config['prompt'] == selected_prompt:
+                            prompt_idx = idx
+                            break
+                    if cluster is not None:
+                        cluster_prompts[cluster] = (selected_prompt, prompt_idx)
+                if prompt_idx is not None:
+                    prompt_usage_stats[prompt_idx] += 1
+                image_prompt_assignments.append((image, original_filename, selected_prompt, prompt_idx))
+            
+            # 按模板分组发送：每个模板先发一个预热请求，完成后其余请求按模板成组排队，
+            # 让在途请求集中在同一模板上，system + 提示词前缀保持在 vLLM 前缀缓存中
+            primers, grouped = grouped_order(image_prompt_assignments, key=lambda item: item[3])
+            cache_stats = PromptCacheStats(
+                {idx: config['prompt'] for idx, config in enumerate(prompt_configs)},
+                {idx: f"提示词{idx + 1}" for idx in range(len(prompt_configs))},
+            )
+            
+            def submissions():
+                """按预热、分组的顺序迭代到哪张才提交哪张，窗口满时阻塞；预热请求全部完成后才提交其余图片"""
+                for batch in (primers, grouped):
+                    primer_futures = []
+                    for image, original_filename, prompt, prompt_idx in batch:
+                        cluster = duplicates.get(image, image) if isinstance(image, str) and image in clustered else None
+                        if cluster in submitted:
+                            pipeline.dedup.record_saved()
+                            yield original_filename, submitted[cluster]
+                            continue
+                        result_key = result_cache.key_for(image, prompt, model, sampling) \
+                            if result_cache is not None and isinstance(image, str) else None
+                        future = pipeline.submit(
+                            image, generate_caption_variants,
+                            prompt, base_url, api_key, 
+                            temperature, top_p, max_tokens, variants, True, hedge, priority,
+                            partial(cache_stats.record, prompt_idx), timeout,
+                            result_key=result_key
+                        )
+                        if cluster is not None:
+                            submitted[cluster] = future
+                        if batch is primers:
+                            primer_futures.append(future)
+                        yield original_filename, future
+                    wait(primer_futures)
             
-            # 收集结果
-            for i, future, original_filename, prompt_idx in futures:
+            # 边提交边按完成顺序收集结果：已完成的图片立即以原始文件名写出描述，慢请求不挡住其他图片
+            for original_filename, future in pipeline.stream(submissions()):
                 try:
-                    caption = future.result(timeout=60)  # 60秒超时
-                    
-                    if caption.startswith("Error:"):
-                        error_count += 1
-                        caption = f"处理失败: {caption}"
-                    else:
-                        success_count += 1
-                    
-                    # 添加元信息到结果中
-                    prompt_name = f"提示词{prompt_idx + 1}" if prompt_idx is not None else "未知"
-                    caption_with_meta = f"{caption}\n\n<!-- 使用提示词: {prompt_name} -->"
+                    captions = future.result()
+                    success_count += 1
                     
                     # 使用原始文件名
                     safe_filename = get_safe_filename(original_filename)
                     # 移除原始扩展名，添加.txt扩展名
                     base_name = os.path.splitext(safe_filename)[0]
-                    txt_filename = f"{base_name}.txt"
-                    
-                    filepath = os.path.join(results_dir, txt_filename)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(caption)
-                    
-                    processed_files.append(txt_filename)
-                    
-                    # 更新进度
-                    progress_val = (i + 1) / total_images
-                    progress(progress_val, desc=f"已处理 {i+1}/{total_images} 张图片")
+                    # 多个变体依次写为 name.txt, name_1.txt, ...
+                    for j, caption in enumerate(captions):
+                        txt_filename = caption_filename(base_name, j)
+                        processed_files.append(sink.write(txt_filename, caption))
                     
                 except Exception as e:
                     error_count += 1
+                    dead_letters.add(original_filename, str(e))
                     safe_filename = get_safe_filename(original_filename)
                     base_name = os.path.splitext(safe_filename)[0]
                     txt_filename = f"{base_name}.txt"
                     
-                    filepath = os.path.join(results_dir, txt_filename)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(f"处理出错: {str(e)}")
-                    
-                    processed_files.append(txt_filename)
+                    processed_files.append(sink.write(txt_filename, f"处理出错: {str(e)}"))
+                
+                # 进度按实际完成的图片数（含失败）更新
+                completed = success_count + error_count
+                progress(completed / total_images, desc=f"已处理 {completed}/{total_images} 张图片")
+            
+            # 失败列表随结果一起打包，便于只重新上传失败的图片
+            if dead_letters:
+                sink.write("failed_images.txt", dead_letters.dumps())
         
-        # 创建ZIP文件
-        zip_path = os.path.join(temp_dir, "mix_caption_results.zip")
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(results_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, results_dir)
-                    zipf.write(file_path, arcname)
+        if hedge is not None:
+            hedge.cancel_shadows()
         
         # 生成摘要，包含提示词使用统计
         prompt_stats = []
@@ -658,13 +827,26 @@ def process_mix_batch_images(
 
 ### 📈 处理统计
 - **总图片数**: {total_images}
+{f"- **每张图片描述数**: {variants}（n 采样，一次请求生成）" if variants > 1 else ""}
 - **成功处理**: {success_count} 张 
 - **处理失败**: {error_count} 张
 - **成功率**: {success_count/total_images*100:.1f}%
+{f"- **失败列表**: ZIP 包中的 `failed_images.txt`（{len(dead_letters)} 张，可只重新上传这些图片）" if dead_letters else ""}
+- **结果压缩包**: {sink.format_stats()}
+
+### 🌐 端点状态
+{format_endpoint_status(base_url, api_key)}
+
+### 🏭 预处理流水线
+{pipeline.format_report()}
+{f"{chr(10)}### ⏱️ 尾延迟对冲{chr(10)}{hedge.format_report()}{chr(10)}" if hedge else ""}
 
 ### 🎯 提示词使用统计
 {chr(10).join(prompt_stats)}
 
+### 🧠 前缀缓存（按模板分组发送）
+{cache_stats.format_report()}
+
 ### 📁 处理的文件
 {chr(10).join([f"- {filename}" for filename in processed_files[:10]])}
 {f"... 还有 {len(processed_files)-10} 个文件" if len(processed_files) > 10 else ""}
@@ -697,9 +879,9 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
         with gr.Row():
             with gr.Column(scale=2):
                 api_base_url = gr.Textbox(
-                    label="🌐 API地址",
+                    label="🌐 API地址（多个地址用逗号分隔，自动负载均衡）",
                     value="http://192.168.5.212:8000/v1",
-                    placeholder="http://your-api-server:port/v1"
+                    placeholder="http://server-a:8000/v1, http://server-b:8001/v1"
                 )
             with gr.Column(scale=2):
                 api_key = gr.Textbox(
@@ -763,6 +945,22 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
                             minimum=1, maximum=1024, value=512, step=1,
                             label="📊 最大Token数"
                         )
+                        hedge_percentile_slider = gr.Slider(
+                            minimum=0, maximum=99, value=0, step=1,
+                            label="⏱️ 尾延迟对冲分位数",
+                            info="批量处理时，请求超过近期延迟的该分位数仍未完成则再发一个副本，取先完成者；0 = 关闭"
+                        )
+                        variants_slider = gr.Slider(
+                            minimum=1, maximum=8, value=1, step=1,
+                            label="🔁 每张图片的描述数",
+                            info="批量处理时一次请求生成多个描述变体（name.txt, name_1.txt, ...），图片只预填充一次"
+                        )
+                        transport_radio = gr.Radio(
+                            choices=list(TRANSPORTS),
+                            value=default_transport(),
+                            label="🚚 批量图片传输方式",
+                            info="base64 = 内联编码；file = 发送本地路径（需与 vLLM 共享存储，vLLM 加 --allowed-local-media-path）；http = 由内置文件服务器提供 URL"
+                        )
                 
                 with gr.Column(scale=1):
                     # 提示词显示
@@ -1146,7 +1344,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
     )
     
     def process_mix_batch_wrapper(files, base_url, api_key, temp, top_p, max_tokens,
-                              t1, l1, w1, e1, t2, l2, w2, e2, t3, l3, w3, e3, t4, l4, w4, e4, t5, l5, w5, e5):
+                              t1, l1, w1, e1, t2, l2, w2, e2, t3, l3, w3, e3, t4, l4, w4, e4, t5, l5, w5, e5, hedge_percentile=0, variants=1,
+                              transport=TRANSPORT_BASE64):
         """优化的混合模式批量处理函数"""
         if not files:
             return "❌ 请先上传图片", gr.update(visible=False)
@@ -1174,33 +1373,13 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
         if not prompt_configs:
             return "❌ 请至少设置一个权重大于0的提示词", gr.update(visible=False)
         
-        # 📦 分批加载图片
-        processor = BatchFileProcessor(batch_size=50)
-        file_batches = processor.create_batches(files)
-        
-        all_files_info = []
-        failed_files = []
-        
-        for batch_idx, file_batch in enumerate(file_batches):
-            for file in file_batch:
-                try:
-                    original_filename = os.path.basename(file.name)
-                    image = Image.open(file.name)
-                    # 🔧 调整图片大小
-                    if max(image.size) > 1024:
-                        image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-                    all_files_info.append((image, original_filename))
-                except Exception as e:
-                    failed_files.append(f"{os.path.basename(file.name)}: {str(e)}")
-                    continue
-        
-        if not all_files_info:
-            error_msg = "❌ 没有有效的图片\n" + "\n".join(failed_files[:10])
-            return error_msg, gr.update(visible=False)
+        # 只记下路径和原始文件名，图片在流水线预处理时才读取，无法识别的文件记为处理失败
+        all_files_info = [(file.name, os.path.basename(file.name)) for file in files]
         
         # 其余部分保持不变...
         status, zip_path = process_mix_batch_images(
-            all_files_info, prompt_configs, base_url, api_key, temp, top_p, max_tokens
+            all_files_info, prompt_configs, base_url, api_key, temp, top_p, max_tokens, hedge_percentile,
+            int(variants), transport
         )
         
         if zip_path:
@@ -1208,7 +1387,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
         else:
             return status, gr.update(visible=False)
     def process_mix_batch_wrapper(files, base_url, api_key, temp, top_p, max_tokens,
-                                t1, l1, w1, e1, t2, l2, w2, e2, t3, l3, w3, e3, t4, l4, w4, e4, t5, l5, w5, e5):
+                                t1, l1, w1, e1, t2, l2, w2, e2, t3, l3, w3, e3, t4, l4, w4, e4, t5, l5, w5, e5, hedge_percentile=0, variants=1,
+                                transport=TRANSPORT_BASE64):
         """优化的混合模式批量处理函数"""
         if not files:
             return "❌ 请先上传图片", gr.update(visible=False)
@@ -1236,33 +1416,13 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
         if not prompt_configs:
             return "❌ 请至少设置一个权重大于0的提示词", gr.update(visible=False)
         
-        # 📦 分批加载图片
-        processor = BatchFileProcessor(batch_size=50)
-        file_batches = processor.create_batches(files)
-        
-        all_files_info = []
-        failed_files = []
-        
-        for batch_idx, file_batch in enumerate(file_batches):
-            for file in file_batch:
-                try:
-                    original_filename = os.path.basename(file.name)
-                    image = Image.open(file.name)
-                    # 🔧 调整图片大小
-                    if max(image.size) > 1024:
-                        image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
-                    all_files_info.append((image, original_filename))
-                except Exception as e:
-                    failed_files.append(f"{os.path.basename(file.name)}: {str(e)}")
-                    continue
-        
-        if not all_files_info:
-            error_msg = "❌ 没有有效的图片\n" + "\n".join(failed_files[:10])
-            return error_msg, gr.update(visible=False)
+        # 只记下路径和原始文件名，图片在流水线预处理时才读取，无法识别的文件记为处理失败
+        all_files_info = [(file.name, os.path.basename(file.name)) for file in files]
         
         # 其余部分保持不变...
         status, zip_path = process_mix_batch_images(
-            all_files_info, prompt_configs, base_url, api_key, temp, top_p, max_tokens
+            all_files_info, prompt_configs, base_url, api_key, temp, top_p, max_tokens, hedge_percentile,
+            int(variants), transport
         )
         
         if zip_path:
@@ -1372,6 +1532,9 @@ with gr.Blocks(theme=gr.themes.Soft(), title="🎨 JoyCaption 混合模式") as
             mix_type_3, mix_length_3, mix_weight_3, mix_extra_3,
             mix_type_4, mix_length_4, mix_weight_4, mix_extra_4,
             mix_type_5, mix_length_5, mix_weight_5, mix_extra_5,
+            hedge_percentile_slider,
+            variants_slider,
+            transport_radio,
         ],
         outputs=[mix_batch_status, mix_download_file],
     )
@@ -1410,6 +1573,9 @@ if __name__ == "__main__":
     print(f"🚀 启动JoyCaption 混合模式 API Demo...")
     print(f"🌐 访问地址: http://{args.host}:{args.port}")
     
+    # 在启动服务线程之前创建共享的预处理进程池，子进程不会继承服务线程持有的锁
+    start_process_pool()
+    
     demo.launch(
         server_name=args.host,
         server_port=args.port,
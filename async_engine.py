@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import os
+import statistics
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from vllm_client import aclose_async_clients, StreamProgress
+from endpoint_router import parse_endpoints
+from dispatch import adispatch_chat_completion, astream_chat_completion
+from retry_policy import RetryPolicy, DeadLetterQueue
+from hedging import HedgePolicy
+from fanout import FanoutStats, afanout_captions, fanout_filename
+from image_preprocess import ImagePreprocessor, content_hash, get_preprocessor
+from payload_cache import PayloadCache
+from media_transport import MediaTransport
+from result_cache import ResultCache, sampling_params, served_models
+from dedup import DuplicateIndex, image_signature
+from pipeline import (PipelineStats, TimedSemaphore, create_process_pool, lookup_payload, media_url, prepare_source,
+                      DEFAULT_PREFETCH, PREPROCESS_WORKERS)
+
+# 默认并发：每个端点同时在途的请求数，应接近 vLLM 的 --max-num-seqs 能容纳的批大小
+DEFAULT_CONCURRENCY = 16
+# 流式模式下输出实时进度的间隔（秒）
+PROGRESS_INTERVAL = 5.0
+
+
+class StreamMonitor:
+    """汇总流式请求的实时进度：生成速度按所有在途和已完成请求的 token 增量计算"""
+
+    def __init__(self):
+        self.active: Set[StreamProgress] = set()
+        self.completed_tokens = 0
+        self.ttfts: Deque[float] = deque(maxlen=500)
+        self._last_time = time.monotonic()
+        self._last_tokens = 0
+
+    def update(self, progress: StreamProgress, previous: Optional[StreamProgress]) -> None:
+        """登记正在读取的流；重试后换成新的进度对象时丢弃旧的"""
+        if progress is not previous:
+            self.active.discard(previous)
+            self.active.add(progress)
+
+    def complete(self, progress: Optional[StreamProgress]) -> None:
+        if progress is None or progress not in self.active:
+            return
+        self.active.discard(progress)
+        self.completed_tokens += progress.tokens
+        if progress.ttft is not None:
+            self.ttfts.append(progress.ttft)
+
+    def discard(self, progress: Optional[StreamProgress]) -> None:
+        self.active.discard(progress)
+
+    def format(self) -> str:
+        """输出一行实时进度：正在输出的请求数、首 token 中位数、最近一段时间的总生成速度"""
+        now = time.monotonic()
+        tokens = self.completed_tokens + sum(p.tokens for p in self.active)
+        rate = (tokens - self._last_tokens) / max(now - self._last_time, 1e-6)
+        self._last_time, self._last_tokens = now, tokens
+        ttft = f"{statistics.median(self.ttfts):.2f}s" if self.ttfts else "-"
+        return f"输出中 {len(self.active)}，首 token 中位数 {ttft}，生成速度 {rate:.0f} tokens/s，累计 {tokens} tokens"
+
+
+class AsyncCaptionEngine:
+    """异步批量打标引擎：生产者把图片路径入队，消费者读取图片并在信号量限制下并发请求
+
+    base_url 可以是逗号分隔的多个端点，请求按在途数路由，总并发为 concurrency × 端点数。
+    prompt 为 {名称: 提示词} 字典时进入扇出模式：每张图片按所有提示词各生成一份描述，
+    图片放在提示词之前，同一张图片的请求紧接着发往同一端点以命中前缀缓存。
+    图片的解码、预缩放和编码在 preprocess_workers 个进程中完成（0 表示在线程中），事件循环只负责网络收发；
+    传入 payload_cache 时编码结果按文件内容缓存到磁盘，重跑未改变的图片时跳过预处理；
+    传入 media 时图片以 file:// 或 HTTP URL 发送，由 vLLM 自行读取原始文件；
+    传入 result_cache 时图片、提示词、模型和采样参数（含 seed）都相同的图片直接复用上次的描述，不预处理也不发请求；
+    传入 dedup 时重复图片只由第一张（代表）发请求，其余等待代表完成后以自己的文件名写出同样的描述。
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        prompt: Union[str, Dict[str, str]],
+        concurrency: int = DEFAULT_CONCURRENCY,
+        prefetch: int = DEFAULT_PREFETCH,
+        temperature: float = 0.9,
+        top_p: float = 0.7,
+        max_tokens: int = 256,
+        max_retries: int = 3,
+        hedge_percentile: float = 0,
+        stream: bool = False,
+        variants: int = 1,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        preprocess_workers: int = PREPROCESS_WORKERS,
+        payload_cache: Optional[PayloadCache] = None,
+        media: Optional[MediaTransport] = None,
+        seed: Optional[int] = None,
+        result_cache: Optional[ResultCache] = None,
+        dedup: Optional[DuplicateIndex] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be >= 1")
+        self.api_key = api_key
+        self.base_url = base_url
+        self.prompt = prompt
+        self.concurrency = concurrency
+        self.prefetch = max(0, prefetch)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.retry_policy = RetryPolicy(max_retries=max_retries)
+        self.dead_letters = DeadLetterQueue()
+        # hedge_percentile > 0 时启用尾延迟对冲
+        self.hedge = HedgePolicy(percentile=hedge_percentile) if hedge_percentile > 0 else None
+        # stream=True 时逐 token 读取响应，并定期输出实时进度
+        self.stream = stream
+        self.monitor = StreamMonitor()
+        # 每张图片的描述变体数，通过 n 采样在一次请求中生成
+        self.variants = max(1, variants)
+        # 固定 seed 时同样的请求得到同样的输出，结果缓存复用的就是确定的结果
+        self.seed = seed
+        self.sampling = sampling_params(temperature, top_p, max_tokens, self.variants, seed)
+        self.result_cache = result_cache
+        self._model: Optional[str] = None
+        self.dedup = dedup
+        # 代表图片路径 -> 其描述结果（失败时为 None），重复图片等待对应的 Future
+        self._representatives: Dict[str, asyncio.Future] = {}
+        self.fanout_stats = FanoutStats() if isinstance(prompt, dict) else None
+        # 图片预处理（按模型视觉输入尺寸预缩放），默认使用进程级预处理器
+        self.preprocessor = preprocessor or get_preprocessor()
+        self.preprocess_workers = max(0, preprocess_workers)
+        self.payload_cache = payload_cache
+        self.media = media
+        self.pipeline_stats: Optional[PipelineStats] = None
+        self._pool = None
+        self.processed = 0
+        self.failed = 0
+
+    async def _produce(self, image_paths: Iterable[str], queue: asyncio.Queue, workers: int) -> None:
+        for image_path in image_paths:
+            await queue.put(image_path)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def _consume(self, queue: asyncio.Queue, semaphore: asyncio.Semaphore, output_folder: str) -> None:
+        while True:
+            image_path = await queue.get()
+            if image_path is None:
+                return
+            if await self.process_image(image_path, output_folder, semaphore):
+                self.processed += 1
+            else:
+                self.failed += 1
+
+    async def process_image(self, image_path: str, output_folder: str, semaphore: asyncio.Semaphore) -> bool:
+        """处理单张图片：编码在信号量外完成，只有网络请求占用并发名额；重试耗尽后记入失败列表"""
+        representative = None
+        result = None
+        try:
+            base_name = os.path.splitext(os.path.basename(image_path))[0]
+            digest = None
+            if self.dedup is not None:
+                digest, hashes = await self._signature(image_path)
+                duplicate_of = self.dedup.find(image_path, digest, hashes)
+                if duplicate_of is not None:
+                    cached = await self._representatives[duplicate_of]
+                    if cached is None:
+                        raise RuntimeError(f"重复图片的代表 {duplicate_of} 处理失败")
+                    await self._write_results(cached, base_name, output_folder)
+                    self.dedup.record_saved(len(self.prompt) if self.fanout_stats is not None else 1)
+                    logging.info(f"Reused result of duplicate {duplicate_of}: {image_path}")
+                    return True
+                representative = self._representatives[image_path] = asyncio.get_running_loop().create_future()
+            result_key = None
+            if self.result_cache is not None:
+                if digest is not None:
+                    result_key = ResultCache.key(digest, self.prompt, self._model, self.sampling)
+                else:
+                    result_key = await asyncio.to_thread(
+                        self.result_cache.key_for, image_path, self.prompt, self._model, self.sampling
+                    )
+                cached = await asyncio.to_thread(self.result_cache.get, result_key) if result_key else None
+                if cached is not None:
+                    result = cached
+                    await self._write_results(cached, base_name, output_folder)
+                    logging.info(f"Reused cached result: {image_path}")
+                    return True
+            image_data = await self._prepare(image_path)
+            start = time.perf_counter()
+            if self.fanout_stats is not None:
+                result = await self._fanout_image(image_data, semaphore)
+            else:
+                result = await self._caption_image(image_data, semaphore)
+            if result_key is not None:
+                await asyncio.to_thread(self.result_cache.put, result_key, result, time.perf_counter() - start)
+            await self._write_results(result, base_name, output_folder)
+
+            logging.info(f"Successfully processed: {image_path}")
+            return True
+
+        except Exception as e:
+            logging.error(f"Error processing {image_path}: {str(e)}")
+            self.dead_letters.add(image_path, str(e))
+            return False
+        finally:
+            if representative is not None:
+                representative.set_result(result)
+
+    async def _signature(self, image_path: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+        """去重签名：近似去重要解码缩略图，放在预处理进程池（或线程）中计算；只查完全重复时内容哈希优先读结果缓存的记录"""
+        if self.dedup.near:
+            if self._pool is not None:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._pool, image_signature, image_path, True, self.preprocessor.max_pixels
+                )
+            return await asyncio.to_thread(image_signature, image_path, True, self.preprocessor.max_pixels)
+        hash_file = self.result_cache.image_hash if self.result_cache is not None else content_hash
+        return await asyncio.to_thread(hash_file, image_path), None
+
+    async def _caption_image(self, image_data: str, semaphore: asyncio.Semaphore) -> List[str]:
+        """单提示词模式：一次请求生成所有变体，返回去掉首尾空白的描述列表"""
+        params = dict(
+            messages=[
+                {
+                    'role': 'system',
+                    'content': 'You are a helpful image captioner.',
+                },
+                {
+                    'role': 'user',
+                    'content': [
+                        {'type': 'text', 'text': self.prompt},
+                        {'type': 'image_url', 'image_url': {'url': image_data}}
+                    ],
+                }
+            ],
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+        )
+        if self.variants > 1:
+            params['n'] = self.variants
+        if self.seed is not None:
+            params['seed'] = self.seed
+        async with semaphore:
+            if self.stream:
+                if self.hedge is not None:
+                    captions = await self.hedge.acall(self._stream_caption, params)
+                else:
+                    captions = await self._stream_caption(params)
+            else:
+                response = await adispatch_chat_completion(
+                    self.base_url,
+                    self.api_key,
+                    retry_policy=self.retry_policy,
+                    hedge=self.hedge,
+                    **params,
+                )
+                captions = [choice.message.content for choice in sorted(response.choices, key=lambda c: c.index)]
+        return [caption.strip() for caption in captions]
+
+    async def _write_results(self, result: Union[List[str], Dict[str, List[str]]], base_name: str,
+                             output_folder: str) -> None:
+        """写出一张图片的描述：列表写为 name.txt, name_1.txt, ...；扇出结果写为 name_名称.txt（变体为 name_名称_1.txt ...）"""
+        outputs = {fanout_filename(base_name, name): captions for name, captions in result.items()} \
+            if isinstance(result, dict) else {base_name: result}
+        for output_name, captions in outputs.items():
+            for index, caption in enumerate(captions):
+                output_path = os.path.join(output_folder, caption_filename(output_name, index))
+                await asyncio.to_thread(_write_text, output_path, caption)
+
+    async def _prepare(self, image_path: str) -> str:
+        """在预处理进程池（或线程）中读取并编码图片，记录预处理阶段耗时；使用 URL 传输或缓存命中时直接返回"""
+        if self.media is not None:
+            url, elapsed = await asyncio.to_thread(media_url, self.media, image_path)
+            if url is not None:
+                self.pipeline_stats.record_preprocess(elapsed)
+                return url
+        key = None
+        if self.payload_cache is not None:
+            key, data_url, elapsed = await asyncio.to_thread(
+                lookup_payload, self.payload_cache, image_path, self.preprocessor
+            )
+            if data_url is not None:
+                self.pipeline_stats.record_preprocess(elapsed)
+                return data_url
+        if self._pool is not None:
+            loop = asyncio.get_running_loop()
+            payload, elapsed = await loop.run_in_executor(self._pool, prepare_source, image_path)
+        else:
+            payload, elapsed = await asyncio.to_thread(prepare_source, image_path, self.preprocessor)
+        self.preprocessor.count(payload.passthrough)
+        self.pipeline_stats.record_preprocess(elapsed, payload.peak_bytes)
+        if key is not None and not payload.passthrough:
+            await asyncio.to_thread(self.payload_cache.put, key, payload.data_url)
+        return payload.data_url
+
+    async def _fanout_image(self, image_data: str, semaphore: asyncio.Semaphore) -> Dict[str, List[str]]:
+        """扇出模式：一张图片按所有提示词生成描述，返回 {名称: 描述列表}"""
+        params = dict(temperature=self.temperature, top_p=self.top_p, max_tokens=self.max_tokens)
+        if self.variants > 1:
+            params['n'] = self.variants
+        if self.seed is not None:
+            params['seed'] = self.seed
+        return await afanout_captions(
+            self.base_url, self.api_key, image_data, self.prompt,
+            retry_policy=self.retry_policy, semaphore=semaphore, stats=self.fanout_stats, **params
+        )
+
+    async def _stream_caption(self, params: dict) -> List[str]:
+        """流式读取一次请求的输出（所有变体），进度登记到 monitor"""
+        progress = None
+        try:
+            async for current in astream_chat_completion(
+                self.base_url, self.api_key, retry_policy=self.retry_policy, **params
+            ):
+                self.monitor.update(current, progress)
+                progress = current
+            self.monitor.complete(progress)
+        finally:
+            self.monitor.discard(progress)
+        return progress.variants if progress is not None else []
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            logging.info(f"进度: 完成 {self.processed}，失败 {self.failed}；{self.monitor.format()}")
+
+    async def run(self, image_paths: Iterable[str], output_folder: str) -> Tuple[int, int]:
+        """处理所有图片，返回 (成功数, 失败数)"""
+        total_concurrency = self.concurrency * max(1, len(parse_endpoints(self.base_url)))
+        workers = total_concurrency + self.prefetch
+        queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+        self.pipeline_stats = PipelineStats(self.preprocess_workers, total_concurrency, self.prefetch)
+        self.pipeline_stats.start()
+        # 网络名额按时间积分统计，用于计算网络阶段利用率和就绪图片的排队深度
+        semaphore = TimedSemaphore(total_concurrency, self.pipeline_stats)
+        if self.result_cache is not None:
+            # 模型 ID 是缓存键的一部分，服务端换了模型时不会复用旧模型的描述
+            try:
+                self._model = await asyncio.to_thread(served_models, self.base_url, self.api_key)
+            except Exception as e:
+                logging.warning(f"无法获取模型 ID，本次不使用结果缓存: {str(e)}")
+                self.result_cache = None
+        self._pool = create_process_pool(self.preprocessor, self.preprocess_workers)
+        reporter = asyncio.create_task(self._report_progress()) if self.stream else None
+        try:
+            await asyncio.gather(
+                self._produce(image_paths, queue, workers),
+                *(self._consume(queue, semaphore, output_folder) for _ in range(workers)),
+            )
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if self.hedge is not None:
+                self.hedge.cancel_shadows()
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+            if self.media is not None:
+                self.media.close()
+            self.pipeline_stats.finish()
+            await aclose_async_clients()
+        return self.processed, self.failed
+
+
+def caption_filename(base_name: str, index: int = 0) -> str:
+    """第 index 个描述变体的文件名：name.txt, name_1.txt, name_2.txt, ..."""
+    return f"{base_name}.txt" if index == 0 else f"{base_name}_{index}.txt"
+
+
+def _write_text(path: str, text: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
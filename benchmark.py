@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import base64
+import itertools
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+
+from async_engine import AsyncCaptionEngine, DEFAULT_CONCURRENCY
+from image_captioning import generate_prompt, iter_image_paths
+from image_preprocess import ImagePreprocessor, DEFAULT_MAX_PIXELS, FORMATS, RESAMPLE, open_image, resolve_vision_size
+from media_transport import MediaServer, TRANSPORTS, TRANSPORT_HTTP, create_transport, local_address_for
+
+ip_algo = '192.168.5.212'
+
+
+def _load_images(args) -> List[str]:
+    image_paths = list(itertools.islice(iter_image_paths(args.input), args.limit))
+    if not image_paths:
+        raise ValueError(f"{args.input} 中没有图片")
+    return image_paths
+
+
+def _run_engine(args, prompt, image_paths: List[str], **engine_kwargs) -> float:
+    """用异步引擎处理一批图片（输出写入临时目录），返回墙钟耗时"""
+    engine = AsyncCaptionEngine(args.api_key, args.base_url, prompt, concurrency=args.concurrency, **engine_kwargs)
+    with tempfile.TemporaryDirectory() as output_folder:
+        start = time.monotonic()
+        processed, failed = asyncio.run(engine.run(image_paths, output_folder))
+        elapsed = time.monotonic() - start
+    if failed:
+        logging.warning(f"{failed} 张图片失败，结果可能偏低")
+    return elapsed
+
+
+def bench_fanout(args) -> None:
+    """扇出 vs 逐个提示词分开跑：先跑扇出，再按提示词逐个跑（文本在前的默认布局），比较墙钟耗时
+
+    扇出先跑，其写入的图片前缀缓存（图片在前）无法被文本在前的分开跑复用，保证对比公平；
+    服务端若已缓存过这些图片，请换一批图片或重启 vLLM 后再测。
+    """
+    prompts: Dict[str, str] = {mode: generate_prompt(mode, args.custom_prompt) for mode in args.mode}
+    image_paths = _load_images(args)
+    print(f"{len(image_paths)} 张图片 × {len(prompts)} 个提示词，每个端点并发 {args.concurrency}")
+
+    fanout = _run_engine(args, prompts, image_paths)
+    print(f"扇出（图片在前，同图请求连续发出）: {fanout:.2f} 秒")
+    naive = 0.0
+    for name, prompt in prompts.items():
+        elapsed = _run_engine(args, prompt, image_paths)
+        print(f"分开跑 {name}: {elapsed:.2f} 秒")
+        naive += elapsed
+    print(f"分开跑合计: {naive:.2f} 秒")
+    print(f"加速比: {naive / fanout:.2f}×")
+
+
+def bench_encode(args) -> None:
+    """各编码格式/质量的编码耗时与负载大小（base64 后），图片先统一预缩放，预缩放耗时单独统计"""
+    vision_size = resolve_vision_size(args.vision_size)
+    image_paths = _load_images(args)
+    resize_times, raw_sizes, resized = [], [], []
+    preprocessor = ImagePreprocessor(vision_size)
+    for path in image_paths:
+        start = time.perf_counter()
+        with preprocessor.open(path) as image:
+            resized.append(preprocessor.resize(image).copy())
+        resize_times.append(time.perf_counter() - start)
+        with open(path, 'rb') as f:
+            raw_sizes.append(len(base64.b64encode(f.read())))
+    print(f"{len(image_paths)} 张图片，预缩放边长 {vision_size or '不缩放'}，"
+          f"解码 + 预缩放平均 {statistics.mean(resize_times) * 1000:.1f} ms")
+    print("| 格式 | 质量 | 编码耗时 (ms) | 负载 (KB) | 相对原始文件 |")
+    print("|---|---|---|---|---|")
+    raw = statistics.mean(raw_sizes)
+    print(f"| 原始文件 | - | 0.0 | {raw / 1024:.1f} | 100.0% |")
+    for name in args.formats:
+        for quality in ([None] if name == "png" else args.qualities):
+            preprocessor = ImagePreprocessor(vision_size, name, quality or 100)
+            times, sizes = [], []
+            for image in resized:
+                start = time.perf_counter()
+                payload = base64.b64encode(preprocessor.encode(image))
+                times.append(time.perf_counter() - start)
+                sizes.append(len(payload))
+            size = statistics.mean(sizes)
+            print(f"| {name} | {quality or '-'} | {statistics.mean(times) * 1000:.1f} | {size / 1024:.1f} | "
+                  f"{size / raw * 100:.1f}% |")
+
+
+def _max_rss() -> Optional[int]:
+    """当前进程的峰值常驻内存（字节），没有 resource 模块（Windows）时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _decode_once(path: str, vision_size: int, max_pixels: int, fast: bool) -> Tuple[float, Optional[float]]:
+    """解码并预缩放一张图片，返回 (耗时秒, 峰值内存增量 MB)
+
+    fast=False 为全尺寸解码后直接缩放，fast=True 为打标流程实际使用的按像素预算解码
+    （draft() 缩小解码或分块解码）+ reducing_gap。每次在新进程中运行，峰值内存不受之前测量的影响。
+    """
+    preprocessor = ImagePreprocessor(vision_size, max_pixels=max_pixels)
+    before = _max_rss()
+    start = time.perf_counter()
+    if fast:
+        image, _ = preprocessor.decode(path)
+        with image:
+            preprocessor.resize(image)
+    else:
+        with open_image(path) as image:
+            image.load()
+            image.resize(preprocessor.target_size(*image.size), RESAMPLE)
+    elapsed = time.perf_counter() - start
+    after = _max_rss()
+    return elapsed, (after - before) / 1024 / 1024 if before is not None else None
+
+
+def bench_decode(args) -> None:
+    """全尺寸解码 vs 按像素预算解码：每张图片的解码 + 预缩放耗时和峰值内存增量；
+    超出像素预算且无法分块解码的图片在预算解码一栏标为“拒绝”"""
+    vision_size = resolve_vision_size(args.vision_size)
+    image_paths = _load_images(args)
+    print(f"{len(image_paths)} 张图片，预缩放边长 {vision_size or '不缩放'}，像素预算 {args.max_pixels or '不限'}，"
+          f"每项取 {args.repeat} 次中的最快值")
+    print("| 图片 | 尺寸 | 全尺寸解码 (ms) | 预算解码 (ms) | 加速 | 峰值内存 全尺寸 (MB) | 峰值内存 预算解码 (MB) |")
+    print("|---|---|---|---|---|---|---|")
+    for path in image_paths:
+        results = {}
+        for fast in (False, True):
+            runs = []
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    try:
+                        runs.append(pool.submit(_decode_once, path, vision_size, args.max_pixels, fast).result())
+                    except ValueError:
+                        break
+            results[fast] = (min(t for t, _ in runs), max((m for _, m in runs if m is not None), default=None)) \
+                if runs else (None, None)
+        with open_image(path) as image:
+            size = f"{image.width}×{image.height} {image.format}"
+        (full, full_mem), (fast, fast_mem) = results[False], results[True]
+        memory = [f"{m:.1f}" if m is not None else "-" for m in (full_mem, fast_mem)]
+        if fast is None:
+            print(f"| {os.path.basename(path)} | {size} | {full * 1000:.1f} | 拒绝 | - | {memory[0]} | - |")
+            continue
+        print(f"| {os.path.basename(path)} | {size} | {full * 1000:.1f} | {fast * 1000:.1f} | "
+              f"{full / fast:.1f}× | {memory[0]} | {memory[1]} |")
+
+
+def bench_transport(args) -> None:
+    """各图片传输方式的墙钟耗时、客户端 CPU 时间和每张图片的请求负载
+
+    预处理在线程中进行（preprocess_workers=0），客户端 CPU 时间即本进程的 CPU 时间。
+    vLLM 按图片内容缓存多模态前缀，同一批图片换传输方式重跑会命中缓存；公平对比请每种方式换一批图片或重启 vLLM。
+    """
+    image_paths = _load_images(args)
+    preprocessor = ImagePreprocessor(resolve_vision_size(args.vision_size))
+    prompt = generate_prompt(args.mode)
+    print(f"{len(image_paths)} 张图片，每个端点并发 {args.concurrency}")
+    print("| 传输方式 | 墙钟耗时 (s) | 客户端 CPU (s) | 每张负载 (KB) |")
+    print("|---|---|---|---|")
+    for transport in args.transports:
+        server = MediaServer(args.media_host or local_address_for(args.base_url)) if transport == TRANSPORT_HTTP else None
+        try:
+            media = create_transport(transport, args.base_url, server)
+            cpu = time.process_time()
+            elapsed = _run_engine(args, prompt, image_paths, preprocess_workers=0, preprocessor=preprocessor,
+                                  media=media)
+            cpu = time.process_time() - cpu
+            sizes = [len((media.url_for(path) if media else None) or preprocessor.file_to_data_url(path))
+                     for path in image_paths]
+        finally:
+            if server is not None:
+                server.close()
+        print(f"| {transport} | {elapsed:.2f} | {cpu:.2f} | {statistics.mean(sizes) / 1024:.1f} |")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='打标流程的性能测试')
+    parser.add_argument('--base_url', type=str, default=f'http://{ip_algo}:8000/v1', help='OpenAI API 基础 URL，多个端点用逗号分隔')
+    parser.add_argument('--api_key', type=str, default="your-api-key", help='OpenAI API 密钥')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fanout = subparsers.add_parser('fanout', help='多提示词扇出与逐个提示词分开跑的耗时对比')
+    fanout.add_argument('--input', type=str, required=True, help='测试图像文件夹路径')
+    fanout.add_argument('--mode', type=str, nargs='+', choices=['tag', 'des', 'custom'], default=['tag', 'des'],
+                        help='参与对比的提示词模式')
+    fanout.add_argument('--custom_prompt', type=str, default=None, help='自定义提示词（mode 含 custom 时使用）')
+    fanout.add_argument('--limit', type=int, default=50, help='最多使用多少张图片')
+    fanout.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='每个端点同时在途的请求数')
+    fanout.set_defaults(func=bench_fanout)
+
+    encode = subparsers.add_parser('encode', help='各编码格式的编码耗时与负载大小（不发请求）')
+    encode.add_argument('--input', type=str, required=True, help='测试图像文件夹路径')
+    encode.add_argument('--formats', type=str, nargs='+', choices=list(FORMATS), default=list(FORMATS),
+                        help='参与对比的编码格式')
+    encode.add_argument('--qualities', type=int, nargs='+', default=[75, 85, 90, 95], help='JPEG/WebP 的编码质量')
+    encode.add_argument('--vision_size', type=int, default=None, help='预缩放边长（默认同打标流程）')
+    encode.add_argument('--limit', type=int, default=50, help='最多使用多少张图片')
+    encode.set_defaults(func=bench_encode)
+
+    decode = subparsers.add_parser('decode', help='大图全尺寸解码与按像素预算解码的耗时和峰值内存（不发请求）')
+    decode.add_argument('--input', type=str, required=True, help='测试图像文件夹路径（建议放 4K/8K 照片和超大 TIFF）')
+    decode.add_argument('--vision_size', type=int, default=None, help='预缩放边长（默认同打标流程）')
+    decode.add_argument('--max_pixels', type=int, default=DEFAULT_MAX_PIXELS, help='像素预算（0 为不限）')
+    decode.add_argument('--repeat', type=int, default=3, help='每张图片重复测量的次数')
+    decode.add_argument('--limit', type=int, default=20, help='最多使用多少张图片')
+    decode.set_defaults(func=bench_decode)
+
+    transport = subparsers.add_parser('transport', help='base64 内联与 file/http URL 传输的耗时和负载对比')
+    transport.add_argument('--input', type=str, required=True, help='测试图像文件夹路径')
+    transport.add_argument('--transports', type=str, nargs='+', choices=list(TRANSPORTS), default=list(TRANSPORTS),
+                           help='参与对比的传输方式（file 需要 vLLM 能访问同一路径）')
+    transport.add_argument('--mode', type=str, choices=['tag', 'des'], default='tag', help='提示词模式')
+    transport.add_argument('--vision_size', type=int, default=None, help='base64 方式的预缩放边长（默认同打标流程）')
+    transport.add_argument('--media_host', type=str, default=None, help='vLLM 访问本机文件服务器的地址（默认自动选择）')
+    transport.add_argument('--limit', type=int, default=50, help='最多使用多少张图片')
+    transport.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='每个端点同时在途的请求数')
+    transport.set_defaults(func=bench_transport)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
+
+## python benchmark.py --base_url http://127.0.0.1:8000/v1 fanout --input "path/to/images" --mode tag des
+## python benchmark.py encode --input "path/to/images" --formats png jpeg webp --qualities 85 90
+## python benchmark.py decode --input "path/to/photos"
+## python benchmark.py --base_url http://127.0.0.1:8000/v1 transport --input "path/to/images" --transports base64 http
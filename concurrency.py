@@ -0,0 +1,258 @@
+import itertools
+import math
+import threading
+import time
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from openai import APIStatusError, APITimeoutError, RateLimitError
+
+from vllm_client import DeadlineExceeded
+
+# 自适应并发默认参数
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+MAX_LIMIT = 64
+LATENCY_TOLERANCE = 2.0   # 延迟超过基线的倍数即视为劣化
+BACKOFF_RATIO = 0.7       # 乘性回退系数
+EWMA_ALPHA = 0.2          # 延迟平滑系数
+BASELINE_DRIFT = 0.001    # 基线每个样本向当前延迟缓慢回升的比例，避免永远锁在历史最小值
+
+# 优先级：数值越小越优先
+PRIORITY_INTERACTIVE = 0  # 单图交互请求
+PRIORITY_BATCH = 1        # 批量处理
+PRIORITY_BACKGROUND = 2   # 超大批量等后台任务
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "交互", PRIORITY_BATCH: "批量", PRIORITY_BACKGROUND: "后台"}
+# 各优先级在有其他优先级排队时最多占用的并发比例（无人竞争时可用满）
+PRIORITY_SHARES = {PRIORITY_INTERACTIVE: 1.0, PRIORITY_BATCH: 0.8, PRIORITY_BACKGROUND: 0.5}
+INTERACTIVE_RESERVE = 2   # 交互请求可超出并发上限的名额，不必等批量请求完成
+AGING_INTERVAL = 10.0     # 排队每满这么多秒优先级提升一级，保证低优先级不会饿死
+WAIT_POLL = 0.5           # 排队时重新评估老化的间隔（秒）
+BACKGROUND_BATCH_SIZE = 500  # 超过此张数的批量任务按后台优先级运行，不挤占小批量任务
+
+
+def is_overload_error(exc: BaseException) -> bool:
+    """判断异常是否表示服务端过载（429/503/超时）"""
+    if isinstance(exc, (RateLimitError, APITimeoutError, DeadlineExceeded)):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code == 503
+
+
+def batch_priority(total_images: int) -> int:
+    """批量任务的优先级：超大批量降为后台"""
+    return PRIORITY_BACKGROUND if total_images > BACKGROUND_BATCH_SIZE else PRIORITY_BATCH
+
+
+class _Ticket:
+    __slots__ = ("priority", "enqueued", "seq")
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.seq = seq
+
+    def rank(self, now: float) -> Tuple[int, int]:
+        """排序键：老化后的优先级，其次先来先服务"""
+        aged = self.priority - int((now - self.enqueued) / AGING_INTERVAL)
+        return max(PRIORITY_INTERACTIVE, aged), self.seq
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 自适应并发限制器，兼做按优先级排队的调度器
+
+    每完成一轮（约等于当前上限个请求）且延迟平稳时上限加一；
+    平滑后的延迟或首 token 时间超过基线的 LATENCY_TOLERANCE 倍，或出现 429/503，
+    则上限乘以 BACKOFF_RATIO，并在随后一轮内不再重复回退。
+    调整记录保存在 history 中，可用于观察服务端在哪个并发度开始饱和。
+
+    空出名额时按优先级（交互 > 批量 > 后台）放行排队的请求：有其他优先级在排队时，
+    每个优先级最多占用 PRIORITY_SHARES 比例的名额；交互请求另有 INTERACTIVE_RESERVE 个
+    超额名额，大批量任务跑满时单图请求也无需等待；排队越久优先级越高，低优先级不会饿死。
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = INITIAL_LIMIT,
+        min_limit: int = MIN_LIMIT,
+        max_limit: int = MAX_LIMIT,
+        latency_tolerance: float = LATENCY_TOLERANCE,
+        backoff_ratio: float = BACKOFF_RATIO,
+        history_size: int = 200,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self._limit = max(min_limit, min(initial_limit, max_limit))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._waiters: List[_Ticket] = []
+        self._seq = itertools.count()
+        self._class_in_flight: Dict[int, int] = {p: 0 for p in PRIORITY_SHARES}
+        self._class_wait: Dict[int, Tuple[int, float]] = {p: (0, 0.0) for p in PRIORITY_SHARES}
+        self._successes = 0
+        self._cooldown = 0
+        self._latency_ewma: Optional[float] = None
+        self._latency_baseline: Optional[float] = None
+        self._ttft_ewma: Optional[float] = None
+        self._ttft_baseline: Optional[float] = None
+        self._started = time.monotonic()
+        self._history: Deque[Tuple[float, int, str]] = deque(maxlen=history_size)
+        self._history.append((0.0, self._limit, "init"))
+
+    @property
+    def limit(self) -> int:
+        """当前并发上限"""
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        """当前在途请求数"""
+        return self._in_flight
+
+    @property
+    def history(self) -> List[Tuple[float, int, str]]:
+        """上限调整记录：(距创建的秒数, 新上限, 原因)"""
+        with self._cond:
+            return list(self._history)
+
+    def _eligible(self, ticket: _Ticket, waiting: set) -> bool:
+        capacity = self._limit + (INTERACTIVE_RESERVE if ticket.priority == PRIORITY_INTERACTIVE else 0)
+        if self._in_flight >= capacity:
+            return False
+        if waiting - {ticket.priority}:
+            share = math.ceil(PRIORITY_SHARES[ticket.priority] * self._limit)
+            return self._class_in_flight[ticket.priority] < max(1, share)
+        return True
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        """当前应放行的排队请求"""
+        now = time.monotonic()
+        waiting = {t.priority for t in self._waiters}
+        candidates = [t for t in self._waiters if self._eligible(t, waiting)]
+        return min(candidates, key=lambda t: t.rank(now)) if candidates else None
+
+    def acquire(self, priority: int = PRIORITY_BATCH) -> None:
+        """按优先级排队，阻塞直到获得并发名额"""
+        with self._cond:
+            ticket = _Ticket(priority, next(self._seq))
+            self._waiters.append(ticket)
+            try:
+                while self._next_ticket() is not ticket:
+                    self._cond.wait(WAIT_POLL)
+            finally:
+                self._waiters.remove(ticket)
+            self._in_flight += 1
+            self._class_in_flight[priority] += 1
+            count, total = self._class_wait[priority]
+            self._class_wait[priority] = (count + 1, total + time.monotonic() - ticket.enqueued)
+            # 其他排队者可能因本次放行变得可放行或不可放行
+            self._cond.notify_all()
+
+    def release(self, latency: Optional[float] = None, ttft: Optional[float] = None,
+                overloaded: bool = False, priority: int = PRIORITY_BATCH) -> None:
+        """归还名额并记录本次请求的结果；latency 为 None 表示非过载失败，不计入样本"""
+        with self._cond:
+            self._in_flight -= 1
+            self._class_in_flight[priority] -= 1
+            if overloaded:
+                if self._cooldown > 0:
+                    self._cooldown -= 1
+                else:
+                    self._decrease("overload")
+            elif latency is not None:
+                self._observe(latency, ttft)
+            self._cond.notify_all()
+
+    def run(self, fn: Callable, *args, priority: int = PRIORITY_BATCH, **kwargs):
+        """按优先级在并发名额内执行 fn，并根据耗时和异常类型调整上限"""
+        self.acquire(priority)
+        start = time.monotonic()
+        latency = None
+        overloaded = False
+        try:
+            result = fn(*args, **kwargs)
+            latency = time.monotonic() - start
+            return result
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            self.release(latency, overloaded=overloaded, priority=priority)
+
+    def _observe(self, latency: float, ttft: Optional[float]) -> None:
+        self._latency_ewma, self._latency_baseline = self._update(
+            latency, self._latency_ewma, self._latency_baseline)
+        degraded = self._latency_ewma > self._latency_baseline * self.latency_tolerance
+        if ttft is not None:
+            self._ttft_ewma, self._ttft_baseline = self._update(
+                ttft, self._ttft_ewma, self._ttft_baseline)
+            degraded = degraded or self._ttft_ewma > self._ttft_baseline * self.latency_tolerance
+
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return
+        if degraded:
+            self._decrease("latency")
+            return
+
+        # 加性增长：每完成一轮请求上限加一
+        self._successes += 1
+        if self._successes >= self._limit and self._limit < self.max_limit:
+            self._set_limit(self._limit + 1, "grow")
+
+    @staticmethod
+    def _update(sample: float, ewma: Optional[float], baseline: Optional[float]) -> Tuple[float, float]:
+        ewma = sample if ewma is None else ewma + EWMA_ALPHA * (sample - ewma)
+        if baseline is None or ewma < baseline:
+            baseline = ewma
+        else:
+            baseline += BASELINE_DRIFT * (ewma - baseline)
+        return ewma, baseline
+
+    def _decrease(self, reason: str) -> None:
+        new_limit = max(self.min_limit, int(self._limit * self.backoff_ratio))
+        # 回退后的一轮内，在途请求仍是旧上限下发出的，其样本不再触发回退
+        self._cooldown = self._limit
+        self._set_limit(new_limit, reason)
+
+    def _set_limit(self, new_limit: int, reason: str) -> None:
+        self._successes = 0
+        if new_limit == self._limit:
+            return
+        logging.info(f"并发上限调整: {self._limit} -> {new_limit} ({reason})")
+        self._limit = new_limit
+        self._history.append((time.monotonic() - self._started, new_limit, reason))
+
+    def format_waits(self) -> str:
+        """各优先级的平均排队时间"""
+        with self._cond:
+            waits = dict(self._class_wait)
+        parts = [
+            f"{PRIORITY_NAMES[p]} {total / count:.1f}s"
+            for p, (count, total) in sorted(waits.items()) if count
+        ]
+        return " / ".join(parts)
+
+    def format_history(self, max_items: int = 12) -> str:
+        """以可读形式输出最近的上限调整记录"""
+        labels = {"init": "", "grow": "", "latency": "(延迟劣化)", "overload": "(过载)"}
+        items = self.history[-max_items:]
+        return " → ".join(f"{limit}{labels.get(reason, '')}" for _, limit, reason in items)
+
+
+# 按端点共享的限制器，多个批处理任务共享同一端点的并发上限
+_limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(base_url: str) -> AdaptiveConcurrencyLimiter:
+    """获取端点对应的自适应并发限制器"""
+    key = base_url.rstrip("/")
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter()
+            _limiters[key] = limiter
+        return limiter
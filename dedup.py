@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+from concurrent.futures import Executor
+from itertools import repeat
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_preprocess import DEFAULT_MAX_PIXELS, ImagePreprocessor, content_hash, flatten
+
+# 去重模式：off 不去重；exact 只合并内容完全相同的文件；near 另按感知哈希合并重新编码、缩放过的同一张图
+DEDUP_OFF = "off"
+DEDUP_EXACT = "exact"
+DEDUP_NEAR = "near"
+DEDUP_MODES = (DEDUP_OFF, DEDUP_EXACT, DEDUP_NEAR)
+# 默认不去重：未固定 seed 时重复上传的图片原本各自得到独立的采样结果，合并为同一条描述需要用户显式开启
+DEFAULT_DEDUP = DEDUP_OFF
+# 近似重复的汉明距离上限（64 位 pHash 和 dHash 都不超过该值才算重复）；
+# 同一张图重新编码或缩放后通常在 0~4 之间，上限越大误合并的风险越高，分段索引也越慢
+DEFAULT_DEDUP_DISTANCE = 4
+MAX_DEDUP_DISTANCE = 10
+# 环境变量：Web 界面批量处理的去重模式和近似重复的距离上限
+DEDUP_ENV = "JOYCAPTION_DEDUP"
+DEDUP_DISTANCE_ENV = "JOYCAPTION_DEDUP_DISTANCE"
+# pHash 在 32×32 灰度图上做二维 DCT，取左上角 8×8 低频系数；dHash 比较 9×8 灰度图相邻像素
+PHASH_SIZE = 32
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """正交 DCT-II 变换矩阵，二维 DCT 即 D @ X @ D.T"""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def perceptual_hashes(image_path: str, max_pixels: int = DEFAULT_MAX_PIXELS) -> Tuple[int, int]:
+    """图片的 64 位 (pHash, dHash)
+
+    按 EXIF 摆正、去透明通道后再计算，与发给模型的图片一致；解码时以 PHASH_SIZE 为预缩放边长，
+    JPEG 通过 draft() 以 1/8 尺寸解码，超大图片同样受像素预算约束。
+    """
+    decoder = ImagePreprocessor(vision_size=PHASH_SIZE, max_pixels=max_pixels)
+    image, _ = decoder.decode(image_path)
+    with image:
+        gray = flatten(decoder.resize(image)).convert("L")
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float32)
+    gradient = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # 直流分量只反映整体亮度，不参与中位数
+    phash = _pack(low > np.median(low.ravel()[1:]))
+    dhash = _pack(gradient[:, 1:] > gradient[:, :-1])
+    return phash, dhash
+
+
+def image_signature(image_path: str, near: bool = False,
+                    max_pixels: int = DEFAULT_MAX_PIXELS) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """去重用的签名 (内容哈希, (pHash, dHash) 或 None)；near=False 或图片无法解码时不计算感知哈希
+    （无法解码的图片照常进入预处理，由预处理报告错误）。可在预处理进程中调用"""
+    digest = content_hash(image_path)
+    if not near:
+        return digest, None
+    try:
+        return digest, perceptual_hashes(image_path, max_pixels)
+    except Exception as e:
+        logging.debug(f"无法计算感知哈希 {image_path}: {str(e)}")
+        return digest, None
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    """逐元素统计 uint64 中 1 的个数"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class HammingIndex:
+    """64 位哈希对的汉明距离索引
+
+    把 pHash 切成 max_distance + 1 段：距离不超过 max_distance 的两个哈希至少有一段完全相同（抽屉原理），
+    因此按段分桶即可找出全部候选，再用 NumPy 对候选批量计算 pHash 和 dHash 的汉明距离，
+    不必与所有已登记的哈希逐一比较。
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max(0, min(MAX_DEDUP_DISTANCE, max_distance))
+        bands = self.max_distance + 1
+        edges = [round(HASH_BITS * i / bands) for i in range(bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+        self._phashes = np.zeros(1024, dtype=np.uint64)
+        self._dhashes = np.zeros(1024, dtype=np.uint64)
+        self.size = 0
+
+    def add(self, phash: int, dhash: int) -> int:
+        """登记一对哈希，返回其编号"""
+        if self.size == len(self._phashes):
+            self._phashes = np.resize(self._phashes, self.size * 2)
+            self._dhashes = np.resize(self._dhashes, self.size * 2)
+        index = self.size
+        self._phashes[index] = phash
+        self._dhashes[index] = dhash
+        self.size += 1
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault((phash >> shift) & mask, []).append(index)
+        return index
+
+    def query(self, phash: int, dhash: int) -> Optional[int]:
+        """查找 pHash 和 dHash 距离都不超过上限的已登记哈希，返回距离最近的编号，没有时返回 None"""
+        candidates = set()
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            candidates.update(buckets.get((phash >> shift) & mask, ()))
+        if not candidates:
+            return None
+        ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        pdist = _popcount(self._phashes[ids] ^ np.uint64(phash))
+        ddist = _popcount(self._dhashes[ids] ^ np.uint64(dhash))
+        matched = (pdist <= self.max_distance) & (ddist <= self.max_distance)
+        if not matched.any():
+            return None
+        total = np.where(matched, pdist.astype(np.int64) + ddist, np.iinfo(np.int64).max)
+        return int(ids[np.argmin(total)])
+
+
+class DuplicateIndex:
+    """批量任务中的重复图片索引：每组重复图片只有第一张（代表）发请求，其余复用代表的描述
+
+    内容哈希相同即完全重复；传入 max_distance 时另按感知哈希查找近似重复（同一张图重新编码、缩放过的版本）。
+    近似重复的图片也按内容哈希登记，之后再出现的同一文件直接归到同一个代表。线程安全。
+    """
+
+    def __init__(self, max_distance: Optional[int] = None):
+        self.near = max_distance is not None
+        self._exact: Dict[str, str] = {}
+        self._hamming = HammingIndex(max_distance) if self.near else None
+        self._items: List[str] = []
+        self._lock = threading.Lock()
+        self.images = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.saved_requests = 0
+
+    def find(self, item: str, digest: str, hashes: Optional[Tuple[int, int]] = None) -> Optional[str]:
+        """返回 item 所属重复组的代表；item 不与任何已登记图片重复时登记为新代表并返回 None"""
+        with self._lock:
+            self.images += 1
+            representative = self._exact.get(digest)
+            if representative is not None:
+                self.exact_duplicates += 1
+                return representative
+            if hashes is not None and self._hamming is not None:
+                index = self._hamming.query(*hashes)
+                if index is not None:
+                    self.near_duplicates += 1
+                    self._exact[digest] = self._items[index]
+                    return self._items[index]
+                self._hamming.add(*hashes)
+                self._items.append(item)
+            self._exact[digest] = item
+            return None
+
+    def record_saved(self, requests: int = 1) -> None:
+        """记录因复用代表的描述而省下的请求数"""
+        with self._lock:
+            self.saved_requests += requests
+
+    def format_stats(self) -> str:
+        with self._lock:
+            representatives = self.images - self.exact_duplicates - self.near_duplicates
+            near = f"、近似重复 {self.near_duplicates} 张" if self.near else ""
+            return (f"{self.images} 张图片中完全相同 {self.exact_duplicates} 张{near}，"
+                    f"归为 {representatives} 组，节省 {self.saved_requests} 次请求")
+
+
+def create_dedup(mode: str, max_distance: int = DEFAULT_DEDUP_DISTANCE) -> Optional[DuplicateIndex]:
+    """按去重模式创建索引，off 返回 None"""
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"不支持的去重模式: {mode}，可选 {', '.join(DEDUP_MODES)}")
+    if mode == DEDUP_OFF:
+        return None
+    return DuplicateIndex(max_distance if mode == DEDUP_NEAR else None)
+
+
+def batch_dedup() -> Optional[DuplicateIndex]:
+    """Web 界面批量处理使用的去重索引（每次任务新建），模式和距离上限由环境变量决定"""
+    return create_dedup(
+        os.environ.get(DEDUP_ENV, DEFAULT_DEDUP).lower(),
+        int(os.environ.get(DEDUP_DISTANCE_ENV, DEFAULT_DEDUP_DISTANCE)),
+    )
+
+
+def _try_signature(image_path: str, near: bool, max_pixels: int) -> Optional[Tuple[str, Optional[Tuple[int, int]]]]:
+    try:
+        return image_signature(image_path, near, max_pixels)
+    except OSError as e:
+        logging.warning(f"计算去重签名失败 {image_path}: {str(e)}")
+        return None
+
+
+def group_duplicates(index: DuplicateIndex, sources: Sequence, executor: Executor,
+                     max_pixels: int = DEFAULT_MAX_PIXELS) -> Dict[str, str]:
+    """在 executor（线程池或预处理进程池）中并行计算所有图片文件的签名，按原顺序登记到索引，
+    返回 {重复图片: 代表}；非文件来源（已解码的图片）和读取失败的文件不参与去重"""
+    paths = [source for source in sources if isinstance(source, str)]
+    signatures = executor.map(_try_signature, paths, repeat(index.near), repeat(max_pixels), chunksize=8)
+    duplicates = {}
+    for path, result in zip(paths, signatures):
+        if result is None:
+            continue
+        representative = index.find(path, *result)
+        if representative is not None:
+            duplicates[path] = representative
+    return duplicates
@@ -0,0 +1,275 @@
+import asyncio
+import os
+import threading
+import time
+import logging
+from typing import AsyncIterator, Iterator, Optional
+
+from concurrency import get_limiter, is_overload_error, PRIORITY_BATCH
+from endpoint_router import get_router
+from hedging import HedgePolicy
+from retry_policy import RetryPolicy, CircuitBreaker, DEFAULT_RETRY_POLICY, get_breaker
+from vllm_client import (
+    get_client, get_async_client, create_chat_completion, acreate_chat_completion,
+    collect_chat_stream, check_deadline, request_timeout, RequestCancelled, StreamProgress,
+)
+
+STREAM_OPTIONS = {"include_usage": True}
+# Web 界面批量处理每次请求的时限（秒），从请求真正发出时起算，排队时间不计入；可用环境变量调整
+DEFAULT_BATCH_TIMEOUT = 120.0
+REQUEST_TIMEOUT_ENV = "JOYCAPTION_REQUEST_TIMEOUT"
+
+
+def _request(client, params: dict, cancel_event: Optional[threading.Event],
+             start_event: Optional[threading.Event], timeout: Optional[float] = None):
+    """发送请求；可取消的请求走流式接口，取消时断开连接让 vLLM 中止生成。
+    timeout 为本次请求的时限（秒），从真正发出时起算，由 HTTP 层执行，超时后连接关闭"""
+    if start_event is not None:
+        start_event.set()
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+        params = dict(params, timeout=request_timeout(deadline))
+    if cancel_event is None:
+        return create_chat_completion(client, **params)
+    if cancel_event.is_set():
+        raise RequestCancelled()
+    stream = create_chat_completion(client, stream=True, stream_options=STREAM_OPTIONS, **params)
+    return collect_chat_stream(stream, cancel_event, deadline)
+
+
+def _dispatch_once(base_url: str, api_key: str, adaptive: bool, params: dict, priority: int = PRIORITY_BATCH,
+                   timeout: Optional[float] = None, cancel_event: Optional[threading.Event] = None,
+                   start_event: Optional[threading.Event] = None, hedged: bool = False):
+    """单次尝试：选端点 → 等待熔断恢复 → （自适应并发名额内按优先级排队）发送请求
+
+    cancel_event/start_event/hedged 由对冲策略传入：取消请求、标记请求真正发出的时刻、
+    对冲副本不占用自适应并发名额（其数量已由对冲预算限制）。
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelled()
+    router = get_router(base_url, api_key)
+    endpoint = router.acquire()
+    breaker = get_breaker(endpoint.base_url)
+    try:
+        breaker.wait()
+        client = get_client(api_key, endpoint.base_url)
+        if adaptive and not hedged:
+            response = get_limiter(endpoint.base_url).run(
+                _request, client, params, cancel_event, start_event, timeout, priority=priority)
+        else:
+            response = _request(client, params, cancel_event, start_event, timeout)
+    except RequestCancelled:
+        breaker.cancel()
+        router.release(endpoint, cancelled=True)
+        raise
+    except Exception as e:
+        breaker.record(e)
+        router.release(endpoint, e)
+        raise
+    breaker.record()
+    router.release(endpoint)
+    return response
+
+
+def dispatch_chat_completion(base_url: str, api_key: str, adaptive: bool = False,
+                             retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+                             hedge: Optional[HedgePolicy] = None, priority: int = PRIORITY_BATCH,
+                             timeout: Optional[float] = None, **params):
+    """按端点路由发起 chat completion，失败按重试策略重试（每次重试重新选端点）；
+    adaptive=True 时在该端点的自适应并发名额内按 priority 排队执行，传入 hedge 时对慢请求发出对冲副本。
+    timeout 为每次尝试的时限（秒，排队时间不计入），超时的请求断开连接后按可重试错误处理"""
+    if hedge is None:
+        return retry_policy.call(_dispatch_once, base_url, api_key, adaptive, params, priority, timeout)
+    return hedge.call(retry_policy.call, _dispatch_once, base_url, api_key, adaptive, params, priority, timeout)
+
+
+async def _adispatch_once(base_url: str, api_key: str, params: dict):
+    router = get_router(base_url, api_key)
+    endpoint = router.acquire()
+    breaker = get_breaker(endpoint.base_url)
+    try:
+        await breaker.await_ready()
+        client = get_async_client(api_key, endpoint.base_url)
+        response = await acreate_chat_completion(client, **params)
+    except asyncio.CancelledError:
+        # 对冲中落后的一方被取消，连接随之关闭
+        breaker.cancel()
+        router.release(endpoint, cancelled=True)
+        raise
+    except Exception as e:
+        breaker.record(e)
+        router.release(endpoint, e)
+        raise
+    breaker.record()
+    router.release(endpoint)
+    return response
+
+
+async def adispatch_chat_completion(base_url: str, api_key: str,
+                                    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+                                    hedge: Optional[HedgePolicy] = None, **params):
+    """dispatch_chat_completion 的异步版本（并发由调用方控制）"""
+    if hedge is None:
+        return await retry_policy.acall(_adispatch_once, base_url, api_key, params)
+    return await hedge.acall(retry_policy.acall, _adispatch_once, base_url, api_key, params)
+
+
+def _stream_once(base_url: str, api_key: str, params: dict, progress: StreamProgress,
+                 priority: Optional[int], prefer_endpoint: Optional[str] = None,
+                 timeout: Optional[float] = None) -> Iterator[StreamProgress]:
+    router = get_router(base_url, api_key)
+    endpoint = router.acquire(prefer_endpoint)
+    progress.endpoint = endpoint.base_url
+    breaker = get_breaker(endpoint.base_url)
+    limiter = get_limiter(endpoint.base_url) if priority is not None else None
+    acquired = False
+    stream = None
+    try:
+        breaker.wait()
+        if limiter is not None:
+            limiter.acquire(priority)
+            acquired = True
+        progress.sent_at = time.monotonic()
+        deadline = None
+        if timeout is not None:
+            deadline = progress.sent_at + timeout
+            params = dict(params, timeout=request_timeout(deadline))
+        client = get_client(api_key, endpoint.base_url)
+        stream = create_chat_completion(client, stream=True, stream_options=STREAM_OPTIONS, **params)
+        for chunk in stream:
+            check_deadline(deadline)
+            progress.update(chunk)
+            yield progress
+        progress.finish()
+    except GeneratorExit:
+        # 调用方提前停止读取（如界面上中断），连接关闭后 vLLM 中止生成
+        breaker.cancel()
+        router.release(endpoint, cancelled=True)
+        if acquired:
+            limiter.release(priority=priority)
+        raise
+    except Exception as e:
+        breaker.record(e)
+        router.release(endpoint, e)
+        if acquired:
+            limiter.release(overloaded=is_overload_error(e), priority=priority)
+        raise
+    finally:
+        if stream is not None:
+            stream.close()
+    breaker.record()
+    router.release(endpoint)
+    if acquired:
+        # 自适应并发的样本不含排队时间
+        limiter.release(progress.end - progress.sent_at, progress.server_ttft, priority=priority)
+
+
+def stream_chat_completion(base_url: str, api_key: str,
+                           retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY, priority: Optional[int] = None,
+                           prefer_endpoint: Optional[str] = None, timeout: Optional[float] = None,
+                           **params) -> Iterator[StreamProgress]:
+    """流式发起 chat completion，每收到一个数据块产出一次 StreamProgress
+
+    只有在首个 token 之前失败才按重试策略重试，已经输出内容后失败直接抛出，避免重复输出。
+    传入 priority 时在端点的并发名额内按优先级排队，首 token 时间同时用于自适应并发调整；
+    prefer_endpoint 指定优先使用的端点（该端点健康时）；timeout 为每次尝试从发出到读完的总时限（秒），
+    超时后断开连接，vLLM 随之中止生成。
+    """
+    attempt = 0
+    while True:
+        progress = StreamProgress()
+        try:
+            yield from _stream_once(base_url, api_key, params, progress, priority, prefer_endpoint, timeout)
+            return
+        except Exception as e:
+            if progress.first_token_at is not None or not retry_policy.should_retry(attempt, e):
+                raise
+            delay = retry_policy.delay(attempt, e)
+            logging.warning(f"流式请求失败，{delay:.2f} 秒后重试 ({attempt + 1}/{retry_policy.max_retries}): {str(e)}")
+            time.sleep(delay)
+            attempt += 1
+
+
+async def _astream_once(base_url: str, api_key: str, params: dict, progress: StreamProgress,
+                        prefer_endpoint: Optional[str] = None) -> AsyncIterator[StreamProgress]:
+    router = get_router(base_url, api_key)
+    endpoint = router.acquire(prefer_endpoint)
+    progress.endpoint = endpoint.base_url
+    breaker = get_breaker(endpoint.base_url)
+    stream = None
+    try:
+        await breaker.await_ready()
+        progress.sent_at = time.monotonic()
+        client = get_async_client(api_key, endpoint.base_url)
+        stream = await acreate_chat_completion(client, stream=True, stream_options=STREAM_OPTIONS, **params)
+        async for chunk in stream:
+            progress.update(chunk)
+            yield progress
+        progress.finish()
+    except (asyncio.CancelledError, GeneratorExit):
+        breaker.cancel()
+        router.release(endpoint, cancelled=True)
+        raise
+    except Exception as e:
+        breaker.record(e)
+        router.release(endpoint, e)
+        raise
+    finally:
+        if stream is not None:
+            await stream.close()
+    breaker.record()
+    router.release(endpoint)
+
+
+async def astream_chat_completion(base_url: str, api_key: str,
+                                  retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+                                  prefer_endpoint: Optional[str] = None, **params) -> AsyncIterator[StreamProgress]:
+    """stream_chat_completion 的异步版本"""
+    attempt = 0
+    while True:
+        progress = StreamProgress()
+        # 显式关闭内层生成器，调用方中途停止读取时连接能立即释放
+        stream = _astream_once(base_url, api_key, params, progress, prefer_endpoint)
+        try:
+            async for progress in stream:
+                yield progress
+            return
+        except Exception as e:
+            if progress.first_token_at is not None or not retry_policy.should_retry(attempt, e):
+                raise
+            delay = retry_policy.delay(attempt, e)
+            logging.warning(f"流式请求失败，{delay:.2f} 秒后重试 ({attempt + 1}/{retry_policy.max_retries}): {str(e)}")
+        finally:
+            await stream.aclose()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def batch_request_timeout() -> float:
+    """Web 界面批量处理的单次请求时限（秒）"""
+    return float(os.environ.get(REQUEST_TIMEOUT_ENV, DEFAULT_BATCH_TIMEOUT))
+
+
+def max_in_flight(base_url: str, api_key: str) -> int:
+    """所有端点自适应并发上限之和，用于确定线程池大小"""
+    router = get_router(base_url, api_key)
+    return sum(get_limiter(ep.base_url).max_limit for ep in router.endpoints)
+
+
+def format_endpoint_status(base_url: str, api_key: str) -> str:
+    """以 Markdown 列表输出各端点的路由与并发状态"""
+    router = get_router(base_url, api_key)
+    lines = []
+    for status in router.status():
+        limiter = get_limiter(status['base_url'])
+        state = "✅" if status['healthy'] else "⛔ 已摘除"
+        waits = limiter.format_waits()
+        if get_breaker(status['base_url']).state != CircuitBreaker.CLOSED:
+            state += " 🔌 熔断中"
+        lines.append(
+            f"- `{status['base_url']}` {state}: 完成 {status['completed']} / 失败 {status['failed']}，"
+            f"并发上限 {limiter.limit}（{limiter.format_history()}）"
+            + (f"，平均排队 {waits}" if waits else "")
+        )
+    return "\n".join(lines)
@@ -0,0 +1,194 @@
+import random
+import re
+import threading
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from vllm_client import DeadlineExceeded, get_client
+
+# 路由默认参数
+FAILURE_THRESHOLD = 3      # 连续失败多少次后摘除端点
+HEALTH_CHECK_INTERVAL = 10.0
+HEALTH_CHECK_TIMEOUT = 5.0
+
+
+def parse_endpoints(text: str) -> List[str]:
+    """解析端点列表，支持逗号、分号、空白或换行分隔"""
+    endpoints = []
+    for url in re.split(r"[\s,;]+", text or ""):
+        url = url.strip().rstrip("/")
+        if url and url not in endpoints:
+            endpoints.append(url)
+    return endpoints
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """判断异常是否说明端点本身不可用（连接失败或 5xx），4xx 属于请求问题不计入。
+    超时（APITimeoutError 是 APIConnectionError 的子类）和超过截止时间说明端点繁忙而不是不可用，
+    只由自适应并发限制按过载处理，不计入摘除和熔断"""
+    if isinstance(exc, (APITimeoutError, DeadlineExceeded)):
+        return False
+    if isinstance(exc, APIConnectionError):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code >= 500
+
+
+class Endpoint:
+    """单个 vLLM 端点的路由状态"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_at: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.base_url!r}, outstanding={self.outstanding}, healthy={self.healthy})"
+
+
+class EndpointRouter:
+    """客户端多端点路由
+
+    strategy="p2c" 时随机取两个健康端点，选在途请求较少的一个；
+    strategy="least" 时直接选在途请求最少的端点。
+    连续失败 FAILURE_THRESHOLD 次的端点被摘除，后台健康检查通过后重新加入。
+    所有端点都被摘除时仍会选出一个，避免整批任务直接失败。
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        api_key: str,
+        strategy: str = "p2c",
+        failure_threshold: int = FAILURE_THRESHOLD,
+        health_check_interval: float = HEALTH_CHECK_INTERVAL,
+    ):
+        if not base_urls:
+            raise ValueError("至少需要一个端点")
+        if strategy not in ("p2c", "least"):
+            raise ValueError(f"未知的路由策略: {strategy}")
+        self.api_key = api_key
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.health_check_interval = health_check_interval
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+
+    def _pick(self) -> Endpoint:
+        candidates = [ep for ep in self.endpoints if ep.healthy] or self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == "p2c":
+            a, b = random.sample(candidates, 2)
+            return a if a.outstanding <= b.outstanding else b
+        return min(candidates, key=lambda ep: (ep.outstanding, random.random()))
+
+    def acquire(self, prefer: Optional[str] = None) -> Endpoint:
+        """选出一个端点并登记一个在途请求；prefer 指定的端点健康时优先使用（用于复用该端点上的前缀缓存）"""
+        with self._lock:
+            endpoint = next((ep for ep in self.endpoints if ep.base_url == prefer and ep.healthy), None) \
+                if prefer else None
+            endpoint = endpoint or self._pick()
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, error: Optional[BaseException] = None,
+                cancelled: bool = False) -> None:
+        """归还在途请求并记录结果，端点级故障累计到阈值后摘除；主动取消的请求不计入成败"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if cancelled:
+                return
+            if error is None:
+                endpoint.completed += 1
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.failed += 1
+            if not is_endpoint_failure(error):
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.healthy and endpoint.consecutive_failures >= self.failure_threshold:
+                self._eject(endpoint, str(error))
+
+    def _eject(self, endpoint: Endpoint, reason: str) -> None:
+        endpoint.healthy = False
+        endpoint.ejected_at = time.monotonic()
+        logging.warning(f"摘除端点 {endpoint.base_url}: {reason}")
+
+    def _probe(self, endpoint: Endpoint) -> Tuple[bool, str]:
+        try:
+            client = get_client(self.api_key, endpoint.base_url)
+            client.with_options(timeout=HEALTH_CHECK_TIMEOUT, max_retries=0).models.list()
+            return True, ""
+        except Exception as e:
+            return False, str(e)
+
+    def check_health(self) -> None:
+        """探测所有端点：失败的摘除，恢复的重新加入"""
+        for endpoint in self.endpoints:
+            ok, reason = self._probe(endpoint)
+            with self._lock:
+                if ok and not endpoint.healthy:
+                    endpoint.healthy = True
+                    endpoint.ejected_at = None
+                    endpoint.consecutive_failures = 0
+                    logging.info(f"端点恢复: {endpoint.base_url}")
+                elif not ok and endpoint.healthy:
+                    self._eject(endpoint, reason)
+
+    def _health_loop(self) -> None:
+        while not self._stop.wait(self.health_check_interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                logging.error(f"健康检查出错: {str(e)}")
+
+    def start_health_checks(self) -> None:
+        """启动后台健康检查线程（单端点时无需启动）"""
+        if self._health_thread is None and len(self.endpoints) > 1:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def stop(self) -> None:
+        """停止后台健康检查"""
+        self._stop.set()
+
+    def status(self) -> List[Dict]:
+        """各端点的当前状态"""
+        with self._lock:
+            return [
+                {
+                    'base_url': ep.base_url,
+                    'healthy': ep.healthy,
+                    'outstanding': ep.outstanding,
+                    'completed': ep.completed,
+                    'failed': ep.failed,
+                }
+                for ep in self.endpoints
+            ]
+
+
+# 按 (端点列表, api_key) 共享的路由器
+_routers: Dict[Tuple[Tuple[str, ...], str], EndpointRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(base_url: str, api_key: str) -> EndpointRouter:
+    """获取端点列表对应的共享路由器，base_url 可以是多个地址组成的列表文本"""
+    endpoints = parse_endpoints(base_url)
+    key = (tuple(endpoints), api_key)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = EndpointRouter(endpoints, api_key)
+            router.start_health_checks()
+            _routers[key] = router
+        return router
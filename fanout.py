@@ -0,0 +1,223 @@
+import asyncio
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from concurrency import PRIORITY_BATCH
+from dispatch import stream_chat_completion, astream_chat_completion
+from retry_policy import RetryPolicy, DEFAULT_RETRY_POLICY
+from vllm_client import StreamProgress
+
+SYSTEM_PROMPT = 'You are a helpful image captioner.'
+
+
+def image_first_messages(image_data: str, prompt: str) -> List[Dict]:
+    """图片在前、提示词在后的消息列表
+
+    同一张图片的多个提示词共享 system + 图片这段前缀，vLLM 开启 --enable-prefix-caching 时
+    只需为第一个请求计算图片部分的 prefill，后续请求直接复用缓存的 KV 块。
+    """
+    return [
+        {
+            'role': 'system',
+            'content': SYSTEM_PROMPT,
+        },
+        {
+            'role': 'user',
+            'content': [
+                {'type': 'image_url', 'image_url': {'url': image_data}},
+                {'type': 'text', 'text': prompt},
+            ],
+        }
+    ]
+
+
+def fanout_filename(base_name: str, key: str) -> str:
+    """扇出模式下某个提示词的输出文件名前缀：name_key（变体后缀由 caption_filename 追加）"""
+    return f"{base_name}_{key}"
+
+
+class FanoutStats:
+    """扇出统计：预热请求与命中缓存请求的首 token 时间、前缀缓存命中的提示词 token
+
+    每张图片的第一个请求（预热）需要完整 prefill 图片，其余请求命中缓存后只需 prefill 提示词。
+    逐个提示词分开跑时每个请求都要重新 prefill 图片，因此用预热请求的首 token 时间代替
+    其余请求的首 token 时间，估计分开跑的总请求耗时，得到加速比。
+    """
+
+    def __init__(self):
+        self.images = 0
+        self.cold_ttfts: List[float] = []
+        self.warm_ttfts: List[float] = []
+        self.request_time = 0.0       # 所有请求从发出到完成的耗时之和
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.cache_reported = False   # 服务端是否返回了 cached_tokens
+        self._lock = threading.Lock()
+
+    def record(self, progress: StreamProgress, primer: bool) -> None:
+        with self._lock:
+            if progress.server_ttft is not None:
+                (self.cold_ttfts if primer else self.warm_ttfts).append(progress.server_ttft)
+            if progress.end is not None:
+                self.request_time += progress.end - (progress.sent_at or progress.start)
+            if progress.prompt_tokens is not None:
+                self.prompt_tokens += progress.prompt_tokens
+            if progress.cached_tokens is not None:
+                self.cached_tokens += progress.cached_tokens
+                self.cache_reported = True
+
+    def record_image(self) -> None:
+        with self._lock:
+            self.images += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            result = {
+                'images': self.images,
+                'requests': len(self.cold_ttfts) + len(self.warm_ttfts),
+                'cold_ttft': statistics.median(self.cold_ttfts) if self.cold_ttfts else None,
+                'warm_ttft': statistics.median(self.warm_ttfts) if self.warm_ttfts else None,
+                'cache_hit': self.cached_tokens / self.prompt_tokens
+                if self.cache_reported and self.prompt_tokens else None,
+                'speedup': None,
+            }
+            if self.cold_ttfts and self.warm_ttfts and self.request_time > 0:
+                # 分开跑时每个命中缓存的请求都要多付出 (冷 - 热) 的 prefill 时间
+                saved = sum(max(0.0, statistics.mean(self.cold_ttfts) - t) for t in self.warm_ttfts)
+                result['saved'] = saved
+                result['speedup'] = (self.request_time + saved) / self.request_time
+        return result
+
+    def format_report(self) -> str:
+        """以 Markdown 列表输出扇出统计"""
+        r = self.report()
+        if not r['requests']:
+            return "- 无请求"
+        lines = [f"- **扇出请求**: {r['images']} 张图片，共 {r['requests']} 个请求"]
+        if r['cold_ttft'] is not None and r['warm_ttft'] is not None:
+            lines.append(
+                f"- **首 token 中位数**: 预热 {r['cold_ttft']:.2f} 秒 → 命中缓存 {r['warm_ttft']:.2f} 秒"
+            )
+        if r['cache_hit'] is not None:
+            lines.append(f"- **前缀缓存命中**: {r['cache_hit'] * 100:.1f}% 的提示词 token")
+        else:
+            lines.append("- **前缀缓存命中**: 服务端未返回 cached_tokens（需 vLLM --enable-prompt-tokens-details）")
+        if r['speedup'] is not None:
+            lines.append(
+                f"- **相比逐个提示词分开跑**: 节省 prefill 约 {r['saved']:.1f} 秒，请求耗时加速约 {r['speedup']:.2f}×"
+                f"（估计值，实测可用 benchmark.py fanout）"
+            )
+        return "\n".join(lines)
+
+
+def fanout_captions(
+    base_url: str,
+    api_key: str,
+    image_data: str,
+    prompts: Dict[str, str],
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    priority: int = PRIORITY_BATCH,
+    stats: Optional[FanoutStats] = None,
+    **params,
+) -> Dict[str, List[str]]:
+    """同一张图片按多个提示词生成描述，返回 {提示词名: [变体...]}
+
+    先流式发出第一个提示词作为预热请求，收到首个 token（图片 prefill 已完成并写入前缀缓存）后
+    立即把其余提示词一起发往同一端点，使它们命中缓存；params 为 temperature/top_p/max_tokens/n 等采样参数。
+    """
+    names = list(prompts)
+
+    def run(name: str, prefer_endpoint: Optional[str], on_first_token=None) -> StreamProgress:
+        progress = None
+        for progress in stream_chat_completion(
+            base_url, api_key, retry_policy=retry_policy, priority=priority, prefer_endpoint=prefer_endpoint,
+            messages=image_first_messages(image_data, prompts[name]), **params
+        ):
+            if on_first_token is not None and progress.first_token_at is not None:
+                on_first_token(progress)
+                on_first_token = None
+        if progress is None:
+            # 流没有返回任何内容（连接立即关闭等）：没有可复用的端点，也没有结果，不再发出其余提示词
+            raise RuntimeError(f"提示词 {name} 的流式请求没有返回任何内容")
+        if on_first_token is not None:
+            on_first_token(progress)
+        if stats is not None:
+            stats.record(progress, primer=name == names[0])
+        return progress
+
+    with ThreadPoolExecutor(max_workers=max(1, len(names) - 1)) as executor:
+        futures = {}
+
+        def launch(primer: StreamProgress) -> None:
+            for name in names[1:]:
+                futures[name] = executor.submit(run, name, primer.endpoint)
+
+        results = {names[0]: run(names[0], None, launch)}
+        for name, future in futures.items():
+            results[name] = future.result()
+
+    if stats is not None:
+        stats.record_image()
+    return {name: [text.strip() for text in results[name].variants] for name in names}
+
+
+async def afanout_captions(
+    base_url: str,
+    api_key: str,
+    image_data: str,
+    prompts: Dict[str, str],
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    stats: Optional[FanoutStats] = None,
+    **params,
+) -> Dict[str, List[str]]:
+    """fanout_captions 的异步版本；每个请求各自占用 semaphore 的一个名额，
+    预热请求完成后即归还，不会因等待其余请求而占住名额"""
+    names = list(prompts)
+
+    def stream(name: str, prefer_endpoint: Optional[str]):
+        return astream_chat_completion(
+            base_url, api_key, retry_policy=retry_policy, prefer_endpoint=prefer_endpoint,
+            messages=image_first_messages(image_data, prompts[name]), **params
+        )
+
+    async def run(name: str, prefer_endpoint: Optional[str], on_first_token=None) -> StreamProgress:
+        progress = None
+        async for progress in stream(name, prefer_endpoint):
+            if on_first_token is not None and progress.first_token_at is not None:
+                on_first_token(progress)
+                on_first_token = None
+        if progress is None:
+            # 流没有返回任何内容（连接立即关闭等）：没有可复用的端点，也没有结果，不再发出其余提示词
+            raise RuntimeError(f"提示词 {name} 的流式请求没有返回任何内容")
+        if on_first_token is not None:
+            on_first_token(progress)
+        if stats is not None:
+            stats.record(progress, primer=name == names[0])
+        return progress
+
+    async def slot(name: str, prefer_endpoint: Optional[str], on_first_token=None) -> StreamProgress:
+        if semaphore is None:
+            return await run(name, prefer_endpoint, on_first_token)
+        async with semaphore:
+            return await run(name, prefer_endpoint, on_first_token)
+
+    tasks: Dict[str, asyncio.Task] = {}
+
+    def launch(primer: StreamProgress) -> None:
+        for name in names[1:]:
+            tasks[name] = asyncio.ensure_future(slot(name, primer.endpoint))
+
+    try:
+        results = {names[0]: await slot(names[0], None, launch)}
+        for name, task in tasks.items():
+            results[name] = await task
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    if stats is not None:
+        stats.record_image()
+    return {name: [text.strip() for text in results[name].variants] for name in names}
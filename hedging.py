@@ -0,0 +1,282 @@
+import asyncio
+import random
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from typing import Callable, Deque, Dict, Optional, Sequence, Tuple
+
+# 对冲默认参数
+HEDGE_PERCENTILE = 95.0
+MIN_SAMPLES = 20          # 延迟样本不足时不对冲
+WINDOW_SIZE = 200         # 触发阈值参考最近多少个请求的延迟
+REPORT_WINDOW = 10000     # 报告统计最近多少个请求的延迟和影子样本，长期运行时内存不增长
+MIN_HEDGE_DELAY = 1.0     # 触发阈值下限（秒），避免短请求被成倍复制
+MAX_HEDGE_RATIO = 0.1     # 对冲副本占请求总数的上限，控制额外负载
+SHADOW_RATIO = 0.2        # 副本获胜时，按此比例保留主请求跑完，用于估计不对冲时的延迟
+MIN_SHADOW_SAMPLES = 3    # 影子样本少于此数时每次副本获胜都保留主请求
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """最近秩法计算分位数，q 取 0~100"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _spawn(fn: Callable, *args, **kwargs) -> Future:
+    """在独立线程中执行 fn，返回 Future"""
+    future: Future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class StartSignal(threading.Event):
+    """请求真正发出时置位，记录首次发出的时间；未置位时以创建时间为准"""
+
+    def __init__(self):
+        super().__init__()
+        self.at = time.monotonic()
+
+    def set(self) -> None:
+        if not self.is_set():
+            self.at = time.monotonic()
+            super().set()
+
+    def release(self) -> None:
+        """请求未发出就已结束（例如出错）时唤醒等待方，保留创建时间"""
+        super().set()
+
+
+class HedgePolicy:
+    """尾延迟对冲
+
+    请求超过最近延迟的第 percentile 分位仍未完成时，再发一个副本（由路由器重新选择端点或并发名额），
+    取先完成的结果并取消另一个。同步调用时 fn 需接受 cancel_event 参数并在置位后尽快放弃；
+    异步调用直接取消落后的任务。
+
+    被取消的主请求真实耗时未知，因此副本获胜时按 SHADOW_RATIO 比例保留主请求跑完作为影子样本，
+    用它们估计“不对冲”时的延迟分布，从而给出 p99 的改善幅度。
+    """
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_PERCENTILE,
+        min_samples: int = MIN_SAMPLES,
+        window_size: int = WINDOW_SIZE,
+        min_delay: float = MIN_HEDGE_DELAY,
+        max_ratio: float = MAX_HEDGE_RATIO,
+        shadow_ratio: float = SHADOW_RATIO,
+    ):
+        if not 0 < percentile < 100:
+            raise ValueError("percentile 必须在 0 到 100 之间")
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.shadow_ratio = shadow_ratio
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._samples: Deque[float] = deque(maxlen=window_size)
+        # 实际端到端延迟及是否由副本获胜（此时即副本获胜时主请求已耗时）
+        self._latencies: Deque[Tuple[float, bool]] = deque(maxlen=REPORT_WINDOW)
+        self._shadow_extra: Deque[float] = deque(maxlen=REPORT_WINDOW)  # 影子主请求在副本获胜后还需要的时间
+        self._shadows: Dict[object, Callable] = {}     # 仍在运行的影子主请求 -> 取消函数
+        self._lock = threading.Lock()
+
+    def threshold(self) -> Optional[float]:
+        """当前触发对冲的等待时间，样本不足时返回 None"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            return max(self.min_delay, percentile(self._samples, self.percentile))
+
+    def _begin(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def _record(self, attempt_latency: float, total: float, hedge_won: bool) -> None:
+        with self._lock:
+            self._samples.append(attempt_latency)
+            self._latencies.append((total, hedge_won))
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def _keep_shadow(self, attempt, cancel: Callable, won_at: float, start: float) -> bool:
+        """决定是否保留落后的主请求作为影子样本，保留时在其完成后记录耗时"""
+        with self._lock:
+            if len(self._shadow_extra) + len(self._shadows) >= MIN_SHADOW_SAMPLES \
+                    and random.random() >= self.shadow_ratio:
+                return False
+            self._shadows[attempt] = cancel
+
+        def on_done(f):
+            with self._lock:
+                self._shadows.pop(f, None)
+                if not f.cancelled() and f.exception() is None:
+                    self._shadow_extra.append(max(0.0, time.monotonic() - start - won_at))
+
+        attempt.add_done_callback(on_done)
+        return True
+
+    def cancel_shadows(self) -> None:
+        """取消仍在运行的影子请求（批处理结束时调用，避免占用服务端）"""
+        with self._lock:
+            cancels = list(self._shadows.values())
+            self._shadows.clear()
+        for cancel in cancels:
+            cancel()
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """同步执行 fn(*args, cancel_event=..., start_event=..., hedged=..., **kwargs)，必要时发出对冲副本
+
+        fn 在真正发出请求时置位 start_event，计时从此刻开始，排队等待并发名额的时间不计入；
+        副本以 hedged=True 调用，应直接发出而不再排队，否则慢请求的副本会排在同一批请求之后。
+        """
+        self._begin()
+        delay = self.threshold()
+        if delay is None:
+            started = StartSignal()
+            result = fn(*args, cancel_event=None, start_event=started, hedged=False, **kwargs)
+            latency = time.monotonic() - started.at
+            self._record(latency, latency, False)
+            return result
+
+        attempts = {}
+        cancel, started = threading.Event(), StartSignal()
+        primary = _spawn(fn, *args, cancel_event=cancel, start_event=started, hedged=False, **kwargs)
+        attempts[primary] = (cancel, started, False)
+        # 等到主请求真正发出（或未发出就结束）才开始计时
+        primary.add_done_callback(lambda _: started.release())
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        if not done and self._take_budget():
+            logging.info(f"请求超过 {delay:.2f} 秒未完成，发出对冲副本")
+            cancel, hedge_started = threading.Event(), StartSignal()
+            attempts[_spawn(fn, *args, cancel_event=cancel, start_event=hedge_started, hedged=True, **kwargs)] = \
+                (cancel, hedge_started, True)
+
+        pending = set(attempts)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                now = time.monotonic()
+                _, attempt_started, is_hedge = attempts[future]
+                start = started.at
+                self._record(now - attempt_started.at, now - start, is_hedge)
+                for loser in pending:
+                    loser_cancel, _, loser_is_hedge = attempts[loser]
+                    if not (is_hedge and not loser_is_hedge
+                            and self._keep_shadow(loser, loser_cancel.set, now - start, start)):
+                        loser_cancel.set()
+                return future.result()
+        raise error
+
+    async def acall(self, fn: Callable, *args, **kwargs):
+        """异步版本的 call，fn 为协程函数，落后的一方直接取消"""
+        self._begin()
+        start = time.monotonic()
+        delay = self.threshold()
+        if delay is None:
+            result = await fn(*args, **kwargs)
+            latency = time.monotonic() - start
+            self._record(latency, latency, False)
+            return result
+
+        primary = asyncio.ensure_future(fn(*args, **kwargs))
+        attempts = {primary: (start, False)}
+        pending = set(attempts)
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self._take_budget():
+                logging.info(f"请求超过 {delay:.2f} 秒未完成，发出对冲副本")
+                attempts[asyncio.ensure_future(fn(*args, **kwargs))] = (time.monotonic(), True)
+                pending = set(attempts)
+
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    now = time.monotonic()
+                    attempt_start, is_hedge = attempts[task]
+                    self._record(now - attempt_start, now - start, is_hedge)
+                    if is_hedge and primary in pending \
+                            and self._keep_shadow(primary, primary.cancel, now - start, start):
+                        pending.discard(primary)
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def report(self) -> dict:
+        """对冲统计：触发次数、副本获胜次数、实际与估计的不对冲 p50/p99"""
+        with self._lock:
+            samples = list(self._latencies)
+            shadow = list(self._shadow_extra)
+            result = {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'shadow_samples': len(shadow),
+                'threshold': None,
+            }
+        result['threshold'] = self.threshold()
+        if not samples:
+            return result
+        # 不对冲估计：副本获胜的请求用“获胜时已耗时 + 影子样本的平均剩余耗时”代替，无影子样本时为下界
+        extra = sum(shadow) / len(shadow) if shadow else 0.0
+        latencies = [total for total, _ in samples]
+        baseline = [total + extra if hedge_won else total for total, hedge_won in samples]
+        for q in (50, 99):
+            result[f'p{q}'] = percentile(latencies, q)
+            result[f'p{q}_unhedged'] = percentile(baseline, q)
+        return result
+
+    def format_report(self) -> str:
+        """以 Markdown 列表输出对冲统计"""
+        r = self.report()
+        if not r['requests']:
+            return "- 无请求"
+        lines = [
+            f"- **对冲触发**: {r['hedged']}/{r['requests']} 次（{r['hedged'] / r['requests'] * 100:.1f}%），"
+            f"副本先完成 {r['hedge_wins']} 次",
+        ]
+        if r['threshold'] is not None:
+            lines.append(f"- **触发阈值**: p{self.percentile:g} ≈ {r['threshold']:.2f} 秒")
+        else:
+            lines.append(f"- **触发阈值**: 样本不足 {self.min_samples} 个，尚未启用")
+        if 'p99' in r:
+            bound = "" if r['shadow_samples'] or not r['hedge_wins'] else "≥"
+            change = (1 - r['p99'] / r['p99_unhedged']) * 100 if r['p99_unhedged'] > 0 else 0.0
+            lines.append(
+                f"- **p99 延迟**: 不对冲估计 {bound}{r['p99_unhedged']:.2f} 秒 → 实际 {r['p99']:.2f} 秒"
+                f"（降低 {bound}{change:.1f}%，影子样本 {r['shadow_samples']} 个）"
+            )
+            lines.append(f"- **p50 延迟**: {r['p50_unhedged']:.2f} 秒 → {r['p50']:.2f} 秒")
+        return "\n".join(lines)
@@ -1,8 +1,19 @@
-import base64
 import os
 import logging
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, Iterator, Union
 from openai import OpenAI
+from vllm_client import get_client
+from async_engine import AsyncCaptionEngine, DEFAULT_CONCURRENCY
+from retry_policy import DeadLetterQueue
+from image_preprocess import (ImagePreprocessor, resolve_vision_size, FORMATS, DEFAULT_FORMAT, DEFAULT_MAX_PIXELS,
+                              DEFAULT_QUALITY)
+from pipeline import PREPROCESS_WORKERS, DEFAULT_PREFETCH
+from payload_cache import PayloadCache, DEFAULT_CACHE_MB
+from result_cache import ResultCache, DEFAULT_RESULT_CACHE_MB, POLICIES, POLICY_REUSE
+from dedup import create_dedup, DEDUP_MODES, DEFAULT_DEDUP, DEFAULT_DEDUP_DISTANCE
+from media_transport import (MediaServer, TRANSPORTS, TRANSPORT_BASE64, TRANSPORT_HTTP, create_transport,
+                             local_address_for, parse_path_map)
 
 # 配置日志记录
 logging.basicConfig(
@@ -15,11 +26,14 @@ logging.basicConfig(
 )
 
 # 定义支持的图像格式
-SUPPORTED_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif",".webp"}
+SUPPORTED_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif",".webp", ".tif", ".tiff"}
+
+# 失败列表默认文件名
+DEAD_LETTER_FILENAME = "failed_images.txt"
 
 def create_openai_client(api_key: str, base_url: str) -> OpenAI:
-    """创建 OpenAI 客户端"""
-    return OpenAI(api_key=api_key, base_url=base_url)
+    """获取共享的 OpenAI 客户端"""
+    return get_client(api_key, base_url)
 
 def generate_prompt(mode: str, custom_prompt: str = None) -> str:
     """生成提示词"""
@@ -35,86 +49,111 @@ def generate_prompt(mode: str, custom_prompt: str = None) -> str:
     else:
         raise ValueError("Invalid mode. Available modes: 'tag', 'des', 'custom'.")
 
-def process_image(
-    client: OpenAI,
-    image_path: str,
-    output_folder: str,
-    prompt: str,
-    max_retries: int = 3
-) -> bool:
-    """处理单个图像文件"""
-    try:
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        image_data = f"data:image/jpeg;base64,{base64_image}"
-        
-        model_name = client.models.list().data[0].id
-        with open(image_path, 'rb') as image_file:
-            response = client.chat.completions.create(
-                model=model_name,
-                # messages=[
-                #     {"role": "user", "content": prompt},
-                #     {"role": "assistant", "content": f"Image file: {image_file}"}
-                # ],
-                messages=[
-                    {
-                    'role':'system',
-                    'content': 'You are a helpful image captioner.',
-                    },
-                    {
-                    'role':'user',
-                    'content': [
-                        {'type': 'text','text': prompt,}, 
-                        {'type': 'image_url', 'image_url': {'url': image_data}}
-                    ],
-                }],
-                temperature=0.9,
-                top_p=0.7,
-                max_tokens=256
-            )
-            
-            caption = response.choices[0].message.content.strip()
-            base_name = os.path.splitext(os.path.basename(image_path))[0]
-            output_path = os.path.join(output_folder, f"{base_name}.txt")
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(caption)
-            
-            logging.info(f"Successfully processed: {image_path}")
-            return True
-        
-    except Exception as e:
-        logging.error(f"Error processing {image_path}: {str(e)}")
-        return False
+def iter_image_paths(input_folder: str) -> Iterator[str]:
+    """遍历文件夹，逐个产出支持格式的图像路径"""
+    for root, _, files in os.walk(input_folder):
+        for file in files:
+            ext = os.path.splitext(file)[1].lower()
+            if ext in SUPPORTED_IMAGE_EXTENSIONS:
+                yield os.path.join(root, file)
 
 def process_images(
     input_folder: str,
     output_folder: str,
-    client: OpenAI,
-    prompt: str,
-    max_retries: int = 3
+    api_key: str,
+    base_url: str,
+    prompt: Union[str, Dict[str, str]],
+    max_retries: int = 3,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    rerun_list: str = None,
+    dead_letter_path: str = None,
+    hedge_percentile: float = 0,
+    stream: bool = False,
+    variants: int = 1,
+    vision_size: int = None,
+    model_config: str = None,
+    image_format: str = DEFAULT_FORMAT,
+    quality: int = DEFAULT_QUALITY,
+    max_pixels: int = DEFAULT_MAX_PIXELS,
+    preprocess_workers: int = PREPROCESS_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    payload_cache_dir: str = None,
+    payload_cache_mb: int = DEFAULT_CACHE_MB,
+    transport: str = TRANSPORT_BASE64,
+    media_host: str = None,
+    media_port: int = 0,
+    media_path_map: str = None,
+    seed: int = None,
+    result_cache_path: str = None,
+    result_cache_mb: int = DEFAULT_RESULT_CACHE_MB,
+    result_cache_policy: str = POLICY_REUSE,
+    dedup: str = DEFAULT_DEDUP,
+    dedup_distance: int = DEFAULT_DEDUP_DISTANCE
 ) -> None:
-    """遍历文件夹处理所有图像"""
+    """遍历文件夹（或重跑失败列表），使用异步引擎并发处理所有图像，失败项写入失败列表
+
+    prompt 为 {名称: 提示词} 字典时按扇出模式为每张图片生成多种描述。
+    图片按模型视觉输入边长预缩放：vision_size 显式指定（0 表示不缩放），否则从 model_config 读取；
+    需要重新编码的图片按 image_format/quality 编码；解码时最多 max_pixels 像素，超出预算且无法缩小或分块解码的图片记为失败。
+    预处理在 preprocess_workers 个进程中进行，领先网络请求 prefetch 张图片；
+    指定 payload_cache_dir 时编码结果缓存到该目录（上限 payload_cache_mb），重跑时跳过未改变图片的预处理。
+    transport 为 file/http 时图片以 file:// 路径或内置文件服务器（media_host:media_port）的 URL 发送。
+    指定 result_cache_path 时描述结果缓存到该 SQLite 数据库（上限 result_cache_mb），按 result_cache_policy
+    复用（reuse）或重新生成（refresh）图片、提示词、模型和采样参数（含 seed）都相同的结果。
+    dedup 为 exact/near 时重复图片（near 还包括感知哈希距离不超过 dedup_distance 的近似重复）只请求一次，
+    描述以各自的文件名写出。
+    """
     output_folder=input_folder
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
         logging.info(f"Created output folder: {output_folder}")
     
-    total_processed = 0
-    total_failed = 0
+    if rerun_list:
+        image_paths = DeadLetterQueue.load(rerun_list)
+        logging.info(f"Re-running {len(image_paths)} failed images from {rerun_list}")
+    else:
+        image_paths = iter_image_paths(input_folder)
     
-    for root, _, files in os.walk(input_folder):
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in SUPPORTED_IMAGE_EXTENSIONS:
-                image_path = os.path.join(root, file)
-                success = process_image(client, image_path, output_folder, prompt, max_retries)
-                
-                if success:
-                    total_processed += 1
-                else:
-                    total_failed += 1
+    preprocessor = ImagePreprocessor(resolve_vision_size(vision_size, model_config), image_format, quality,
+                                     max_pixels=max_pixels)
+    payload_cache = PayloadCache(payload_cache_dir, payload_cache_mb) if payload_cache_dir else None
+    server = MediaServer(media_host or local_address_for(base_url), media_port) if transport == TRANSPORT_HTTP else None
+    media = create_transport(transport, base_url, server, parse_path_map(media_path_map))
+    result_cache = ResultCache(result_cache_path, result_cache_mb, result_cache_policy) if result_cache_path else None
+    duplicates = create_dedup(dedup, dedup_distance)
+    engine = AsyncCaptionEngine(api_key, base_url, prompt, concurrency=concurrency, max_retries=max_retries,
+                                hedge_percentile=hedge_percentile, stream=stream, variants=variants,
+                                preprocessor=preprocessor, preprocess_workers=preprocess_workers, prefetch=prefetch,
+                                payload_cache=payload_cache, media=media, seed=seed, result_cache=result_cache,
+                                dedup=duplicates)
+    try:
+        total_processed, total_failed = asyncio.run(engine.run(image_paths, output_folder))
+    finally:
+        if server is not None:
+            server.close()
     
+    dead_letter_path = dead_letter_path or os.path.join(output_folder, DEAD_LETTER_FILENAME)
+    if engine.dead_letters:
+        engine.dead_letters.save(dead_letter_path)
+        logging.info(f"Failed images written to {dead_letter_path}, re-run with --rerun {dead_letter_path}")
+    elif os.path.exists(dead_letter_path):
+        os.remove(dead_letter_path)
+    
+    if engine.hedge is not None:
+        logging.info("Hedging report:\n" + engine.hedge.format_report())
+    logging.info(f"Image preprocessing: {preprocessor.format_stats()}")
+    logging.info("Pipeline report:\n" + engine.pipeline_stats.format_report())
+    if payload_cache is not None:
+        logging.info(f"Payload cache: {payload_cache.format_stats()}")
+    if media is not None:
+        logging.info(f"Media transport: {media.format_stats()}")
+    if result_cache is not None:
+        logging.info(f"Result cache: {result_cache.format_stats()}")
+        result_cache.close()
+    if duplicates is not None:
+        logging.info(f"Dedup: {duplicates.format_stats()}")
+    if engine.fanout_stats is not None:
+        logging.info("Fan-out report:\n" + engine.fanout_stats.format_report())
     logging.info(f"Processing complete. Total processed: {total_processed}, Failed: {total_failed}")
 
 ip_algo='192.168.5.212'
@@ -125,24 +164,76 @@ def main() -> None:
     parser.add_argument('--input', type=str, default=r"\\192.168.1.121\\dataset\\Ghibli",required=True, help='输入图像文件夹路径')
     parser.add_argument('--output', type=str, required=False, help='输出文件夹路径')
     parser.add_argument('--api_key', type=str, required=False, default="your-api-key",help='OpenAI API 密钥')
-    parser.add_argument('--base_url', type=str, default=f'http://{ip_algo}:8000/v1', help='OpenAI API 基础 URL')
+    parser.add_argument('--base_url', type=str, default=f'http://{ip_algo}:8000/v1', help='OpenAI API 基础 URL，多个端点用逗号分隔')
     # parser.add_argument('--model', type=str, required=True, help='模型名称')
-    parser.add_argument('--mode', type=str, choices=['tag', 'des', 'custom'], required=True, help='模式选择：tag（标签）、des（描述）、custom（自定义）')
+    parser.add_argument('--mode', type=str, nargs='+', choices=['tag', 'des', 'custom'], required=True,
+                        help='模式选择：tag（标签）、des（描述）、custom（自定义）；给出多个模式时每张图片按各模式分别生成，'
+                             '输出为 name_tag.txt, name_des.txt, ...，同一张图片的请求共享前缀缓存')
     parser.add_argument('--custom_prompt', type=str, default=None, help='自定义提示词（仅在 mode 为 custom 时使用）')
     parser.add_argument('--max_retries', type=int, default=3, help='最大重试次数')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='每个端点同时在途的请求数')
+    parser.add_argument('--dead_letter', type=str, default=None, help=f'失败列表文件路径（默认为输出文件夹下的 {DEAD_LETTER_FILENAME}）')
+    parser.add_argument('--rerun', type=str, default=None, help='只重跑指定失败列表中的图像')
+    parser.add_argument('--hedge_percentile', type=float, default=0,
+                        help='尾延迟对冲：请求超过近期延迟的该分位数（如 95）仍未完成时发出副本，0 表示关闭')
+    parser.add_argument('--stream', action='store_true', help='流式读取输出，并定期打印首 token 时间和生成速度')
+    parser.add_argument('--variants', type=int, default=1,
+                        help='每张图片生成的描述数，一次请求用 n 采样生成，输出为 name.txt, name_1.txt, ...')
+    parser.add_argument('--vision_size', type=int, default=None,
+                        help='预缩放边长：图片短边超过该值时先缩小再发送，0 表示不缩放（默认读取模型配置，否则为 384）')
+    parser.add_argument('--model_config', type=str, default=None,
+                        help='读取视觉输入尺寸的模型目录、config.json 路径或 HuggingFace 仓库名')
+    parser.add_argument('--image_format', type=str, choices=list(FORMATS), default=DEFAULT_FORMAT,
+                        help='需要重新编码的图片（缩放、非 JPEG/PNG/WebP 格式或带旋转信息）的发送格式')
+    parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY, help='JPEG/WebP 编码质量（1-100）')
+    parser.add_argument('--max_pixels', type=int, default=DEFAULT_MAX_PIXELS,
+                        help='像素预算：单张图片解码时最多同时存在的像素数，超大图片缩小或分块解码（0 表示不限制）')
+    parser.add_argument('--preprocess_workers', type=int, default=PREPROCESS_WORKERS,
+                        help='图片解码/预缩放/编码的进程数（0 表示在线程中预处理）')
+    parser.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH, help='预处理领先网络请求的图片数')
+    parser.add_argument('--payload_cache', type=str, default=None,
+                        help='预处理结果缓存目录（默认不缓存），换提示词重跑同一批图片时跳过解码和编码')
+    parser.add_argument('--payload_cache_mb', type=int, default=DEFAULT_CACHE_MB, help='预处理结果缓存上限（MB）')
+    parser.add_argument('--transport', type=str, choices=TRANSPORTS, default=TRANSPORT_BASE64,
+                        help='图片传输方式：base64 内联 / file 本地路径（vLLM 需 --allowed-local-media-path）/ http 内置文件服务器')
+    parser.add_argument('--media_host', type=str, default=None, help='http 方式下 vLLM 访问本机文件服务器的地址（默认自动选择）')
+    parser.add_argument('--media_port', type=int, default=0, help='http 方式的文件服务器端口（默认随机）')
+    parser.add_argument('--media_path_map', type=str, default=None,
+                        help='file 方式的路径映射 "本地前缀=服务端前缀"，客户端与 vLLM 挂载路径不同时使用')
+    parser.add_argument('--seed', type=int, default=None, help='采样随机种子（固定后同样的请求得到同样的描述）')
+    parser.add_argument('--result_cache', type=str, default=None,
+                        help='描述结果缓存数据库路径（SQLite，默认不缓存），重跑未改变的图片时不再请求')
+    parser.add_argument('--result_cache_mb', type=int, default=DEFAULT_RESULT_CACHE_MB, help='描述结果缓存上限（MB）')
+    parser.add_argument('--result_cache_policy', type=str, choices=POLICIES, default=POLICY_REUSE,
+                        help='结果缓存策略：reuse 复用命中的结果 / refresh 重新生成并覆盖')
+    parser.add_argument('--dedup', type=str, choices=DEDUP_MODES, default=DEFAULT_DEDUP,
+                        help='重复图片去重：off 不去重 / exact 内容完全相同 / near 另合并重新编码、缩放过的近似重复')
+    parser.add_argument('--dedup_distance', type=int, default=DEFAULT_DEDUP_DISTANCE,
+                        help='near 模式下判为近似重复的感知哈希汉明距离上限（0-10）')
     
     args = parser.parse_args()
     
-    client = create_openai_client(args.api_key, args.base_url)
-    
-    if args.mode == 'custom':
+    modes = list(dict.fromkeys(args.mode))
+    if len(modes) > 1:
+        prompt = {mode: generate_prompt(mode, args.custom_prompt) for mode in modes}
+    elif modes[0] == 'custom':
         if not args.custom_prompt:
             raise ValueError("Custom mode requires a custom prompt string.")
         prompt = args.custom_prompt
     else:
-        prompt = generate_prompt(args.mode)
+        prompt = generate_prompt(modes[0])
     
-    process_images(args.input, args.input, client, prompt, args.max_retries)
+    process_images(args.input, args.input, args.api_key, args.base_url, prompt, args.max_retries, args.concurrency,
+                   rerun_list=args.rerun, dead_letter_path=args.dead_letter,
+                   hedge_percentile=args.hedge_percentile, stream=args.stream, variants=args.variants,
+                   vision_size=args.vision_size, model_config=args.model_config,
+                   image_format=args.image_format, quality=args.quality, max_pixels=args.max_pixels,
+                   preprocess_workers=args.preprocess_workers, prefetch=args.prefetch,
+                   payload_cache_dir=args.payload_cache, payload_cache_mb=args.payload_cache_mb,
+                   transport=args.transport, media_host=args.media_host, media_port=args.media_port,
+                   media_path_map=args.media_path_map, seed=args.seed, result_cache_path=args.result_cache,
+                   result_cache_mb=args.result_cache_mb, result_cache_policy=args.result_cache_policy,
+                   dedup=args.dedup, dedup_distance=args.dedup_distance)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,603 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+from PIL import Image, ImageOps, TiffImagePlugin, TiffTags
+
+# JoyCaption（LLaVA + SigLIP so400m-patch14-384）的视觉塔输入边长，读不到模型配置时使用
+DEFAULT_VISION_SIZE = 384
+# 环境变量：模型目录 / config.json 路径 / HuggingFace 仓库名，以及直接指定的预缩放边长（0 表示不缩放）
+MODEL_CONFIG_ENV = "JOYCAPTION_MODEL_CONFIG"
+VISION_SIZE_ENV = "JOYCAPTION_VISION_SIZE"
+IMAGE_FORMAT_ENV = "JOYCAPTION_IMAGE_FORMAT"
+IMAGE_QUALITY_ENV = "JOYCAPTION_IMAGE_QUALITY"
+MAX_PIXELS_ENV = "JOYCAPTION_MAX_PIXELS"
+# 预缩放使用的滤波器：双线性足够快，且缩到视觉塔输入尺寸后与高质量滤波器差别不大
+RESAMPLE = Image.BILINEAR
+# 缩放时先用 reduce() 按整数倍缩小到目标尺寸的这个倍数以内，再用 RESAMPLE 精确缩放；
+# 大图缩放耗时成倍下降，3 倍以上时结果与直接缩放几乎没有差别
+REDUCING_GAP = 3.0
+# 发送格式：名称 -> (Pillow 格式, MIME 类型)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+DEFAULT_FORMAT = "jpeg"
+DEFAULT_QUALITY = 90      # JPEG/WebP 质量，缩到视觉输入尺寸后 90 与无损几乎没有差别
+# 透明图片铺底的背景色（vLLM 直接丢弃 alpha 通道，透明区域常变成黑色）
+BACKGROUND = (255, 255, 255)
+EXIF_ORIENTATION = 0x0112
+# 直传条件：短边不超过 vision_size 的这个倍数、文件不超过 PASSTHROUGH_MAX_BYTES 时直接发送原始文件。
+# 略大的图片交给服务端缩放，比在客户端解码、缩放、重新编码更省 CPU，负载也只多一点
+PASSTHROUGH_SCALE = 1.5
+PASSTHROUGH_MAX_BYTES = 512 * 1024
+# 原始文件可以直接发送的格式（Pillow 格式名 -> MIME 类型），其他格式（GIF、BMP 等）重新编码
+PASSTHROUGH_MIME = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+# 可以直接放进 image_url 发送的图片来源
+URL_PREFIXES = ("data:", "file://", "http://", "https://")
+# 像素预算：单张图片解码时最多同时存在的像素数（RGBA 约 4 字节/像素，默认约 160 MB），
+# 也是预缩放结果的像素上限；0 表示不限制。8K（约 3300 万像素）可以整张解码，更大的图片见 ImagePreprocessor.decode
+DEFAULT_MAX_PIXELS = 40_000_000
+# 分块解码时每组图块的像素数不超过像素预算的这个比例
+BAND_FRACTION = 8
+# 无法缩小或分块解码的格式（PNG、WebP 等）超出像素预算时退回整张解码，像素数不超过预算的这个倍数
+# （默认 1.6 亿像素，与 Pillow 默认的解压炸弹上限相当）；再大才拒绝
+FULL_DECODE_FACTOR = 4
+# 未压缩的单块位图（BMP、PPM、未压缩 TIFF 等）可以按行切分，这里是常见原始像素格式每像素的字节数
+RAW_PIXEL_BYTES = {"L": 1, "P": 1, "LA": 2, "RGB": 3, "BGR": 3, "RGBA": 4, "RGBX": 4, "BGRX": 4, "BGRA": 4,
+                   "CMYK": 4, "I;16": 2, "I;16B": 2}
+# 压缩的 TIFF（LZW、Deflate、JPEG 等）在 Pillow 中是整张的单个 libtiff 图块；按条带（strip）或一行分块（tile）
+# 把对应的压缩数据和解码所需的标签拼成一个只含这几行的小 TIFF，交给 libtiff 分别解码
+TIFF_IMAGE_LENGTH = 257
+TIFF_STRIP_OFFSETS = 273
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIG = 284
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+# 分段解码需要保留的标签：尺寸、采样格式、压缩与预测器、颜色解释、分块尺寸、JPEG 量化表等
+TIFF_BAND_TAGS = {256, 258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338, 339, 347, 530, 531, 532}
+LIBTIFF_BAND = "libtiff_band"
+# 预处理输出格式的版本号，预处理逻辑改变输出时递增，使磁盘上的旧缓存失效
+PAYLOAD_VERSION = 1
+
+
+def vision_size_from_config(source: str) -> Optional[int]:
+    """从模型配置读取视觉塔输入边长（vision_config.image_size），source 可以是模型目录、
+    config.json 路径或 HuggingFace 仓库名（需要 huggingface_hub），读取失败返回 None"""
+    try:
+        if os.path.isdir(source):
+            path = os.path.join(source, "config.json")
+        elif os.path.isfile(source):
+            path = source
+        else:
+            from huggingface_hub import hf_hub_download
+            path = hf_hub_download(source, "config.json")
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except Exception as e:
+        logging.warning(f"无法读取模型配置 {source}: {str(e)}")
+        return None
+    size = config.get("vision_config", {}).get("image_size") or config.get("image_size")
+    return int(size) if size else None
+
+
+def resolve_vision_size(override: Optional[int] = None, model_config: Optional[str] = None) -> int:
+    """确定预缩放边长：显式指定 > 环境变量 > 模型配置 > 默认值；0 表示不缩放"""
+    if override is not None:
+        return max(0, int(override))
+    if os.environ.get(VISION_SIZE_ENV):
+        return max(0, int(os.environ[VISION_SIZE_ENV]))
+    model_config = model_config or os.environ.get(MODEL_CONFIG_ENV)
+    if model_config:
+        size = vision_size_from_config(model_config)
+        if size:
+            logging.info(f"模型视觉输入边长: {size}（{model_config}）")
+            return size
+    return DEFAULT_VISION_SIZE
+
+
+class ImageInfo(NamedTuple):
+    """只读文件头得到的图片信息"""
+    format: Optional[str]
+    mode: str
+    width: int
+    height: int
+    file_size: int
+    orientation: int
+
+
+def _open_unchecked(image_path: str) -> Image.Image:
+    """按文件头依次尝试 Pillow 已注册的格式插件，直接构造图片对象（只解析文件头）；
+    与 Image.open 相同，只是不做解压炸弹检查"""
+    Image.init()
+    with open(image_path, "rb") as f:
+        prefix = f.read(16)
+    for format_id in Image.ID:
+        factory, accept = Image.OPEN[format_id]
+        if accept and accept(prefix) is not True:
+            continue
+        try:
+            return factory(image_path, image_path)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+    raise Image.UnidentifiedImageError(f"无法识别的图片文件: {image_path}")
+
+
+def open_image(image_path: str) -> Image.Image:
+    """打开图片文件（只解析文件头）。超过 Pillow 解压炸弹上限的图片改用 _open_unchecked 打开：
+    解码内存由像素预算控制，超大图片要能打开才能按预算缩小解码或拒绝；
+    不修改进程级的 Image.MAX_IMAGE_PIXELS，其他线程打开图片时照常检查"""
+    try:
+        return Image.open(image_path)
+    except Image.DecompressionBombError:
+        return _open_unchecked(image_path)
+
+
+def inspect_image(image_path: str) -> ImageInfo:
+    """只解析文件头（不解码像素）读取格式、尺寸、文件大小和 EXIF 方向，文件不是有效图片时抛出异常"""
+    with open_image(image_path) as image:
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1) if image.format in ("JPEG", "WEBP") else 1
+        mode = "RGBA" if image.mode == "P" and "transparency" in image.info else image.mode
+        return ImageInfo(image.format, mode, image.width, image.height, os.path.getsize(image_path), orientation)
+
+
+def read_base64(path: str) -> str:
+    """通过内存映射读取文件并做 base64 编码，不额外复制一份文件内容"""
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return base64.b64encode(mapped).decode("ascii")
+        except ValueError:
+            # 空文件无法映射
+            return base64.b64encode(f.read()).decode("ascii")
+
+
+def content_hash(path: str) -> str:
+    """文件内容的 SHA-256（十六进制），通过内存映射读取"""
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha256(mapped).hexdigest()
+        except ValueError:
+            # 空文件无法映射
+            return hashlib.sha256(f.read()).hexdigest()
+
+
+def bitmap_bytes(image: Image.Image) -> int:
+    """解码后位图占用的字节数（按每通道 1 字节估计）"""
+    return image.width * image.height * len(image.getbands())
+
+
+def flatten(image: Image.Image) -> Image.Image:
+    """按 EXIF 方向摆正并转为 RGB：透明（RGBA/LA/带透明色的调色板）图片铺在白色背景上，
+    调色板、灰度、CMYK 等其他模式直接转换；无需处理时返回原图（不复制）"""
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA", "PA"):
+        background = Image.new("RGB", image.size, BACKGROUND)
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def _libtiff_tiles(image: Image.Image) -> list:
+    """压缩 TIFF 的单个 libtiff 图块按存储单位切开：条带存储每个条带一组，分块存储每行分块一组，
+    返回 (LIBTIFF_BAND, 行范围, (起始序号, 个数), None)；平面分开存储（PlanarConfiguration=2）时返回空列表"""
+    tags = getattr(image, "tag_v2", None)
+    if tags is None or tags.get(TIFF_PLANAR_CONFIG, 1) != 1:
+        return []
+    if TIFF_TILE_OFFSETS in tags:
+        rows = tags.get(TIFF_TILE_LENGTH)
+        per_row = math.ceil(image.width / tags.get(TIFF_TILE_WIDTH, image.width))
+        chunks = len(tags[TIFF_TILE_OFFSETS])
+    elif TIFF_STRIP_OFFSETS in tags:
+        rows = tags.get(TIFF_ROWS_PER_STRIP, image.height)
+        per_row = 1
+        chunks = len(tags[TIFF_STRIP_OFFSETS])
+    else:
+        return []
+    if not rows or chunks != math.ceil(image.height / rows) * per_row:
+        return []
+    return [(LIBTIFF_BAND, (0, start, image.width, min(start + rows, image.height)), (index * per_row, per_row), None)
+            for index, start in enumerate(range(0, image.height, rows))]
+
+
+def _tiff_rows(image_path: str, start: int, end: int, tiles: list) -> Image.Image:
+    """把 [start, end) 行对应的条带或分块的压缩数据拼成一个小 TIFF 并打开（尚未解码）"""
+    with open_image(image_path) as source:
+        tags = source.tag_v2
+        offsets_tag, counts_tag = (TIFF_TILE_OFFSETS, TIFF_TILE_BYTE_COUNTS) if TIFF_TILE_OFFSETS in tags \
+            else (TIFF_STRIP_OFFSETS, TIFF_STRIP_BYTE_COUNTS)
+        first = tiles[0][2][0]
+        last = tiles[-1][2][0] + tiles[-1][2][1]
+        offsets = tags[offsets_tag][first:last]
+        counts = tags[counts_tag][first:last]
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=tags.prefix)
+        for tag in TIFF_BAND_TAGS & set(tags.keys()):
+            ifd.tagtype[tag] = tags.tagtype[tag]
+            ifd[tag] = tags[tag]
+    buffer = io.BytesIO()
+    buffer.write(b"\0" * 8)
+    new_offsets = []
+    with open(image_path, "rb") as f:
+        for offset, count in zip(offsets, counts):
+            f.seek(offset)
+            new_offsets.append(buffer.tell())
+            buffer.write(f.read(count))
+    # Pillow 写 IFD 时把 StripOffsets 当作紧跟在 IFD 后的单个条带处理，不支持多个条带；
+    # 先用相邻的占位标签写入偏移，再把该项的标签号改回 StripOffsets（标签顺序不变）
+    placeholder = offsets_tag - 1 if offsets_tag == TIFF_STRIP_OFFSETS else offsets_tag
+    ifd[TIFF_IMAGE_LENGTH] = end - start
+    ifd.tagtype[placeholder] = TiffTags.LONG
+    ifd._tags_v2[placeholder] = tuple(new_offsets)  # 绕过占位标签按单值截断的检查
+    ifd.tagtype[counts_tag] = TiffTags.LONG
+    ifd[counts_tag] = tuple(counts)
+    ifd_offset = buffer.tell()
+    data = bytearray(ifd.tobytes(ifd_offset))
+    if placeholder != offsets_tag:
+        (entries,) = ifd._unpack("H", data[:2])
+        for position in range(2, 2 + 12 * entries, 12):
+            if ifd._unpack("H", data[position:position + 2])[0] == placeholder:
+                data[position:position + 2] = ifd._pack("H", offsets_tag)
+    buffer.write(data)
+    buffer.seek(0)
+    buffer.write(tags.prefix + ifd._pack("HL", 42, ifd_offset))
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+def _row_tiles(image: Image.Image, band_rows: int) -> list:
+    """可以按行分别解码的图块：多个图块时原样返回；单个未压缩的原始像素块按 band_rows 行切开
+    （按行计算文件偏移，支持自下而上存储的 BMP）；压缩 TIFF 的单个 libtiff 图块按条带或分块行切开；
+    其他情况返回空列表"""
+    if len(image.tile) != 1:
+        return image.tile
+    decoder, extents, offset, args = image.tile[0]
+    if decoder == "libtiff" and tuple(extents) == (0, 0, image.width, image.height):
+        return _libtiff_tiles(image)
+    if decoder != "raw" or tuple(extents) != (0, 0, image.width, image.height):
+        return []
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    pixel_bytes = RAW_PIXEL_BYTES.get(rawmode)
+    if pixel_bytes is None:
+        return []
+    stride = stride or image.width * pixel_bytes
+    tiles = []
+    for start in range(0, image.height, band_rows):
+        end = min(start + band_rows, image.height)
+        first_row = image.height - end if orientation < 0 else start
+        tiles.append(("raw", (0, start, image.width, end), offset + first_row * stride, (rawmode, stride, orientation)))
+    return tiles
+
+
+def _row_bands(image: Image.Image, band_rows: int) -> List[Tuple[int, int, list]]:
+    """把图片的图块按行分组，每组至少 band_rows 行，返回 [(起始行, 结束行, 图块列表)]；
+    图块不能按行完整覆盖图片（压缩的单个图块、交错存储等）时返回空列表"""
+    tiles = _row_tiles(image, band_rows)
+    rows = sorted({(tile[1][1], tile[1][3]) for tile in tiles})
+    if len(rows) < 2 or rows[0][0] != 0 or rows[-1][1] != image.height:
+        return []
+    if any(previous[1] != current[0] for previous, current in zip(rows, rows[1:])):
+        return []
+    bands = []
+    start = 0
+    for _, end in rows:
+        if end - start >= band_rows or end == image.height:
+            bands.append((start, end, [tile for tile in tiles if start <= tile[1][1] and tile[1][3] <= end]))
+            start = end
+    return bands
+
+
+def _decode_rows(image_path: str, start: int, end: int, tiles: list) -> Image.Image:
+    """重新打开图片文件，只解码 [start, end) 行对应的图块"""
+    if tiles[0][0] == LIBTIFF_BAND:
+        band = _tiff_rows(image_path, start, end, tiles)
+    else:
+        band = open_image(image_path)
+        band.tile = [(decoder, (x0, y0 - start, x1, y1 - start), offset, args)
+                     for decoder, (x0, y0, x1, y1), offset, args in tiles]
+        band._size = (band.width, end - start)
+    band.load()
+    if band.mode not in ("L", "LA", "RGB", "RGBA"):
+        # reduce() 不支持调色板等模式
+        converted = band.convert("RGBA" if "transparency" in band.info else "RGB")
+        band.close()
+        band = converted
+    return band
+
+
+def tiled_reduce(image_path: str, image: Image.Image, size: Tuple[int, int],
+                 max_pixels: int) -> Optional[Tuple[Image.Image, int]]:
+    """分块解码超出像素预算的图片：按行分组解码图块，每组用 reduce() 按整数倍缩小后拼接，
+    同时存在的只有一组图块（不超过像素预算的 1/BAND_FRACTION）、上一组余下的几行和缩小后的结果。
+    组的行数不是倍数的整数倍时，余下的行并入下一组，拼接处不会出现接缝。
+    支持由多个图块按行组成的图片（未压缩的条带/分块 TIFF 等）、压缩的条带/分块 TIFF（LZW、Deflate、JPEG 等，
+    按条带或分块行交给 libtiff）和未压缩的位图；平面分开存储的 TIFF 及 PNG、WebP 等其他图片返回 None。
+    返回 (缩小后的图片, 估计的峰值字节数)。
+    """
+    width, height = image.size
+    factor = max(2, int(min(width / size[0], height / size[1])))
+    bands = _row_bands(image, max(factor, max_pixels // BAND_FRACTION // width))
+    if not bands:
+        return None
+    reduced = None
+    carry = None
+    top = 0
+    peak = 0
+    for start, end, tiles in bands:
+        band = _decode_rows(image_path, start, end, tiles)
+        held = bitmap_bytes(band) + (bitmap_bytes(carry) if carry is not None else 0)
+        if carry is not None:
+            held += bitmap_bytes(band) + bitmap_bytes(carry)
+            merged = Image.new(band.mode, (width, carry.height + band.height))
+            merged.paste(carry, (0, 0))
+            merged.paste(band, (0, carry.height))
+            carry.close()
+            band.close()
+            band = merged
+        usable = band.height if end == height else band.height // factor * factor
+        if usable:
+            part = band if usable == band.height else band.crop((0, 0, width, usable))
+            small = part.reduce(factor)
+            if part is not band:
+                part.close()
+            if reduced is None:
+                reduced = Image.new(small.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+            peak = max(peak, held + bitmap_bytes(reduced) + bitmap_bytes(small))
+            reduced.paste(small, (0, top))
+            top += small.height
+            small.close()
+        carry = band.crop((0, usable, width, band.height)) if usable < band.height else None
+        band.close()
+    # 保留 EXIF 方向，flatten 时照常摆正
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    if orientation != 1:
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = orientation
+        reduced.info["exif"] = exif.tobytes()
+    return reduced, peak
+
+
+class Prepared(NamedTuple):
+    """一张图片的预处理结果"""
+    data_url: str
+    passthrough: bool
+    peak_bytes: int    # 处理过程中同时存在的位图和缓冲区的估计峰值字节数
+
+
+class ImagePreprocessor:
+    """发送前的图片预处理：按模型视觉输入尺寸预缩放，再编码为 JPEG/WebP/PNG
+
+    视觉塔会把图片缩放到 vision_size × vision_size，因此只要短边不小于 vision_size 就不损失模型可见的信息；
+    提前缩放可以减少客户端编码、请求体积、JSON 解析和服务端解码的开销。vision_size 为 0 时不缩放。
+    编码前统一摆正方向、去掉透明通道并转为 RGB，输出不带 EXIF 等元数据。
+    max_pixels 限制单张图片解码时的像素数（见 decode），各步骤的中间图像用完立即释放。
+    """
+
+    def __init__(self, vision_size: int = DEFAULT_VISION_SIZE, format: str = DEFAULT_FORMAT,
+                 quality: int = DEFAULT_QUALITY, passthrough_scale: float = PASSTHROUGH_SCALE,
+                 passthrough_max_bytes: int = PASSTHROUGH_MAX_BYTES, max_pixels: int = DEFAULT_MAX_PIXELS):
+        if format not in FORMATS:
+            raise ValueError(f"不支持的图片格式: {format}，可选 {', '.join(FORMATS)}")
+        self.vision_size = max(0, vision_size)
+        self.format = format
+        self.quality = min(100, max(1, quality))
+        self.passthrough_scale = passthrough_scale
+        self.passthrough_max_bytes = passthrough_max_bytes
+        self.max_pixels = max(0, max_pixels)
+        self.passthrough_count = 0
+        self.reencoded_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def mime_type(self) -> str:
+        return FORMATS[self.format][1]
+
+    def target_size(self, width: int, height: int) -> Tuple[int, int]:
+        """按短边缩到 vision_size、且总像素不超过像素预算的目标尺寸，图片已经足够小时返回原尺寸"""
+        scale = 1.0
+        short = min(width, height)
+        if self.vision_size and short > self.vision_size:
+            scale = self.vision_size / short
+        if self.max_pixels and width * height * scale * scale > self.max_pixels:
+            scale = math.sqrt(self.max_pixels / (width * height))
+        if scale >= 1:
+            return width, height
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        """预缩放，无需缩放时返回原图"""
+        size = self.target_size(*image.size)
+        if size == image.size:
+            return image
+        return image.resize(size, RESAMPLE, reducing_gap=REDUCING_GAP)
+
+    def open(self, image_path: str) -> Image.Image:
+        """打开图片文件，返回尚未解码的图片
+
+        JPEG 需要预缩放时通过 draft() 让解码器在 DCT 域直接按 1/2、1/4、1/8 缩小输出（结果不小于目标尺寸，
+        再由 resize 精确缩放），4K/8K 照片的解码耗时和内存成倍下降；原图超出像素预算时至少缩小到预算以内
+        （最多 1/8）。其他格式按原尺寸解码。
+        """
+        image = open_image(image_path)
+        if image.format == "JPEG":
+            size = self.target_size(*image.size)
+            scale = 1
+            while scale < 8 and self.max_pixels and image.width * image.height > self.max_pixels * scale * scale:
+                scale *= 2
+            # draft() 选择不超过 原尺寸 // 请求尺寸 的最大缩小倍数，请求 原尺寸 // scale 即可保证缩小 scale 倍
+            size = min(size, (image.width // scale, image.height // scale))
+            if size != image.size:
+                image.draft(image.mode, size)
+        return image
+
+    def decode(self, image_path: str) -> Tuple[Image.Image, int]:
+        """按像素预算解码图片文件，返回 (解码后的图片, 解码阶段估计的峰值字节数)
+
+        解码像素数（JPEG 为 draft() 缩小后的尺寸）在预算内时整张解码；超出时由 tiled_reduce 分块解码并逐块缩小，
+        内存不随原图尺寸增长；压缩的 TIFF 按条带或分块行解码。单个图块存储的其他格式（PNG、WebP 等）无法分块，不超过预算 FULL_DECODE_FACTOR 倍时
+        仍整张解码（例如 8192×8192 的 PNG），更大时抛出 ValueError，而不是把整张位图读进内存。
+        """
+        image = self.open(image_path)
+        pixels = image.width * image.height
+        if not self.max_pixels or pixels <= self.max_pixels:
+            image.load()
+            return image, bitmap_bytes(image)
+        try:
+            reduced = tiled_reduce(image_path, image, self.target_size(*image.size), self.max_pixels)
+        except BaseException:
+            image.close()
+            raise
+        if reduced is not None:
+            image.close()
+            return reduced
+        if pixels > self.max_pixels * FULL_DECODE_FACTOR:
+            image.close()
+            raise ValueError(f"图片 {image.width}×{image.height} 超出像素预算 {self.max_pixels} 的 {FULL_DECODE_FACTOR} 倍，"
+                             f"且 {image.format} 格式无法分块解码")
+        logging.debug(f"{image.format} 格式无法分块解码，整张解码 {image.width}×{image.height}: {image_path}")
+        image.load()
+        return image, bitmap_bytes(image)
+
+    def encode_with_peak(self, image: Image.Image) -> Tuple[bytes, int]:
+        """预缩放、转为 RGB 并按配置的格式编码（不写入元数据），返回 (编码结果, 估计的峰值字节数)；
+        每一步产生的中间图像在下一步完成后立即关闭，传入的图片由调用方负责"""
+        peak = bitmap_bytes(image)
+        resized = self.resize(image)
+        if resized is not image:
+            peak = max(peak, bitmap_bytes(image) + bitmap_bytes(resized))
+        flat = flatten(resized)
+        if flat is not resized:
+            peak = max(peak, bitmap_bytes(resized) + bitmap_bytes(flat))
+            if resized is not image:
+                resized.close()
+        buffer = io.BytesIO()
+        pil_format = FORMATS[self.format][0]
+        if pil_format == "PNG":
+            flat.save(buffer, format=pil_format)
+        else:
+            flat.save(buffer, format=pil_format, quality=self.quality)
+        data = buffer.getvalue()
+        buffer.close()
+        peak = max(peak, bitmap_bytes(flat) + 2 * len(data))
+        if flat is not image:
+            flat.close()
+        return data, peak
+
+    def encode(self, image: Image.Image) -> bytes:
+        """预缩放、转为 RGB 并按配置的格式编码（不写入元数据）"""
+        return self.encode_with_peak(image)[0]
+
+    def prepare_image(self, image: Image.Image) -> Prepared:
+        """预缩放并编码为 data URL，编码结果转成 base64 后立即释放"""
+        data, peak = self.encode_with_peak(image)
+        encoded = base64.b64encode(data)
+        # 编码结果、base64 字节串和最终的字符串短暂同时存在
+        peak = max(peak, len(data) + 2 * len(encoded))
+        del data
+        data_url = f"data:{self.mime_type};base64,{encoded.decode('ascii')}"
+        return Prepared(data_url, False, peak)
+
+    def to_data_url(self, image: Image.Image) -> str:
+        """预缩放并编码为 data URL"""
+        return self.prepare_image(image).data_url
+
+    def can_pass_through(self, info: ImageInfo) -> bool:
+        """文件是否可以不解码直接发送：格式可直接发送、不透明、无需按 EXIF 旋转、尺寸和文件大小都在限制内"""
+        if info.format not in PASSTHROUGH_MIME or info.orientation != 1 or info.mode in ("RGBA", "LA", "PA"):
+            return False
+        if info.file_size > self.passthrough_max_bytes:
+            return False
+        return not self.vision_size or min(info.width, info.height) <= self.vision_size * self.passthrough_scale
+
+    def prepare_file(self, image_path: str) -> Prepared:
+        """读取图片文件并编码为 data URL，不计入统计（供进程池调用）"""
+        info = inspect_image(image_path)
+        if self.can_pass_through(info):
+            data_url = f"data:{PASSTHROUGH_MIME[info.format]};base64,{read_base64(image_path)}"
+            return Prepared(data_url, True, 2 * len(data_url))
+        image, decode_peak = self.decode(image_path)
+        with image:
+            prepared = self.prepare_image(image)
+        return prepared._replace(peak_bytes=max(decode_peak, prepared.peak_bytes))
+
+    def count(self, passthrough: bool) -> None:
+        """记录一张图片是直传还是重新编码"""
+        with self._lock:
+            if passthrough:
+                self.passthrough_count += 1
+            else:
+                self.reencoded_count += 1
+
+    def file_to_data_url(self, image_path: str) -> str:
+        """读取图片文件：符合直传条件时不解码，直接对原始字节做 base64（按实际格式标注 MIME），
+        否则解码、预缩放后重新编码"""
+        prepared = self.prepare_file(image_path)
+        self.count(prepared.passthrough)
+        return prepared.data_url
+
+    def source_to_data_url(self, source: Union[str, Image.Image]) -> str:
+        """文件路径走 file_to_data_url（可直传），已解码的图片直接预缩放编码，
+        已经生成好的 URL（预处理流水线输出的 data URL 或 file/http 传输方式的 URL）原样返回"""
+        if isinstance(source, str):
+            if source.startswith(URL_PREFIXES):
+                return source
+            return self.file_to_data_url(source)
+        return self.to_data_url(source)
+
+    def cache_params(self) -> str:
+        """影响预处理输出的全部参数，与文件内容哈希一起组成磁盘缓存的键"""
+        return (f"v{PAYLOAD_VERSION}:{self.vision_size}:{self.format}:{self.quality}:"
+                f"{self.passthrough_scale}:{self.passthrough_max_bytes}:{self.max_pixels}")
+
+    def __getstate__(self):
+        # 锁不能序列化，传给预处理进程时去掉
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def format_stats(self) -> str:
+        """直传与重新编码的图片数"""
+        with self._lock:
+            return f"直传原始文件 {self.passthrough_count} 张，重新编码 {self.reencoded_count} 张"
+
+
+_default: Optional[ImagePreprocessor] = None
+_default_lock = threading.Lock()
+
+
+def get_preprocessor() -> ImagePreprocessor:
+    """进程级默认预处理器，预缩放边长、编码格式和质量由环境变量或模型配置决定（首次调用时解析）"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ImagePreprocessor(
+                resolve_vision_size(),
+                os.environ.get(IMAGE_FORMAT_ENV, DEFAULT_FORMAT).lower(),
+                int(os.environ.get(IMAGE_QUALITY_ENV, DEFAULT_QUALITY)),
+                max_pixels=int(os.environ.get(MAX_PIXELS_ENV, DEFAULT_MAX_PIXELS)),
+            )
+        return _default
+
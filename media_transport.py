@@ -0,0 +1,200 @@
+import logging
+import mimetypes
+import os
+import secrets
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from urllib.parse import quote, urlparse
+
+from endpoint_router import parse_endpoints
+from image_preprocess import ImageInfo, inspect_image
+
+# 图片传输方式：base64 内联（默认）、本地文件路径（file://，需与 vLLM 共享存储）、内置静态文件服务器的 HTTP URL
+TRANSPORT_BASE64 = "base64"
+TRANSPORT_FILE = "file"
+TRANSPORT_HTTP = "http"
+TRANSPORTS = (TRANSPORT_BASE64, TRANSPORT_FILE, TRANSPORT_HTTP)
+# 环境变量：Web 界面的默认传输方式、文件服务器对 vLLM 可见的地址、监听地址（默认同对外地址）和端口（0 为随机端口）、路径映射
+MEDIA_TRANSPORT_ENV = "JOYCAPTION_MEDIA_TRANSPORT"
+MEDIA_HOST_ENV = "JOYCAPTION_MEDIA_HOST"
+MEDIA_BIND_ENV = "JOYCAPTION_MEDIA_BIND"
+MEDIA_PORT_ENV = "JOYCAPTION_MEDIA_PORT"
+MEDIA_PATH_MAP_ENV = "JOYCAPTION_MEDIA_PATH_MAP"
+# 文件服务器每次读写的块大小
+CHUNK_SIZE = 1024 * 1024
+
+
+def default_transport() -> str:
+    """Web 界面默认的传输方式（环境变量 JOYCAPTION_MEDIA_TRANSPORT，未设置时为 base64）"""
+    transport = os.environ.get(MEDIA_TRANSPORT_ENV, TRANSPORT_BASE64).lower()
+    return transport if transport in TRANSPORTS else TRANSPORT_BASE64
+
+
+def needs_client_processing(info: ImageInfo) -> bool:
+    """图片是否必须在客户端处理后再发送：需要按 EXIF 旋转或带透明通道
+    （vLLM 加载图片时不处理 EXIF 方向，透明区域会变成黑色），这类图片仍以 base64 发送"""
+    return info.orientation != 1 or info.mode in ("RGBA", "LA", "PA")
+
+
+def parse_path_map(text: Optional[str]) -> Optional[Tuple[str, str]]:
+    """解析 "本地前缀=服务端前缀" 形式的路径映射，客户端和 vLLM 挂载同一存储的路径不同时使用"""
+    if not text:
+        return None
+    local, sep, remote = text.partition("=")
+    if not sep:
+        raise ValueError(f"路径映射格式应为 本地前缀=服务端前缀: {text}")
+    return os.path.abspath(local), remote
+
+
+def local_address_for(base_url: str) -> str:
+    """本机访问 base_url（取第一个端点）时使用的网卡地址，即 vLLM 回连文件服务器应使用的地址"""
+    endpoints = parse_endpoints(base_url)
+    host = urlparse(endpoints[0]).hostname if endpoints else None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # UDP connect 不发送数据，只让系统选出路由对应的本机地址
+            sock.connect((host or "8.8.8.8", 80))
+            return sock.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+
+
+class _MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(f"媒体文件服务器: {format % args}")
+
+    def do_GET(self):
+        token = self.path.lstrip("/").split("/", 1)[0]
+        path = self.server.media_files.get(token)
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+
+class MediaServer:
+    """内置静态文件服务器（后台线程）：只提供通过 register() 登记、尚未 unregister() 的文件，
+    URL 中使用随机令牌而不是文件路径，无法由路径推算，也不会暴露其他文件；vLLM 按 URL 自行下载图片。
+    默认只监听对外地址所在的网卡（bind 为 None 时等于 advertise_host），不在所有网卡上开放"""
+
+    def __init__(self, advertise_host: str, port: int = 0, bind: Optional[str] = None):
+        self._server = ThreadingHTTPServer((bind or advertise_host, port), _MediaHandler)
+        self._server.daemon_threads = True
+        self._server.media_files = {}
+        self.advertise_host = advertise_host
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="media-server", daemon=True)
+        self._thread.start()
+        logging.info(f"媒体文件服务器已启动: http://{advertise_host}:{self.port}")
+
+    def register(self, path: str) -> Tuple[str, str]:
+        """登记文件，返回 (令牌, URL)；令牌用于任务结束后 unregister()"""
+        path = os.path.abspath(path)
+        token = secrets.token_urlsafe(24)
+        self._server.media_files[token] = path
+        return token, f"http://{self.advertise_host}:{self.port}/{token}/{quote(os.path.basename(path))}"
+
+    def unregister(self, tokens: Iterable[str]) -> None:
+        """撤销登记，之后这些 URL 返回 404"""
+        for token in tokens:
+            self._server.media_files.pop(token, None)
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MediaTransport:
+    """按传输方式生成图片 URL：file 模式为 file:// 路径（vLLM 需加 --allowed-local-media-path），
+    http 模式为内置文件服务器的 URL；两种模式都由 vLLM 自行读取和缩放原始文件，
+    省去客户端编码、base64 膨胀（+33%）和巨大的 JSON 请求体。需要客户端处理的图片返回 None，调用方改用 base64。
+    """
+
+    def __init__(self, transport: str, server: Optional[MediaServer] = None,
+                 path_map: Optional[Tuple[str, str]] = None):
+        if transport not in (TRANSPORT_FILE, TRANSPORT_HTTP):
+            raise ValueError(f"不支持的传输方式: {transport}")
+        if transport == TRANSPORT_HTTP and server is None:
+            raise ValueError("http 传输方式需要文件服务器")
+        self.transport = transport
+        self.server = server
+        self.path_map = path_map
+        self.sent = 0
+        self.fallback = 0
+        self._tokens: List[str] = []
+        self._lock = threading.Lock()
+
+    def _server_path(self, path: str) -> str:
+        path = os.path.abspath(path)
+        if self.path_map and path.startswith(self.path_map[0]):
+            return self.path_map[1] + path[len(self.path_map[0]):]
+        return path
+
+    def url_for(self, path: str) -> Optional[str]:
+        """图片文件对应的 URL，需要在客户端处理的图片返回 None"""
+        if needs_client_processing(inspect_image(path)):
+            with self._lock:
+                self.fallback += 1
+            return None
+        if self.transport == TRANSPORT_HTTP:
+            token, url = self.server.register(path)
+            with self._lock:
+                self.sent += 1
+                self._tokens.append(token)
+            return url
+        with self._lock:
+            self.sent += 1
+        return Path(self._server_path(path)).as_uri()
+
+    def close(self) -> None:
+        """撤销本次任务在文件服务器上登记的全部文件，由流水线或引擎在任务结束时调用"""
+        with self._lock:
+            tokens, self._tokens = self._tokens, []
+        if tokens:
+            self.server.unregister(tokens)
+
+    def format_stats(self) -> str:
+        with self._lock:
+            return (f"{self.transport} 方式发送 {self.sent} 张，"
+                    f"需要旋转或去透明通道改用 base64 发送 {self.fallback} 张")
+
+
+_server: Optional[MediaServer] = None
+_server_lock = threading.Lock()
+
+
+def get_media_server(base_url: str) -> MediaServer:
+    """进程级文件服务器（首次使用时启动），地址由环境变量指定或按 base_url 的路由自动选择；
+    各次批量任务只在运行期间登记自己的文件"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            advertise_host = os.environ.get(MEDIA_HOST_ENV) or local_address_for(base_url)
+            _server = MediaServer(advertise_host, int(os.environ.get(MEDIA_PORT_ENV, 0)),
+                                  os.environ.get(MEDIA_BIND_ENV))
+        return _server
+
+
+def create_transport(transport: str, base_url: str, server: Optional[MediaServer] = None,
+                     path_map: Optional[Tuple[str, str]] = None) -> Optional[MediaTransport]:
+    """按传输方式创建 MediaTransport，base64 返回 None；http 方式未传入 server 时使用进程级文件服务器"""
+    if transport == TRANSPORT_BASE64:
+        return None
+    if transport == TRANSPORT_HTTP and server is None:
+        server = get_media_server(base_url)
+    return MediaTransport(transport, server, path_map or parse_path_map(os.environ.get(MEDIA_PATH_MAP_ENV)))
@@ -1,4 +1,4 @@
-from openai import OpenAI
+from vllm_client import get_client, create_chat_completion
 import time
 
 
@@ -16,7 +16,7 @@ ip_algo='192.168.5.212'
 
 #client = OpenAI(api_key='YOUR_API_KEY', base_url='http://192.168.5.212:8000/v1')
 
-client = OpenAI(api_key='sk-2x1zj2w6q7jQ8q6Y5q6Y5q6Y', base_url=f'http://{ip_algo}:8000/v1')
+client = get_client('sk-2x1zj2w6q7jQ8q6Y5q6Y5q6Y', f'http://{ip_algo}:8000/v1')
 prompt_types={
             # "Tag":"Write a list of Booru tags for this image.",
             # "Tag":"Write a medium-length list of Booru tags for this image.",
@@ -39,9 +39,8 @@ while(1):
     for img_type, img_url in image_types.items():
         for prompt_type, prompt in prompt_types.items():
             T0=time.time()
-            model_name = client.models.list().data[0].id
-            response = client.chat.completions.create(
-                model=model_name,
+            response = create_chat_completion(
+                client,
                 messages=[
                     {
                     'role':'system',
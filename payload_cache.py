@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import uuid
+from typing import Optional, Tuple
+
+from image_preprocess import ImagePreprocessor, content_hash, inspect_image
+
+# 默认缓存上限（MB）
+DEFAULT_CACHE_MB = 2048
+# 超出上限时淘汰到上限的这个比例以下，避免每次写入都触发淘汰
+EVICT_TARGET = 0.9
+# 环境变量：Web 界面批量处理使用的缓存目录（不设置则不缓存）和上限（MB）
+PAYLOAD_CACHE_ENV = "JOYCAPTION_PAYLOAD_CACHE"
+PAYLOAD_CACHE_MB_ENV = "JOYCAPTION_PAYLOAD_CACHE_MB"
+SUFFIX = ".payload"
+# 文件指纹（路径 + 大小 + 修改时间）到内容哈希的索引，文件未改变时不必重新计算哈希
+INDEX_DIR = "index"
+
+
+class PayloadCache:
+    """磁盘上的预处理结果缓存：键为文件内容哈希 + 预处理参数，值为可直接发送的 data URL
+
+    换提示词重跑同一批图片时，未改变的图片直接读取缓存，不再解码、缩放和编码；
+    图片内容或预处理参数（边长、格式、质量等）变化时键随之变化，不会读到过期结果。
+    直传的图片本身没有编码开销，不写入缓存。
+    文件按键的前两位分目录存放，写入先写临时文件再原子替换；命中时更新文件修改时间，
+    总大小超过上限时按修改时间淘汰最久未用的条目（LRU）。
+    另按文件指纹记录内容哈希，重跑未改变的图片时连哈希也不必重新计算。
+    """
+
+    def __init__(self, directory: str, max_mb: int = DEFAULT_CACHE_MB):
+        self.directory = directory
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + SUFFIX)
+
+    def _entries(self):
+        """遍历缓存条目，产出 (路径, 大小, 修改时间)"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _write(self, path: str, data: bytes) -> None:
+        """先写临时文件再原子替换，并发写入同一条目时不会读到半个文件"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def content_hash(self, image_path: str) -> str:
+        """文件内容哈希，文件指纹未变时直接读取索引"""
+        stat = os.stat(image_path)
+        fingerprint = hashlib.sha256(
+            f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        ).hexdigest()
+        index_path = os.path.join(self.directory, INDEX_DIR, fingerprint[:2], fingerprint)
+        try:
+            with open(index_path, "r", encoding="ascii") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        digest = content_hash(image_path)
+        try:
+            self._write(index_path, digest.encode("ascii"))
+        except OSError as e:
+            logging.warning(f"写入预处理缓存索引失败 {index_path}: {str(e)}")
+        return digest
+
+    def key(self, image_path: str, preprocessor: ImagePreprocessor) -> str:
+        """缓存键：文件内容哈希与预处理参数的 SHA-256"""
+        return hashlib.sha256(f"{self.content_hash(image_path)}:{preprocessor.cache_params()}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的 data URL（内存映射读取），不存在时返回 None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                data_url = mapped[:].decode("ascii")
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data_url
+
+    def lookup(self, image_path: str, preprocessor: ImagePreprocessor) -> Tuple[Optional[str], Optional[str]]:
+        """按图片文件查找，返回 (缓存键, data URL 或 None)；可以直传的图片不经过缓存，返回 (None, None)"""
+        if preprocessor.can_pass_through(inspect_image(image_path)):
+            return None, None
+        key = self.key(image_path, preprocessor)
+        return key, self.get(key)
+
+    def put(self, key: str, data_url: str) -> None:
+        """写入一条缓存，必要时淘汰最久未用的条目；写入失败只记录警告"""
+        path = self._path(key)
+        data = data_url.encode("ascii")
+        try:
+            self._write(path, data)
+        except OSError as e:
+            logging.warning(f"写入预处理缓存失败 {path}: {str(e)}")
+            return
+        with self._lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """按修改时间从旧到新删除条目，直到总大小低于上限的 EVICT_TARGET（调用方持有锁）；
+        已被其他进程删除的条目照常扣除大小，删除失败（权限等）的条目只记录警告并跳过"""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TARGET
+        for path, size, _ in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"淘汰预处理缓存失败 {path}: {str(e)}")
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def format_stats(self) -> str:
+        """本进程累计的命中数、未命中数与缓存占用"""
+        with self._lock:
+            return (f"累计命中 {self.hits} 张，未命中 {self.misses} 张，淘汰 {self.evictions} 条，"
+                    f"占用 {self.size / 1024 / 1024:.1f} / {self.max_bytes / 1024 / 1024:.0f} MB")
+
+
+_default: Optional[PayloadCache] = None
+_default_lock = threading.Lock()
+
+
+def get_payload_cache() -> Optional[PayloadCache]:
+    """进程级默认缓存，由环境变量 JOYCAPTION_PAYLOAD_CACHE 指定目录，未设置时返回 None（不缓存）"""
+    global _default
+    directory = os.environ.get(PAYLOAD_CACHE_ENV)
+    if not directory:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = PayloadCache(directory, int(os.environ.get(PAYLOAD_CACHE_MB_ENV, DEFAULT_CACHE_MB)))
+        return _default
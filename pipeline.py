@@ -0,0 +1,450 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+from PIL import Image
+
+from image_preprocess import ImagePreprocessor, Prepared, get_preprocessor
+from payload_cache import PayloadCache, get_payload_cache
+from media_transport import MediaTransport
+from result_cache import ResultCache
+from dedup import DuplicateIndex, group_duplicates
+
+T = TypeVar("T")
+
+# 预处理进程数：解码、预缩放、编码都是 CPU 密集操作，放在独立进程中不占用网络线程的 GIL
+PREPROCESS_WORKERS = min(4, os.cpu_count() or 1)
+# 预取数：预处理阶段领先网络阶段的图片数，保证网络空闲时立即有下一张可发
+DEFAULT_PREFETCH = 4
+# 环境变量：Web 界面批量处理的预处理进程数（0 表示在线程中预处理）和预取数
+PREPROCESS_WORKERS_ENV = "JOYCAPTION_PREPROCESS_WORKERS"
+PREFETCH_ENV = "JOYCAPTION_PREFETCH"
+
+_worker_preprocessor: Optional[ImagePreprocessor] = None
+
+
+def _init_worker(preprocessor: ImagePreprocessor) -> None:
+    global _worker_preprocessor
+    _worker_preprocessor = preprocessor
+
+
+def prepare_source(source: Union[str, Image.Image],
+                   preprocessor: Optional[ImagePreprocessor] = None) -> Tuple[Prepared, float]:
+    """解码、预缩放、编码一张图片，返回 (预处理结果, 耗时)；在预处理进程中调用时
+    使用进程初始化时传入的预处理器，统计由主进程按返回值记录"""
+    preprocessor = preprocessor or _worker_preprocessor
+    start = time.perf_counter()
+    if isinstance(source, str):
+        prepared = preprocessor.prepare_file(source)
+    else:
+        prepared = preprocessor.prepare_image(source)
+    return prepared, time.perf_counter() - start
+
+
+def lookup_payload(payload_cache: PayloadCache, source: str,
+                   preprocessor: ImagePreprocessor) -> Tuple[Optional[str], Optional[str], float]:
+    """查询预处理缓存，返回 (缓存键, data URL 或 None, 耗时)；查询出错时按未命中处理"""
+    start = time.perf_counter()
+    try:
+        key, data_url = payload_cache.lookup(source, preprocessor)
+    except Exception as e:
+        logging.warning(f"查询预处理缓存失败 {source}: {str(e)}")
+        key, data_url = None, None
+    return key, data_url, time.perf_counter() - start
+
+
+def media_url(media: MediaTransport, source: str) -> Tuple[Optional[str], float]:
+    """按传输方式取图片 URL，返回 (URL 或 None, 耗时)；需要客户端处理或读取出错时返回 None，改走预处理"""
+    start = time.perf_counter()
+    try:
+        url = media.url_for(source)
+    except Exception as e:
+        logging.warning(f"无法为 {source} 生成 URL: {str(e)}")
+        url = None
+    return url, time.perf_counter() - start
+
+
+def _pool_context():
+    """预处理进程的启动方式：进程中只有主线程时用 fork（最快）；已有其他线程（网络、健康检查、其他批量任务）时
+    用 forkserver（不支持时为 spawn），子进程由干净的服务进程派生，不会继承其他线程正持有的锁而卡死"""
+    methods = multiprocessing.get_all_start_methods()
+    if threading.active_count() == 1 and "fork" in methods:
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def create_process_pool(preprocessor: Optional[ImagePreprocessor], workers: int) -> Optional[ProcessPoolExecutor]:
+    """预处理进程池，workers 为 0 时返回 None（在线程中预处理）；传入 preprocessor 时作为各子进程的默认预处理器。
+    创建后立即提交一个空任务启动全部子进程，启动耗时不计入第一张图片的预处理"""
+    if workers < 1:
+        return None
+    initargs = (preprocessor,) if preprocessor is not None else ()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context(),
+                               initializer=_init_worker if initargs else None, initargs=initargs)
+    pool.submit(int).result()
+    return pool
+
+
+_shared_pool: Optional[ProcessPoolExecutor] = None
+_shared_pool_lock = threading.Lock()
+
+
+def start_process_pool() -> Optional[ProcessPoolExecutor]:
+    """Web 界面各次批量任务共享的预处理进程池（进程级，进程数由环境变量决定，为 0 时返回 None）
+
+    应在启动 Web 服务之前调用：此时只有主线程，子进程以 fork 方式一次性启动，之后的批量任务不再创建进程。
+    未提前启动或子进程异常退出（进程池损坏）时在此重新创建，改用 forkserver/spawn 方式。
+    任务随附预处理器，不依赖子进程初始化时的参数。
+    """
+    global _shared_pool
+    workers = int(os.environ.get(PREPROCESS_WORKERS_ENV, PREPROCESS_WORKERS))
+    if workers < 1:
+        return None
+    with _shared_pool_lock:
+        if _shared_pool is None or getattr(_shared_pool, "_broken", False):
+            if _shared_pool is not None:
+                logging.warning("预处理进程池已损坏，重新创建")
+                _shared_pool.shutdown(wait=False)
+            _shared_pool = create_process_pool(None, workers)
+        return _shared_pool
+
+
+class PipelineStats:
+    """流水线各阶段的利用率：阶段忙碌时间 / (工作者数 × 墙钟时间)
+
+    预处理阶段按每张图片的处理耗时累计；就绪队列按已编码图片等待网络名额的时间累计，
+    除以墙钟时间即平均排队深度；网络阶段按请求占用并发名额的时间累计。
+    就绪队列持续有积压时瓶颈在网络阶段，否则利用率接近饱和的阶段就是瓶颈。
+    """
+
+    def __init__(self, preprocess_workers: int, network_workers: int, prefetch: int):
+        self.preprocess_workers = preprocess_workers
+        self.network_workers = network_workers
+        self.prefetch = prefetch
+        self.items = 0
+        self.preprocess_time = 0.0
+        self.queue_time = 0.0
+        self.network_time = 0.0
+        self.blocked_time = 0.0       # 提交方因预取窗口已满而等待的时间
+        self.encoded = 0              # 实际解码编码（而非命中缓存或以 URL 发送）的图片数
+        self.peak_total = 0
+        self.peak_max = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = time.perf_counter()
+
+    def finish(self) -> None:
+        with self._lock:
+            self.finished_at = time.perf_counter()
+
+    def record_preprocess(self, elapsed: float, peak_bytes: int = 0) -> None:
+        """记录一张图片的预处理耗时，以及在本进程或预处理进程中编码时的估计内存峰值"""
+        with self._lock:
+            self.items += 1
+            self.preprocess_time += elapsed
+            if peak_bytes:
+                self.encoded += 1
+                self.peak_total += peak_bytes
+                self.peak_max = max(self.peak_max, peak_bytes)
+
+    def record_queue(self, elapsed: float) -> None:
+        with self._lock:
+            self.queue_time += elapsed
+
+    def record_network(self, elapsed: float) -> None:
+        with self._lock:
+            self.network_time += elapsed
+
+    def record_blocked(self, elapsed: float) -> None:
+        with self._lock:
+            self.blocked_time += elapsed
+
+    def report(self) -> dict:
+        with self._lock:
+            if self.started_at is None:
+                return {'items': 0}
+            wall = max((self.finished_at or time.perf_counter()) - self.started_at, 1e-9)
+            preprocess_workers = max(1, self.preprocess_workers)
+            result = {
+                'items': self.items,
+                'wall': wall,
+                'preprocess_util': min(1.0, self.preprocess_time / (preprocess_workers * wall)),
+                'preprocess_ms': self.preprocess_time / self.items * 1000 if self.items else 0.0,
+                'queue_depth': self.queue_time / wall,
+                'queue_wait': self.queue_time / self.items if self.items else 0.0,
+                'network_util': min(1.0, self.network_time / (max(1, self.network_workers) * wall)),
+                'blocked': self.blocked_time,
+                'peak_max_mb': self.peak_max / 1024 / 1024,
+                'peak_mean_mb': self.peak_total / self.encoded / 1024 / 1024 if self.encoded else 0.0,
+            }
+        # 编码好的图片在排队等网络名额说明网络阶段跟不上；否则看哪个阶段更接近饱和
+        if result['queue_depth'] >= 1:
+            result['bottleneck'] = "网络"
+        elif max(result['preprocess_util'], result['network_util']) < 0.5:
+            result['bottleneck'] = None
+        else:
+            result['bottleneck'] = "预处理" if result['preprocess_util'] > result['network_util'] else "网络"
+        return result
+
+    def format_report(self) -> str:
+        """以 Markdown 列表输出各阶段的工作者数、利用率和就绪队列深度"""
+        r = self.report()
+        if not r['items']:
+            return "- 无图片"
+        preprocess = f"{self.preprocess_workers} 进程" if self.preprocess_workers > 0 else "线程内"
+        if r['bottleneck'] is None:
+            bottleneck = "无（各阶段均未饱和，耗时主要取决于请求延迟）"
+        elif r['bottleneck'] == "预处理":
+            bottleneck = "预处理阶段（可增大预处理进程数或降低编码开销）"
+        else:
+            bottleneck = "网络阶段（可增大并发或增加端点）"
+        lines = [
+            f"- **预处理（{preprocess}）**: 利用率 {r['preprocess_util'] * 100:.1f}%，平均每张 {r['preprocess_ms']:.1f} ms",
+            f"- **就绪队列（领先 {self.prefetch} 张）**: 平均深度 {r['queue_depth']:.1f}，"
+            f"每张平均等待网络 {r['queue_wait']:.2f} 秒",
+            f"- **网络（{self.network_workers} 并发）**: 利用率 {r['network_util'] * 100:.1f}%",
+            f"- **瓶颈**: {bottleneck}，{r['items']} 张图片耗时 {r['wall']:.1f} 秒",
+        ]
+        if r['peak_max_mb']:
+            # 每个预处理工作者同时只处理一张图片，解码阶段的内存不超过 工作者数 × 单张峰值
+            lines.insert(1, f"- **单张图片内存峰值（估计）**: 最大 {r['peak_max_mb']:.1f} MB，"
+                            f"平均 {r['peak_mean_mb']:.1f} MB，同时解码最多 {max(1, self.preprocess_workers)} 张")
+        return "\n".join(lines)
+
+
+class TimedSemaphore:
+    """按时间积分统计的 asyncio 信号量（网络阶段的并发名额）
+
+    占用名额数 × 时间计入网络阶段忙碌时间，等待名额的请求数 × 时间计入就绪队列等待，
+    不需要为每次获取单独记录时间，因此可以直接替代 asyncio.Semaphore 传给 afanout_captions。
+    """
+
+    def __init__(self, value: int, stats: PipelineStats):
+        self._semaphore = asyncio.Semaphore(value)
+        self.stats = stats
+        self._held = 0
+        self._waiting = 0
+        self._last = time.perf_counter()
+
+    def _advance(self) -> None:
+        now = time.perf_counter()
+        elapsed, self._last = now - self._last, now
+        if self._held:
+            self.stats.record_network(self._held * elapsed)
+        if self._waiting:
+            self.stats.record_queue(self._waiting * elapsed)
+
+    async def __aenter__(self) -> "TimedSemaphore":
+        self._advance()
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._advance()
+            self._waiting -= 1
+        self._held += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._advance()
+        self._held -= 1
+        self._semaphore.release()
+
+
+class PreprocessPipeline:
+    """两级流水线（同步，供 Web 界面批量处理使用）：进程池解码/预缩放/编码 → 有界就绪窗口 → 网络线程
+
+    submit() 把图片交给预处理进程（路径在预处理时才打开，解码出的图像编码完立即释放），编码完成后自动转交网络线程执行 fn(data_url, *args)，网络线程只负责
+    收发请求。已提交但尚未开始发送的图片最多 network_workers + prefetch 张，窗口满时 submit() 阻塞，
+    预处理始终领先网络阶段 prefetch 张，又不会把整批图片的编码结果都堆在内存里。
+    传入 payload_cache 时先按文件内容查缓存，命中的图片不进入预处理进程，编码结果写回缓存；
+    传入 media 时文件以 file:// 或 HTTP URL 发送，不经过预处理（需要客户端处理的图片除外）。
+    传入 result_cache 且 submit() 给出 result_key 时先查结果缓存，命中的图片既不预处理也不发请求，
+    未命中的请求结果写回缓存。
+    传入 dedup 时 find_duplicates() 在预处理进程中计算整批图片的去重签名，调用方只提交每组重复图片的代表。
+    传入 pool 时使用这个共享的预处理进程池（关闭流水线时不关闭它），否则自行创建 preprocess_workers 个进程。
+    """
+
+    def __init__(self, preprocessor: ImagePreprocessor, network_workers: int,
+                 preprocess_workers: int = PREPROCESS_WORKERS, prefetch: int = DEFAULT_PREFETCH,
+                 payload_cache: Optional[PayloadCache] = None, media: Optional[MediaTransport] = None,
+                 result_cache: Optional[ResultCache] = None, dedup: Optional[DuplicateIndex] = None,
+                 pool: Optional[Executor] = None):
+        self.preprocessor = preprocessor
+        self.payload_cache = payload_cache
+        self.media = media
+        self.result_cache = result_cache
+        self.dedup = dedup
+        # 结果缓存是进程级的，报告中只统计本流水线期间的命中
+        self._result_snapshot = result_cache.snapshot() if result_cache is not None else None
+        self.stats = PipelineStats(preprocess_workers, network_workers, prefetch)
+        self._owns_pool = pool is None
+        if pool is not None:
+            self._preprocess = pool
+            self._prepare = partial(prepare_source, preprocessor=preprocessor)
+        elif preprocess_workers > 0:
+            self._preprocess = create_process_pool(preprocessor, preprocess_workers)
+            self._prepare = prepare_source
+        else:
+            self._preprocess = ThreadPoolExecutor(max_workers=max(1, network_workers))
+            self._prepare = partial(prepare_source, preprocessor=preprocessor)
+        self._network = ThreadPoolExecutor(max_workers=max(1, network_workers))
+        self._window = threading.BoundedSemaphore(max(1, network_workers) + max(0, prefetch))
+        # 只记录未完成的图片数，不持有已完成的 Future，close() 等它归零
+        self._outstanding = 0
+        self._idle = threading.Condition()
+
+    def find_duplicates(self, sources: Sequence) -> Dict[str, str]:
+        """返回 {重复图片: 代表}，未启用去重时为空；签名在预处理进程池（或线程池）中并行计算"""
+        if self.dedup is None:
+            return {}
+        return group_duplicates(self.dedup, sources, self._preprocess, self.preprocessor.max_pixels)
+
+    def submit(self, source: Union[str, Image.Image], fn: Callable, *args,
+               result_key: Optional[str] = None) -> Future:
+        """提交一张图片，返回 fn(data_url, *args) 结果的 Future；预处理失败时 Future 带有该异常。
+        给出 result_key 且结果缓存命中时直接返回已完成的 Future"""
+        if result_key is not None and self.result_cache is not None:
+            cached = self.result_cache.get(result_key)
+            if cached is not None:
+                done: Future = Future()
+                done.set_result(cached)
+                return done
+            fn = partial(self.result_cache.call, result_key, fn)
+        self.stats.start()
+        start = time.perf_counter()
+        self._window.acquire()
+        self.stats.record_blocked(time.perf_counter() - start)
+        result: Future = Future()
+        with self._idle:
+            self._outstanding += 1
+        result.add_done_callback(self._on_done)
+        if self.media is not None and isinstance(source, str):
+            url, elapsed = media_url(self.media, source)
+            if url is not None:
+                self.stats.record_preprocess(elapsed)
+                self._network.submit(self._send, result, fn, args, url, time.perf_counter())
+                return result
+        key = None
+        if self.payload_cache is not None and isinstance(source, str):
+            key, data_url, elapsed = lookup_payload(self.payload_cache, source, self.preprocessor)
+            if data_url is not None:
+                self.stats.record_preprocess(elapsed)
+                self._network.submit(self._send, result, fn, args, data_url, time.perf_counter())
+                return result
+        prepared = self._preprocess.submit(self._prepare, source)
+        prepared.add_done_callback(partial(self._on_prepared, result, fn, args, key))
+        return result
+
+    def _on_done(self, result: Future) -> None:
+        with self._idle:
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def _on_prepared(self, result: Future, fn: Callable, args: tuple, key: Optional[str], prepared: Future) -> None:
+        try:
+            payload, elapsed = prepared.result()
+        except BaseException as e:
+            self._window.release()
+            if result.set_running_or_notify_cancel():
+                result.set_exception(e)
+            return
+        try:
+            self.preprocessor.count(payload.passthrough)
+            self.stats.record_preprocess(elapsed, payload.peak_bytes)
+            if key is not None and not payload.passthrough:
+                self.payload_cache.put(key, payload.data_url)
+            self._network.submit(self._send, result, fn, args, payload.data_url, time.perf_counter())
+        except BaseException as e:
+            # 回调线程里的异常会被 Future 吞掉；不在这里结束 result，窗口名额不会归还，调用方会一直等下去
+            self._window.release()
+            if result.set_running_or_notify_cancel():
+                result.set_exception(e)
+
+    def _send(self, result: Future, fn: Callable, args: tuple, data_url: str, ready_at: float) -> None:
+        start = time.perf_counter()
+        self._window.release()
+        self.stats.record_queue(start - ready_at)
+        if not result.set_running_or_notify_cancel():
+            return
+        try:
+            result.set_result(fn(data_url, *args))
+        except BaseException as e:
+            result.set_exception(e)
+        finally:
+            self.stats.record_network(time.perf_counter() - start)
+
+    def stream(self, submissions: Iterable[Tuple[T, Future]]) -> Iterator[Tuple[T, Future]]:
+        """边提交边收集：submissions 通常是在迭代时才调用 submit() 的生成器（窗口满时阻塞），
+        每提交一张就交出所有已完成的 (标记, Future)，全部提交后按完成顺序交出其余的；交出的 Future 都已完成。
+        调用方在交出时写出结果并丢弃引用，已上传图片再多，内存中也只有窗口内和尚未完成的少量 Future；
+        一张图片卡住也不会挡住后面已完成图片的写出和进度。多个标记可以共享同一个 Future（重复图片）"""
+        pending: Dict[Future, List[T]] = {}
+        for tag, future in submissions:
+            pending.setdefault(future, []).append(tag)
+            for done in [future for future in pending if future.done()]:
+                for done_tag in pending.pop(done):
+                    yield done_tag, done
+        for done in as_completed(list(pending)):
+            for done_tag in pending.pop(done):
+                yield done_tag, done
+
+    def format_report(self) -> str:
+        """各阶段利用率，启用缓存时附带缓存命中情况"""
+        report = self.stats.format_report()
+        if self.payload_cache is not None:
+            report += f"\n- **预处理缓存**: {self.payload_cache.format_stats()}"
+        if self.media is not None:
+            report += f"\n- **图片传输**: {self.media.format_stats()}"
+        if self.result_cache is not None:
+            report += f"\n- **结果缓存**: {self.result_cache.format_stats(self._result_snapshot)}"
+        if self.dedup is not None:
+            report += f"\n- **重复图片**: {self.dedup.format_stats()}"
+        return report
+
+    def close(self) -> None:
+        """等待所有已提交的图片完成后关闭两个阶段的线程池/进程池"""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._outstanding)
+        self._network.shutdown()
+        if self._owns_pool:
+            self._preprocess.shutdown()
+        if self.media is not None:
+            self.media.close()
+        self.stats.finish()
+
+    def __enter__(self) -> "PreprocessPipeline":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def batch_pipeline(network_workers: int, media: Optional[MediaTransport] = None,
+                   result_cache: Optional[ResultCache] = None,
+                   dedup: Optional[DuplicateIndex] = None) -> PreprocessPipeline:
+    """Web 界面批量处理使用的流水线：默认预处理器、预处理缓存和共享的预处理进程池，预处理进程数和预取数由环境变量决定"""
+    pool = start_process_pool()
+    return PreprocessPipeline(
+        get_preprocessor(),
+        network_workers,
+        int(os.environ.get(PREPROCESS_WORKERS_ENV, PREPROCESS_WORKERS)),
+        int(os.environ.get(PREFETCH_ENV, DEFAULT_PREFETCH)),
+        get_payload_cache(),
+        media,
+        result_cache,
+        dedup,
+        pool,
+    )
@@ -0,0 +1,94 @@
+import math
+import threading
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+CHARS_PER_TOKEN = 4.0     # 服务端未返回 cached_tokens 时，按英文约 4 字符 / token 估计提示词长度
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计文本的 token 数"""
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def grouped_order(items: List[T], key: Callable[[T], Hashable]) -> Tuple[List[T], List[T]]:
+    """按提示词模板分组排列任务，返回 (预热任务, 其余任务)
+
+    预热任务为每个模板的第一个任务，先行发出，让各模板的 system + 提示词前缀各计算一次并写入缓存；
+    其余任务按模板首次出现的顺序成组排列，在途请求集中在同一个模板上，前缀在缓存中保持热度。
+    每个任务的模板不变，因此加权分配的比例不受影响。
+    """
+    groups: Dict[Hashable, List[T]] = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    primers = [group[0] for group in groups.values()]
+    rest = [item for group in groups.values() for item in group[1:]]
+    return primers, rest
+
+
+class PromptCacheStats:
+    """按提示词模板统计前缀缓存命中
+
+    服务端返回 usage.prompt_tokens_details.cached_tokens 时使用实测值；否则假设每个模板只有
+    预热请求未命中，按模板文本长度估计节省的提示词 token。
+    """
+
+    def __init__(self, prompts: Dict[Hashable, str], labels: Optional[Dict[Hashable, str]] = None):
+        self.prompts = prompts
+        self.labels = labels or {key: str(key) for key in prompts}
+        self._requests: Dict[Hashable, int] = {key: 0 for key in prompts}
+        self._prompt_tokens: Dict[Hashable, int] = {key: 0 for key in prompts}
+        self._cached_tokens: Dict[Hashable, int] = {key: 0 for key in prompts}
+        self._reported: Dict[Hashable, bool] = {key: False for key in prompts}
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable, usage) -> None:
+        """记录一次请求的 usage（可为 None）"""
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if usage is None:
+                return
+            self._prompt_tokens[key] = self._prompt_tokens.get(key, 0) + (usage.prompt_tokens or 0)
+            details = getattr(usage, 'prompt_tokens_details', None)
+            if details is not None and details.cached_tokens is not None:
+                self._cached_tokens[key] = self._cached_tokens.get(key, 0) + details.cached_tokens
+                self._reported[key] = True
+
+    def report(self) -> List[dict]:
+        """各模板的请求数、缓存命中率（实测或估计）与节省的提示词 token"""
+        rows = []
+        with self._lock:
+            for key, prompt in self.prompts.items():
+                requests = self._requests.get(key, 0)
+                if not requests:
+                    continue
+                if self._reported.get(key):
+                    saved = self._cached_tokens[key]
+                    prompt_tokens = self._prompt_tokens[key]
+                    hit = saved / prompt_tokens if prompt_tokens else 0.0
+                    measured = True
+                else:
+                    # 只有预热请求需要计算模板前缀
+                    saved = (requests - 1) * estimate_tokens(prompt)
+                    hit = (requests - 1) / requests
+                    measured = False
+                rows.append({'key': key, 'requests': requests, 'hit': hit, 'saved': saved, 'measured': measured})
+        return rows
+
+    def format_report(self) -> str:
+        """以 Markdown 列表输出各模板的缓存命中与节省的提示词 token"""
+        rows = self.report()
+        if not rows:
+            return "- 无请求"
+        lines = []
+        for row in rows:
+            if row['measured']:
+                detail = f"实测命中 {row['hit'] * 100:.1f}% 的提示词 token，节省 {row['saved']} tokens"
+            else:
+                detail = f"估计模板前缀命中 {row['hit'] * 100:.1f}%，节省约 {row['saved']} tokens"
+            lines.append(f"- **{self.labels[row['key']]}**: {row['requests']} 次请求，{detail}")
+        total = sum(row['saved'] for row in rows)
+        estimated = "" if all(row['measured'] for row in rows) else "约 "
+        lines.append(f"- **合计节省提示词 prefill**: {estimated}{total} tokens")
+        return "\n".join(lines)
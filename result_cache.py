@@ -0,0 +1,221 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from endpoint_router import parse_endpoints
+from image_preprocess import content_hash
+from payload_cache import EVICT_TARGET
+from vllm_client import get_client, resolve_model
+
+# 默认结果缓存上限（MB），描述文本很小，这已足够存下数百万条
+DEFAULT_RESULT_CACHE_MB = 512
+# 复用策略：reuse 命中时直接使用缓存结果、不发请求；refresh 不读缓存，重新生成并覆盖旧结果
+POLICY_REUSE = "reuse"
+POLICY_REFRESH = "refresh"
+POLICIES = (POLICY_REUSE, POLICY_REFRESH)
+# 环境变量：Web 界面批量处理使用的缓存数据库路径（不设置则不缓存）、上限（MB）和复用策略
+RESULT_CACHE_ENV = "JOYCAPTION_RESULT_CACHE"
+RESULT_CACHE_MB_ENV = "JOYCAPTION_RESULT_CACHE_MB"
+RESULT_CACHE_POLICY_ENV = "JOYCAPTION_RESULT_CACHE_POLICY"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    created REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE TABLE IF NOT EXISTS hashes (
+    fingerprint TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def sampling_params(temperature: float, top_p: float, max_tokens: int, n: int = 1,
+                    seed: Optional[int] = None) -> Dict[str, Any]:
+    """参与缓存键的采样参数；命令行和 Web 界面对相同设置得到相同的字典，两边的缓存可以互通"""
+    params = {'temperature': temperature, 'top_p': top_p, 'max_tokens': max_tokens, 'n': max(1, int(n))}
+    if seed is not None:
+        params['seed'] = seed
+    return params
+
+
+def served_models(base_url: str, api_key: str) -> str:
+    """各端点当前加载的模型 ID（去重后排序，逗号连接），作为结果缓存键的一部分；服务端换模型后缓存自然失效"""
+    return ",".join(sorted({resolve_model(get_client(api_key, endpoint)) for endpoint in parse_endpoints(base_url)}))
+
+
+class ResultCache:
+    """跨运行的打标结果缓存（SQLite）：键为图片内容哈希 + 最终提示词 + 模型 ID + 采样参数（含 seed），值为描述列表
+
+    同一批图片用相同提示词和采样设置重跑时，命中的图片不解码、不发请求，GPU 时间为零。
+    采样参数未固定 seed 时缓存的是上一次的随机采样结果，由复用策略显式决定是否接受：
+    reuse 直接复用，refresh 重新生成并覆盖。
+    每条记录保存生成它的请求耗时，命中时累计为节省的 GPU 时间；总大小超过上限时按最近使用时间淘汰。
+    另按文件指纹（路径 + 大小 + 修改时间）记录内容哈希，重跑未改变的图片时不必重新计算哈希。
+    连接在线程间共享，所有操作由一把锁串行化。
+    """
+
+    def __init__(self, path: str, max_mb: int = DEFAULT_RESULT_CACHE_MB, policy: str = POLICY_REUSE):
+        if policy not in POLICIES:
+            raise ValueError(f"不支持的复用策略: {policy}，可选 {', '.join(POLICIES)}")
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def image_hash(self, image_path: str) -> str:
+        """图片文件的内容哈希，文件指纹未变时直接读取记录"""
+        stat = os.stat(image_path)
+        fingerprint = f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM hashes WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if row is not None:
+            return row[0]
+        digest = content_hash(image_path)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?)", (fingerprint, digest))
+        return digest
+
+    @staticmethod
+    def key(image_hash: str, prompt: Union[str, Dict[str, str]], model: str, params: Dict[str, Any]) -> str:
+        """缓存键：图片内容哈希、提示词（扇出模式为 {名称: 提示词}）、模型 ID 和采样参数的 SHA-256"""
+        fingerprint = json.dumps(
+            {'image': image_hash, 'prompt': prompt, 'model': model, 'params': params},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    def key_for(self, image_path: str, prompt: Union[str, Dict[str, str]], model: str,
+                params: Dict[str, Any]) -> Optional[str]:
+        """按图片文件计算缓存键，读取文件出错时返回 None（不使用缓存）"""
+        try:
+            return self.key(self.image_hash(image_path), prompt, model, params)
+        except OSError as e:
+            logging.warning(f"计算结果缓存键失败 {image_path}: {str(e)}")
+            return None
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存结果，未命中或策略为 refresh 时返回 None"""
+        with self._lock:
+            if self.policy == POLICY_REFRESH:
+                self.misses += 1
+                return None
+            row = self._conn.execute("SELECT result, seconds FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            self.saved_seconds += row[1]
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Any, seconds: float) -> None:
+        """写入一条结果及生成它的请求耗时，必要时淘汰最久未用的条目；写入失败只记录警告"""
+        data = json.dumps(result, ensure_ascii=False)
+        size = len(key) + len(data.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            try:
+                previous = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self._conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                   (key, data, size, seconds, now, now))
+            except sqlite3.Error as e:
+                logging.warning(f"写入结果缓存失败 {self.path}: {str(e)}")
+                return
+            self.stores += 1
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """按最近使用时间从旧到新删除条目，直到总大小低于上限的 EVICT_TARGET（调用方持有锁）"""
+        target = self.max_bytes * EVICT_TARGET
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY used"):
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= size
+        self._conn.executemany("DELETE FROM results WHERE key = ?", keys)
+        self.evictions += len(keys)
+
+    def call(self, key: str, fn: Callable, *args) -> Any:
+        """执行 fn(*args) 并把结果和耗时写入缓存，出错时不写入"""
+        start = time.perf_counter()
+        result = fn(*args)
+        self.put(key, result, time.perf_counter() - start)
+        return result
+
+    def snapshot(self) -> Dict[str, float]:
+        """当前累计计数，传给 format_stats 可只统计之后的一段（例如一次批量任务）"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                    'saved_seconds': self.saved_seconds}
+
+    def format_stats(self, since: Optional[Dict[str, float]] = None) -> str:
+        """命中率、节省的 GPU 时间（按命中条目当初的请求耗时累计）与缓存占用"""
+        current = self.snapshot()
+        if since is not None:
+            current = {name: value - since[name] for name, value in current.items()}
+        lookups = current['hits'] + current['misses']
+        rate = current['hits'] / lookups * 100 if lookups else 0.0
+        return (f"命中 {current['hits']:.0f} / {lookups:.0f} 张（{rate:.1f}%），"
+                f"节省约 {current['saved_seconds']:.1f} 秒 GPU 时间，新写入 {current['stores']:.0f} 条；"
+                f"策略 {self.policy}，占用 {self.size / 1024 / 1024:.1f} / {self.max_bytes / 1024 / 1024:.0f} MB")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_default: Optional[ResultCache] = None
+_default_lock = threading.Lock()
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """进程级默认结果缓存，由环境变量 JOYCAPTION_RESULT_CACHE 指定数据库路径，未设置时返回 None（不缓存）"""
+    global _default
+    path = os.environ.get(RESULT_CACHE_ENV)
+    if not path:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = ResultCache(
+                path,
+                int(os.environ.get(RESULT_CACHE_MB_ENV, DEFAULT_RESULT_CACHE_MB)),
+                os.environ.get(RESULT_CACHE_POLICY_ENV, POLICY_REUSE).lower(),
+            )
+        return _default
+
+
+def batch_result_cache(base_url: str, api_key: str) -> Tuple[Optional[ResultCache], Optional[str]]:
+    """Web 界面批量处理使用的结果缓存和当前模型 ID；未启用缓存或无法获取模型 ID 时返回 (None, None)，本次不使用缓存"""
+    cache = get_result_cache()
+    if cache is None:
+        return None, None
+    try:
+        return cache, served_models(base_url, api_key)
+    except Exception as e:
+        logging.warning(f"无法获取模型 ID，本次不使用结果缓存: {str(e)}")
+        return None, None
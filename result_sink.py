@@ -0,0 +1,80 @@
+import os
+import threading
+import zipfile
+from typing import Optional, Set
+
+# ZIP 条目的压缩方式：stored 不压缩（写入最快），deflated 压缩（描述文本通常能压到原来的 1/3 左右）
+COMPRESSION_STORED = "stored"
+COMPRESSION_DEFLATED = "deflated"
+COMPRESSIONS = {COMPRESSION_STORED: zipfile.ZIP_STORED, COMPRESSION_DEFLATED: zipfile.ZIP_DEFLATED}
+DEFAULT_COMPRESSION = COMPRESSION_DEFLATED
+# 环境变量：Web 界面批量处理结果压缩包的压缩方式和 deflate 压缩级别（0-9，不设置时为 zlib 默认的 6）
+ZIP_COMPRESSION_ENV = "JOYCAPTION_ZIP_COMPRESSION"
+ZIP_LEVEL_ENV = "JOYCAPTION_ZIP_LEVEL"
+
+
+class ZipSink:
+    """边收结果边写压缩包：每条描述完成时直接作为一个条目追加到 ZIP，不先写成单独的文件再统一压缩
+
+    条目数据在 write() 时就已压缩并写入磁盘，close() 只需补上中央目录，最后一条描述写完即可下载。
+    同名条目（不同目录下的同名图片）依次改名为 name (2).txt、name (3).txt ...。线程安全。
+    """
+
+    def __init__(self, path: str, compression: str = DEFAULT_COMPRESSION, level: Optional[int] = None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"不支持的压缩方式: {compression}，可选 {', '.join(COMPRESSIONS)}")
+        self.path = path
+        self.compression = compression
+        self.level = level if compression == COMPRESSION_DEFLATED else None
+        self._zip = zipfile.ZipFile(path, 'w', COMPRESSIONS[compression], compresslevel=self.level)
+        self._names: Set[str] = set()
+        self._lock = threading.Lock()
+        self.entries = 0
+        self.raw_bytes = 0
+
+    def _unique(self, name: str) -> str:
+        root, ext = os.path.splitext(name)
+        candidate, index = name, 2
+        while candidate in self._names:
+            candidate = f"{root} ({index}){ext}"
+            index += 1
+        self._names.add(candidate)
+        return candidate
+
+    def write(self, name: str, text: str) -> str:
+        """把一段文本作为条目追加到压缩包，返回实际使用的条目名"""
+        data = text.encode('utf-8')
+        with self._lock:
+            name = self._unique(name)
+            self._zip.writestr(name, data)
+            self.entries += 1
+            self.raw_bytes += len(data)
+        return name
+
+    def close(self) -> str:
+        """写入中央目录并关闭文件，返回压缩包路径"""
+        with self._lock:
+            self._zip.close()
+        return self.path
+
+    def format_stats(self) -> str:
+        size = os.path.getsize(self.path)
+        level = f"（级别 {self.level}）" if self.level is not None else ""
+        return (f"{self.entries} 个文件，{self.compression}{level}，"
+                f"原始 {self.raw_bytes / 1024:.1f} KB → 压缩包 {size / 1024:.1f} KB")
+
+    def __enter__(self) -> "ZipSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def batch_zip_sink(path: str) -> ZipSink:
+    """Web 界面批量处理使用的结果压缩包，压缩方式和级别由环境变量决定"""
+    level = os.environ.get(ZIP_LEVEL_ENV)
+    return ZipSink(
+        path,
+        os.environ.get(ZIP_COMPRESSION_ENV, DEFAULT_COMPRESSION).lower(),
+        int(level) if level else None,
+    )
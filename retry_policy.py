@@ -0,0 +1,230 @@
+import asyncio
+import random
+import threading
+import time
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from openai import APIConnectionError, APIStatusError, RateLimitError
+
+from endpoint_router import is_endpoint_failure
+from vllm_client import DeadlineExceeded
+
+# 重试默认参数
+MAX_RETRIES = 3
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+
+# 熔断默认参数
+FAILURE_THRESHOLD = 5      # 连续失败多少次后熔断
+RECOVERY_TIMEOUT = 30.0    # 熔断后多久放行一个探测请求
+MAX_PAUSE = 600.0          # 单个请求因熔断最多等待多久，超过则放弃
+PROBE_WAIT = 1.0           # 半开状态下其他请求的轮询间隔
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """连接错误、超时（含超过截止时间）、429 和 5xx 可以重试，其他 4xx 是请求本身的问题，重试无意义"""
+    if isinstance(exc, (APIConnectionError, RateLimitError, DeadlineExceeded)):
+        return True
+    return isinstance(exc, APIStatusError) and (exc.status_code >= 500 or exc.status_code == 408)
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    """读取服务端 Retry-After 头（秒）"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """指数退避 + 全抖动的重试策略"""
+
+    def __init__(self, max_retries: int = MAX_RETRIES, base_delay: float = BASE_DELAY,
+                 max_delay: float = MAX_DELAY):
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, exc: BaseException) -> float:
+        """第 attempt 次失败后的等待时间：优先使用 Retry-After，否则在 [0, base·2^attempt] 内随机"""
+        retry_after = _retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def should_retry(self, attempt: int, exc: BaseException) -> bool:
+        """第 attempt 次失败后是否还应重试"""
+        return attempt < self.max_retries and is_retryable(exc)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """同步执行 fn，可重试的错误按退避策略重试"""
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                delay = self.delay(attempt, e)
+                logging.warning(f"请求失败，{delay:.2f} 秒后重试 ({attempt + 1}/{self.max_retries}): {str(e)}")
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, fn: Callable, *args, **kwargs):
+        """异步版本的 call，fn 为协程函数"""
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                delay = self.delay(attempt, e)
+                logging.warning(f"请求失败，{delay:.2f} 秒后重试 ({attempt + 1}/{self.max_retries}): {str(e)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+class CircuitOpenError(Exception):
+    """端点熔断时间过长，放弃本次请求"""
+
+
+class CircuitBreaker:
+    """单端点熔断器：连续故障后打开，暂停发往该端点的请求，到时放行一个探测请求"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD,
+                 recovery_timeout: float = RECOVERY_TIMEOUT, max_pause: float = MAX_PAUSE):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.max_pause = max_pause
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _wait_time(self) -> float:
+        """返回需要等待的秒数，0 表示可以立即发送"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.recovery_timeout - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = True
+                logging.info(f"熔断器半开，发送探测请求: {self.name}")
+                return 0.0
+            if self._probe_in_flight:
+                return PROBE_WAIT
+            self._probe_in_flight = True
+            return 0.0
+
+    def wait(self) -> None:
+        """熔断期间阻塞等待，超过 max_pause 抛出 CircuitOpenError"""
+        deadline = time.monotonic() + self.max_pause
+        while True:
+            delay = self._wait_time()
+            if delay <= 0:
+                return
+            if time.monotonic() + delay > deadline:
+                raise CircuitOpenError(f"端点 {self.name} 熔断超过 {self.max_pause:.0f} 秒")
+            time.sleep(min(delay, PROBE_WAIT * 5))
+
+    async def await_ready(self) -> None:
+        """wait 的异步版本"""
+        deadline = time.monotonic() + self.max_pause
+        while True:
+            delay = self._wait_time()
+            if delay <= 0:
+                return
+            if time.monotonic() + delay > deadline:
+                raise CircuitOpenError(f"端点 {self.name} 熔断超过 {self.max_pause:.0f} 秒")
+            await asyncio.sleep(min(delay, PROBE_WAIT * 5))
+
+    def cancel(self) -> None:
+        """请求被主动取消，不计入成败；若它是半开状态的探测请求，允许下一个请求接替探测"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record(self, error: Optional[BaseException] = None) -> None:
+        """记录一次请求结果；只有端点故障（连接失败、5xx，不含超时）计入熔断，429 和超时只是繁忙"""
+        with self._lock:
+            if error is None or not is_endpoint_failure(error):
+                if self.state != self.CLOSED:
+                    logging.info(f"熔断器关闭，端点恢复: {self.name}")
+                self.state = self.CLOSED
+                self._failures = 0
+                self._probe_in_flight = False
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning(f"端点熔断 {self.recovery_timeout:.0f} 秒: {self.name} ({str(error)})")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+class DeadLetterQueue:
+    """失败任务列表，可保存为文件后单独重跑"""
+
+    def __init__(self):
+        self._items: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def add(self, key: str, error: str) -> None:
+        with self._lock:
+            self._items.append((key, " ".join(str(error).split())))
+
+    @property
+    def items(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._items)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def dumps(self) -> str:
+        """每行一条 "路径\\t错误" 的文本"""
+        return "".join(f"{key}\t{error}\n" for key, error in self.items)
+
+    def save(self, path: str) -> None:
+        """保存为 "路径\\t错误" 的文本文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.dumps())
+
+    @staticmethod
+    def load(path: str) -> List[str]:
+        """读取失败列表中的路径"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.split("\t", 1)[0] for line in f if line.strip()]
+
+
+# 默认策略和按端点共享的熔断器
+DEFAULT_RETRY_POLICY = RetryPolicy()
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(base_url: str) -> CircuitBreaker:
+    """获取端点对应的熔断器"""
+    key = base_url.rstrip("/")
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key)
+            _breakers[key] = breaker
+        return breaker
@@ -0,0 +1,406 @@
+import threading
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple, Optional, Union
+
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, NotFoundError
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+# 连接池参数：vLLM 单机可同时跑几十条序列，连接数要比并发上限留有余量
+MAX_CONNECTIONS = 128
+MAX_KEEPALIVE_CONNECTIONS = 64
+KEEPALIVE_EXPIRY = 120.0  # 秒，批处理间隙较长时也能复用连接
+CONNECT_TIMEOUT = 10.0
+REQUEST_TIMEOUT = httpx.Timeout(300.0, connect=CONNECT_TIMEOUT)
+
+# 模型ID缓存时间：过期后先返回旧值，同时在后台刷新
+MODEL_CACHE_TTL = 300.0
+
+
+class ClientRegistry:
+    """进程级 OpenAI 客户端注册表，按 (base_url, api_key) 复用长连接客户端"""
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = KEEPALIVE_EXPIRY,
+        timeout: httpx.Timeout = REQUEST_TIMEOUT,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str], OpenAI] = {}
+        self._async_clients: Dict[Tuple[str, str, Optional[int]], AsyncOpenAI] = {}
+
+    @staticmethod
+    def _key(api_key: str, base_url: str) -> Tuple[str, str]:
+        return (base_url.rstrip("/"), api_key)
+
+    def get_client(self, api_key: str, base_url: str) -> OpenAI:
+        """获取（或创建）同步客户端"""
+        key = self._key(api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                http_client = DefaultHttpxClient(limits=self.limits, timeout=self.timeout)
+                # 重试由 retry_policy 统一负责（带熔断和端点切换），关闭 SDK 自带的重试
+                client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+                self._clients[key] = client
+                logging.info(f"创建共享客户端: {key[0]}")
+            return client
+
+    def get_async_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        """获取（或创建）异步客户端，连接池绑定当前事件循环"""
+        try:
+            loop_id = id(asyncio.get_running_loop())
+        except RuntimeError:
+            loop_id = None
+        key = self._key(api_key, base_url) + (loop_id,)
+        with self._lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                http_client = DefaultAsyncHttpxClient(limits=self.limits, timeout=self.timeout)
+                client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+                self._async_clients[key] = client
+            return client
+
+    async def aclose_async_clients(self) -> None:
+        """关闭当前事件循环下的异步客户端"""
+        loop_id = id(asyncio.get_running_loop())
+        with self._lock:
+            keys = [key for key in self._async_clients if key[2] == loop_id]
+            clients = [self._async_clients.pop(key) for key in keys]
+        for client in clients:
+            await client.close()
+
+    def close(self) -> None:
+        """关闭所有同步客户端"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+# 进程级默认注册表
+_registry = ClientRegistry()
+
+
+def get_client(api_key: str, base_url: str) -> OpenAI:
+    """获取共享的同步 OpenAI 客户端"""
+    return _registry.get_client(api_key, base_url)
+
+
+def get_async_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """获取共享的异步 OpenAI 客户端"""
+    return _registry.get_async_client(api_key, base_url)
+
+
+async def aclose_async_clients() -> None:
+    """关闭当前事件循环下的共享异步客户端"""
+    await _registry.aclose_async_clients()
+
+
+def close_clients() -> None:
+    """关闭所有共享同步客户端"""
+    _registry.close()
+
+
+class ModelResolver:
+    """按端点缓存已部署的模型ID：TTL 过期后后台刷新，模型不存在时失效"""
+
+    def __init__(self, ttl: float = MODEL_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._fetch_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._async_fetch_locks: Dict[Tuple[str, str, int], asyncio.Lock] = {}
+        self._refreshing: set = set()
+
+    @staticmethod
+    def _key(client: Union[OpenAI, AsyncOpenAI]) -> Tuple[str, str]:
+        return (str(client.base_url).rstrip("/"), client.api_key)
+
+    def _lookup(self, key: Tuple[str, str]) -> Optional[Tuple[str, bool]]:
+        """返回 (模型ID, 是否过期)，未缓存时返回 None"""
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is None:
+            return None
+        model_id, fetched_at = entry
+        return model_id, time.monotonic() - fetched_at > self.ttl
+
+    def _store(self, key: Tuple[str, str], models) -> str:
+        if not models.data:
+            raise RuntimeError(f"{key[0]} 没有可用的模型")
+        model_id = models.data[0].id
+        with self._lock:
+            previous = self._cache.get(key)
+            self._cache[key] = (model_id, time.monotonic())
+        if previous is None or previous[0] != model_id:
+            logging.info(f"端点 {key[0]} 使用模型: {model_id}")
+        return model_id
+
+    def _claim_refresh(self, key: Tuple[str, str]) -> bool:
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _release_refresh(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def resolve(self, client: OpenAI) -> str:
+        """获取端点当前的模型ID（同步客户端）"""
+        key = self._key(client)
+        cached = self._lookup(key)
+        if cached is not None:
+            model_id, stale = cached
+            if stale and self._claim_refresh(key):
+                threading.Thread(target=self._refresh, args=(client, key), daemon=True).start()
+            return model_id
+
+        # 首次解析时按端点加锁，避免并发线程同时请求 /models
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached[0]
+            return self._store(key, client.models.list())
+
+    def _refresh(self, client: OpenAI, key: Tuple[str, str]) -> None:
+        try:
+            self._store(key, client.models.list())
+        except Exception as e:
+            logging.warning(f"后台刷新模型列表失败 ({key[0]}): {str(e)}")
+        finally:
+            self._release_refresh(key)
+
+    async def aresolve(self, client: AsyncOpenAI) -> str:
+        """获取端点当前的模型ID（异步客户端）"""
+        key = self._key(client)
+        cached = self._lookup(key)
+        if cached is not None:
+            model_id, stale = cached
+            if stale and self._claim_refresh(key):
+                asyncio.create_task(self._arefresh(client, key))
+            return model_id
+
+        loop_id = id(asyncio.get_running_loop())
+        with self._lock:
+            fetch_lock = self._async_fetch_locks.setdefault(key + (loop_id,), asyncio.Lock())
+        async with fetch_lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached[0]
+            return self._store(key, await client.models.list())
+
+    async def _arefresh(self, client: AsyncOpenAI, key: Tuple[str, str]) -> None:
+        try:
+            self._store(key, await client.models.list())
+        except Exception as e:
+            logging.warning(f"后台刷新模型列表失败 ({key[0]}): {str(e)}")
+        finally:
+            self._release_refresh(key)
+
+    def invalidate(self, client: Union[OpenAI, AsyncOpenAI]) -> None:
+        """丢弃端点的缓存模型ID（例如服务端换了模型）"""
+        with self._lock:
+            self._cache.pop(self._key(client), None)
+
+
+# 进程级默认模型解析器
+_resolver = ModelResolver()
+
+
+def resolve_model(client: OpenAI) -> str:
+    """获取端点当前的模型ID（带缓存）"""
+    return _resolver.resolve(client)
+
+
+def invalidate_model(client: Union[OpenAI, AsyncOpenAI]) -> None:
+    """使端点的缓存模型ID失效"""
+    _resolver.invalidate(client)
+
+
+def create_chat_completion(client: OpenAI, **kwargs):
+    """使用缓存的模型ID发起 chat completion，模型不存在时刷新后重试一次"""
+    try:
+        return client.chat.completions.create(model=resolve_model(client), **kwargs)
+    except NotFoundError:
+        # vLLM 对未知模型返回 404，说明服务端已更换模型
+        invalidate_model(client)
+        return client.chat.completions.create(model=resolve_model(client), **kwargs)
+
+
+async def acreate_chat_completion(client: AsyncOpenAI, **kwargs):
+    """create_chat_completion 的异步版本"""
+    try:
+        return await client.chat.completions.create(model=await _resolver.aresolve(client), **kwargs)
+    except NotFoundError:
+        invalidate_model(client)
+        return await client.chat.completions.create(model=await _resolver.aresolve(client), **kwargs)
+
+
+class StreamProgress:
+    """流式生成的进度：已生成文本、首 token 时间（TTFT）和解码速度
+
+    n > 1 时各变体的文本按 choice 下标保存在 texts 中，text 为第一个变体。
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.sent_at: Optional[float] = None      # 请求真正发出的时刻（不含排队）
+        self.endpoint: Optional[str] = None       # 实际处理请求的端点
+        self.first_token_at: Optional[float] = None
+        self.end: Optional[float] = None
+        self.texts: Dict[int, str] = {}
+        self.chunks = 0
+        self.completion_tokens: Optional[int] = None
+        self.prompt_tokens: Optional[int] = None
+        self.cached_tokens: Optional[int] = None   # 命中前缀缓存的提示词 token 数，服务端未返回时为 None
+        self.finish_reason: Optional[str] = None
+
+    def update(self, chunk) -> str:
+        """处理一个数据块，返回第一个变体新增的文本"""
+        if chunk.usage is not None:
+            self.completion_tokens = chunk.usage.completion_tokens
+            self.prompt_tokens = chunk.usage.prompt_tokens
+            details = getattr(chunk.usage, 'prompt_tokens_details', None)
+            if details is not None and details.cached_tokens is not None:
+                self.cached_tokens = details.cached_tokens
+        first_delta = ""
+        for choice in chunk.choices:
+            delta = choice.delta.content or ""
+            if choice.index == 0:
+                first_delta = delta
+                if choice.finish_reason is not None:
+                    self.finish_reason = choice.finish_reason
+            if delta:
+                if self.first_token_at is None:
+                    self.first_token_at = time.monotonic()
+                self.texts[choice.index] = self.texts.get(choice.index, "") + delta
+                self.chunks += 1
+        return first_delta
+
+    @property
+    def text(self) -> str:
+        """第一个变体的文本"""
+        return self.texts.get(0, "")
+
+    @property
+    def variants(self) -> List[str]:
+        """按下标排列的所有变体文本"""
+        return [text for _, text in sorted(self.texts.items())]
+
+    def finish(self) -> None:
+        self.end = time.monotonic()
+
+    @property
+    def ttft(self) -> Optional[float]:
+        """首 token 时间（秒）"""
+        return None if self.first_token_at is None else self.first_token_at - self.start
+
+    @property
+    def server_ttft(self) -> Optional[float]:
+        """从请求发出到首 token 的时间，不含排队等待并发名额的时间，近似服务端 prefill 耗时"""
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - (self.sent_at if self.sent_at is not None else self.start)
+
+    @property
+    def tokens(self) -> int:
+        """已生成的 token 数；服务端返回 usage 前按数据块计数（vLLM 每块约一个 token）"""
+        return self.completion_tokens if self.completion_tokens is not None else self.chunks
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """首 token 之后的解码速度"""
+        if self.first_token_at is None or self.tokens < 2:
+            return None
+        elapsed = (self.end or time.monotonic()) - self.first_token_at
+        return (self.tokens - 1) / elapsed if elapsed > 0 else None
+
+    def format(self) -> str:
+        """以一行文本输出进度"""
+        if self.ttft is None:
+            return f"⏳ 等待首个 token… {time.monotonic() - self.start:.1f}s"
+        speed = self.tokens_per_second
+        speed_text = f"{speed:.1f} tokens/s" if speed is not None else "- tokens/s"
+        return f"⏱️ 首 token {self.ttft:.2f}s · {speed_text} · {self.tokens} tokens"
+
+
+class RequestCancelled(Exception):
+    """请求在完成前被主动取消（例如对冲请求中落后的一方）"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求超过截止时间，连接已关闭（vLLM 随之中止生成）"""
+
+
+def request_timeout(deadline: float) -> httpx.Timeout:
+    """距截止时刻（time.monotonic()）的剩余时间作为本次 HTTP 请求的超时；非流式请求在生成结束前没有数据，
+    读超时即整个请求的时限。已过截止时间时抛出 DeadlineExceeded"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return httpx.Timeout(remaining, connect=min(CONNECT_TIMEOUT, remaining))
+
+
+def check_deadline(deadline: Optional[float]) -> None:
+    """流式读取时逐块检查截止时间：读超时只限制两个数据块之间的间隔，不限制总时长"""
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded()
+
+
+def collect_chat_stream(stream, cancel_event: Optional[threading.Event] = None,
+                        deadline: Optional[float] = None) -> ChatCompletion:
+    """读取流式 chat completion 并拼装成普通的 ChatCompletion
+
+    cancel_event 被置位或超过截止时间 deadline 后，在下一个数据块到达时关闭连接并抛出
+    RequestCancelled / DeadlineExceeded，vLLM 检测到客户端断开后会中止该请求，释放 GPU。
+    """
+    texts: Dict[int, List[str]] = {}
+    finish_reasons: Dict[int, Optional[str]] = {}
+    first = None
+    usage = None
+    try:
+        for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled()
+            check_deadline(deadline)
+            first = first or chunk
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                texts.setdefault(choice.index, []).append(choice.delta.content or "")
+                if choice.finish_reason is not None:
+                    finish_reasons[choice.index] = choice.finish_reason
+    finally:
+        stream.close()
+    return ChatCompletion.construct(
+        id=first.id if first else "",
+        object="chat.completion",
+        created=first.created if first else int(time.time()),
+        model=first.model if first else "",
+        choices=[
+            Choice.construct(
+                index=index,
+                finish_reason=finish_reasons.get(index) or "stop",
+                message=ChatCompletionMessage.construct(role="assistant", content="".join(parts)),
+            )
+            for index, parts in sorted(texts.items())
+        ],
+        usage=usage,
+    )